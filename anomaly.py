@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+"""
+Compute monthly and annual anomalies for station records.
+
+A record is a sequence of monthly values, 12 for each year,
+starting with January; invalid values are marked with `bad`.
+Rather than visiting each datum in turn, the computation works on
+whole calendar-month columns (data[m::12]) and whole years
+(data[12*y:12*y+12]), so that the work done per datum is as small
+as possible.
+
+`dataset_anomalies` does the same for every station in a binary
+cache (see ghcnm_cache.py) at once: since every series in the
+cache starts in January, each calendar month of a whole block of
+series is a single strided slice of the cache's matrix of values,
+and it is converted with one comprehension over the block, not one
+for each series.
+
+The rules are those used by stationplot.py: the climatology for
+each calendar month is the mean of its valid values; an annual
+anomaly is the mean of the valid monthly anomalies, provided there
+are at least 6 of them.
+"""
+
+# Same as stationplot.BAD.
+BAD = 9999
+
+# Minimum number of valid monthly anomalies for a valid annual
+# anomaly.
+MIN_MONTHS = 6
+
+def climatology(data, bad=BAD):
+    """
+    Return a list of 12 means, one for each calendar month of
+    `data`.  A calendar month with no valid data has a mean of
+    `bad`.
+    """
+
+    result = []
+    for m in range(12):
+        good = [x for x in data[m::12] if x != bad]
+        if good:
+            result.append(float(sum(good)) / len(good))
+        else:
+            result.append(bad)
+    return result
+
+def monthly_anomalies(data, bad=BAD):
+    """
+    Convert `data` to monthly anomalies by subtracting the
+    climatology from each datum.  A pair of (monthly_anomalies,
+    climatology) is returned.
+    """
+
+    means = climatology(data, bad)
+    anomalies = list(data)
+    for m, mean in enumerate(means):
+        # When *mean* is bad, so is every datum in the column.
+        anomalies[m::12] = [x if x == bad else x - mean
+          for x in data[m::12]]
+    return anomalies, means
+
+def mean12(block, bad=BAD):
+    """
+    The mean of the valid values in `block` (normally one year of
+    12 values), or `bad` if there are fewer than 6 valid values.
+    """
+
+    good = [x for x in block if x != bad]
+    if len(good) < MIN_MONTHS:
+        return bad
+    return sum(good) / float(len(good))
+
+def annual_anomalies(data, bad=BAD):
+    """
+    Convert `data` to annual anomalies (one per year).  A pair of
+    (annual_anomalies, annual_average) is returned; annual_average
+    is the mean of the monthly climatology.
+    """
+
+    monthlies, means = monthly_anomalies(data, bad)
+    annual = [mean12(monthlies[i:i+12], bad)
+      for i in range(0, len(monthlies) - 11, 12)]
+    return annual, mean12(means, bad)
+
+def annual_temps(data, bad=BAD):
+    """
+    Convert `data` to annual temperatures: annual anomalies with the
+    annual average added back.
+    """
+
+    anoms, average = annual_anomalies(data, bad)
+    return [d if d == bad else d + average for d in anoms]
+
+# The modes of `dataset_anomalies` (the same as stationplot.py's
+# --mode option).
+MODES = ('anom', 'annanom', 'annual')
+
+# Number of values in a block of series converted at once by
+# `dataset_anomalies`.
+BLOCK = 1 << 20
+
+def dataset_anomalies(cache, element='TAVG', mode='anom', scale=0.01):
+    """
+    For every series of `element` in `cache` (a ghcnm_cache.Cache
+    instance), yield an (id, first_year, anomalies) triple.  Values
+    are multiplied by `scale` (to give degrees C for GHCN-M v3)
+    before conversion, exactly as stationplot.from_lines does,
+    so the results are identical to plotting each station in turn.
+    `mode` is one of 'anom', 'annanom', 'annual'.
+
+    The series are converted in blocks of about BLOCK values (see
+    `block_anomalies`).
+    """
+
+    if mode not in MODES:
+        raise ValueError("Unknown mode %r" % mode)
+    i = 0
+    while i < len(cache):
+        j = i + 1
+        while j < len(cache) and cache.start[j] - cache.start[i] < BLOCK:
+            j += 1
+        for k, anomalies in block_anomalies(cache, i, j, mode, scale,
+          element):
+            yield cache.id(k), cache.first_year[k], anomalies
+        i = j
+
+def block_anomalies(cache, i, j, mode, scale, element):
+    """
+    Convert the series from `i` up to `j` of `cache` (those of
+    `element` only), as per `dataset_anomalies`, and yield a
+    (series, anomalies) pair for each.
+
+    The whole block is converted a calendar month at a time.  The
+    climatology of each series is the sum of its segment of the
+    month (with 0.0 for invalid data, which leaves the sum
+    unchanged) over its number of valid values (found with
+    list.count), and the anomalies of the month are one
+    comprehension over the block, with the climatology of each
+    series repeated for each of its years.
+    """
+
+    if not any(cache.element(k) == element for k in range(i, j)):
+        return
+    # MISSING in the cache.
+    missing = -9999
+    start = cache.start
+    base = start[i]
+    values = cache.values[base:start[j]]
+    # The first row (year) of each series in the block, and the end.
+    rows = [(start[k] - base) // 12 for k in range(i, j + 1)]
+    spans = list(zip(rows, rows[1:]))
+    # For each series, its 12 monthly means.
+    means = [[] for _ in spans]
+    # For each calendar month, the anomalies of the whole block.
+    columns = []
+    for m in range(12):
+        column = values[m::12].tolist()
+        scaled = [0.0 if v == missing else v * scale for v in column]
+        repeated = []
+        for (a, b), series_means in zip(spans, means):
+            good = (b - a) - column[a:b].count(missing)
+            if good:
+                mean = float(sum(scaled[a:b])) / good
+            else:
+                mean = BAD
+            series_means.append(mean)
+            repeated.extend([mean] * (b - a))
+        columns.append([BAD if v == missing else x - mean
+          for v, x, mean in zip(column, scaled, repeated)])
+    del values
+
+    if mode != 'anom':
+        # One annual anomaly for each row of the block.
+        annual = [mean12(row) for row in zip(*columns)]
+    for k, (a, b), series_means in zip(range(i, j), spans, means):
+        if cache.element(k) != element:
+            continue
+        if mode == 'anom':
+            anomalies = [None] * (12 * (b - a))
+            for m in range(12):
+                anomalies[m::12] = columns[m][a:b]
+        elif mode == 'annanom':
+            anomalies = annual[a:b]
+        else:
+            average = mean12(series_means)
+            anomalies = [d if d == BAD else d + average
+              for d in annual[a:b]]
+        yield k, anomalies
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+"""
+cmpv3.py [--tolerance T] [--jobs N] [--diffs | --json] a.dat b.dat
+
+Compare two files in GHCN-M v3 format (for example, two releases of
+the same dataset), reporting:
+
+  the stations only in a.dat, and only in b.dat;
+  the months with a value only in a.dat, and only in b.dat
+  (including the months of the stations only in one of them);
+  the values that differ by more than T (in the units of the file,
+  so hundredths of a degree for temperatures; 0 by default).
+
+Both files must be sorted by station, as GHCN-M files are; they are
+read once, side by side, and compared a station at a time.  Rows
+that are identical are skipped without being parsed.  Flags are not
+compared.
+
+By default a summary is printed, with up to 10 station identifiers
+for each kind of difference (as cmpv2.py does for GHCN v2).  With
+--diffs every difference is printed, one to a line:
+
+  removed-station ID
+  added-station ID
+  removed ID ELEMENT YEAR MONTH VALUE
+  added ID ELEMENT YEAR MONTH VALUE
+  changed ID ELEMENT YEAR MONTH OLD NEW
+
+("removed" being in a.dat only, and "added" in b.dat only; a
+station in only one file is followed by each of its months).  With
+--json the summary is printed as a JSON object, with the complete
+lists of station identifiers.
+
+--jobs compares the files in parallel, in shards that are cut at
+the same stations in both files (see shard.plan_aligned).
+"""
+
+import itertools
+import json
+import sys
+
+# ghcntool directory
+import ghcnm_cache
+import shard
+
+class Error(Exception):
+    pass
+
+def stations(rows, name='input'):
+    """
+    Group `rows` (bytes) by station, and yield an (id, rows) pair
+    for each station.  An Error is raised if the stations are not
+    in increasing order.
+    """
+
+    prev = None
+    for id, group in itertools.groupby(rows, shard.station_id):
+        if prev is not None and id <= prev:
+            raise Error("%s is not sorted by station at %r" % (name, id))
+        prev = id
+        yield id, list(group)
+
+def merge(a, b):
+    """
+    Merge `a` and `b`, sequences of (id, rows) pairs (as yielded by
+    `stations`), and yield an (id, rows_a, rows_b) triple for each
+    station in either; the rows of a station that is missing from
+    one sequence are None.
+    """
+
+    a = iter(a)
+    b = iter(b)
+    x = next(a, None)
+    y = next(b, None)
+    while x is not None or y is not None:
+        if y is None or (x is not None and x[0] < y[0]):
+            yield x[0], x[1], None
+            x = next(a, None)
+        elif x is None or y[0] < x[0]:
+            yield y[0], None, y[1]
+            y = next(b, None)
+        else:
+            yield x[0], x[1], y[1]
+            x = next(a, None)
+            y = next(b, None)
+
+def compare_station(id, rows_a, rows_b, tolerance=0):
+    """
+    Compare the rows of a single station, and yield a
+    (kind, id, element, year, month, old, new) tuple for each
+    difference (see the module docstring for `kind`).  `month` is
+    1 to 12; `old` or `new` is None for a value that is missing.
+    """
+
+    a = dict((row[11:19], row) for row in rows_a)
+    b = dict((row[11:19], row) for row in rows_b)
+    # Keys are year and element; ordered by element, then year.
+    for key in sorted(set(a) | set(b), key=lambda k: (k[4:], k[:4])):
+        row_a = a.get(key)
+        row_b = b.get(key)
+        if row_a == row_b:
+            continue
+        values_a = values(row_a)
+        values_b = values(row_b)
+        if values_a == values_b:
+            # Only the flags differ.
+            continue
+        year = int(key[:4])
+        element = key[4:].decode('iso8859-1')
+        for m, (old, new) in enumerate(zip(values_a, values_b)):
+            if old == new:
+                continue
+            if new == ghcnm_cache.MISSING:
+                yield ('removed', id, element, year, m + 1, old, None)
+            elif old == ghcnm_cache.MISSING:
+                yield ('added', id, element, year, m + 1, None, new)
+            elif abs(new - old) > tolerance:
+                yield ('changed', id, element, year, m + 1, old, new)
+
+def values(row):
+    """The 12 values of `row`, or all MISSING if `row` is None."""
+
+    if row is None:
+        return [ghcnm_cache.MISSING] * 12
+    return ghcnm_cache.parse_row(row)[3]
+
+def compare(rows_a, rows_b, tolerance=0, names=('a', 'b')):
+    """
+    Compare two sequences of rows, each sorted by station.  A
+    (counts, diffs) pair is returned: `counts` is a pair of the
+    number of stations in each; `diffs` is a list of
+    (kind, id, element, year, month, old, new) tuples, as per
+    `compare_station` (for a station only in one sequence, the kind
+    is 'removed-station' or 'added-station' and the other fields
+    are None; it is followed by a 'removed' or 'added' difference
+    for each of its months).
+    """
+
+    counts = [0, 0]
+    diffs = []
+    for id, a, b in merge(stations(rows_a, names[0]),
+      stations(rows_b, names[1])):
+        id = id.decode('iso8859-1')
+        if a is None:
+            counts[1] += 1
+            diffs.append(('added-station', id) + (None,) * 5)
+            diffs.extend(compare_station(id, [], b, tolerance))
+        elif b is None:
+            counts[0] += 1
+            diffs.append(('removed-station', id) + (None,) * 5)
+            diffs.extend(compare_station(id, a, [], tolerance))
+        else:
+            counts[0] += 1
+            counts[1] += 1
+            if a != b:
+                diffs.extend(compare_station(id, a, b, tolerance))
+    return counts, diffs
+
+def compare_shard(name_a, range_a, name_b, range_b, tolerance):
+    """
+    Compare a shard of the file `name_a` with the corresponding
+    shard of `name_b`, as per `compare`.
+    """
+
+    return compare(shard.lines(name_a, *range_a, binary=True),
+      shard.lines(name_b, *range_b, binary=True), tolerance,
+      (name_a, name_b))
+
+def compare_files(name_a, name_b, tolerance=0, jobs=1):
+    """
+    Compare the GHCN-M v3 files `name_a` and `name_b`, using `jobs`
+    processes.  The result is as per `compare`.
+    """
+
+    tasks = [(name_a, range_a, name_b, range_b, tolerance)
+      for range_a, range_b in shard.plan_aligned([name_a, name_b], jobs)]
+    counts = [0, 0]
+    diffs = []
+    for shard_counts, shard_diffs in shard.starmap(compare_shard, tasks,
+      jobs):
+        counts[0] += shard_counts[0]
+        counts[1] += shard_counts[1]
+        diffs.extend(shard_diffs)
+    return counts, diffs
+
+def summary(names, counts, diffs, tolerance):
+    """
+    Summarise the result of `compare_files` as a dict (which is
+    what --json prints).
+    """
+
+    def ids(*kinds):
+        return sorted(set(d[1] for d in diffs if d[0] in kinds))
+
+    def count(kind):
+        return sum(1 for d in diffs if d[0] == kind)
+
+    # The months of these stations are counted, but the stations
+    # are not also "changed".
+    alone = set(ids('removed-station', 'added-station'))
+    return dict(
+      files=list(names),
+      stations=list(counts),
+      tolerance=tolerance,
+      removed_stations=ids('removed-station'),
+      added_stations=ids('added-station'),
+      changed_stations=[id for id in ids('removed', 'added', 'changed')
+        if id not in alone],
+      removed_months=count('removed'),
+      added_months=count('added'),
+      changed_values=count('changed'),
+    )
+
+def write_summary(out, s):
+    """Write the summary `s` (as returned by `summary`) as text."""
+
+    a, b = s['files']
+    out.write("Number of stations: %d :: %d\n" % tuple(s['stations']))
+    for title, key in [
+      ("Stations only in %s" % a, 'removed_stations'),
+      ("Stations only in %s" % b, 'added_stations'),
+      ("Stations with different data", 'changed_stations')]:
+        out.write("%s (%d)\n" % (title, len(s[key])))
+        note10(out, s[key])
+    out.write("Months only in %s: %d\n" % (a, s['removed_months']))
+    out.write("Months only in %s: %d\n" % (b, s['added_months']))
+    out.write("Values different by more than %s: %d\n" % (
+      s['tolerance'], s['changed_values']))
+
+def note10(out, s):
+    """If `s` has any elements, write out up to 10 of them on a
+    line."""
+
+    if not s:
+        return
+    suffix = ''
+    if len(s) > 10:
+        suffix = ' ...'
+    out.write(' '.join(s[:10]) + suffix + '\n')
+
+def write_diffs(out, diffs):
+    """Write every difference, one to a line."""
+
+    for d in diffs:
+        out.write(' '.join(str(x) for x in d if x is not None) + '\n')
+
+def main(argv=None):
+    import getopt
+
+    if argv is None:
+        argv = sys.argv
+
+    opt, arg = getopt.getopt(argv[1:], '',
+      ['tolerance=', 'jobs=', 'diffs', 'json'])
+    tolerance = 0
+    jobs = 1
+    output = 'summary'
+    for k,v in opt:
+        if k == '--tolerance':
+            tolerance = float(v)
+            if tolerance == int(tolerance):
+                tolerance = int(tolerance)
+        if k == '--jobs':
+            jobs = int(v)
+        if k == '--diffs':
+            output = 'diffs'
+        if k == '--json':
+            output = 'json'
+    if len(arg) != 2:
+        sys.stderr.write(__doc__)
+        return 2
+
+    counts, diffs = compare_files(arg[0], arg[1], tolerance, jobs)
+    if output == 'diffs':
+        write_diffs(sys.stdout, diffs)
+        return
+    s = summary(arg, counts, diffs, tolerance)
+    if output == 'json':
+        json.dump(s, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        write_summary(sys.stdout, s)
+
+if __name__ == '__main__':
+    sys.exit(main())
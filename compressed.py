@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+"""
+Read compressed GHCN-M files (and other inputs) without
+extracting them first.
+
+Files ending in .gz, .bz2 or .xz are decompressed as they are
+read.  A tar file (.tar, .tar.gz, .tgz, .tar.bz2, .tar.xz), such
+as a GHCN-M release, is read as its first member whose name ends
+in '.dat'.
+
+`open_input` opens a file for reading from start to end, which is
+all that the streaming tools need.  `open_reader` opens a file for
+random access, as ghcnm_index.File needs: its `read` method reads
+a range of bytes given by its offsets in the uncompressed data.
+
+A gzip file is read at random by keeping checkpoints: copies of
+the state of the decompressor (made with zlib's
+decompressobj.copy) at intervals through the file, together with
+the positions in the compressed and uncompressed data that they
+correspond to.  A read starts from the nearest checkpoint before
+it, so at most SPAN bytes are decompressed before the data wanted.
+Checkpoints are made as the file is read, so the first read of the
+end of the file decompresses everything before it.  The state of
+the decompressor cannot be saved from Python, so the checkpoints
+are kept in memory and not in the index file.  The bz2 and lzma
+decompressors cannot be copied at all, so reading such a file at
+random restarts from the beginning whenever it has to go back.
+"""
+
+import bisect
+import io
+import os
+import zlib
+
+# The suffixes of compressed files, and the compression that they
+# imply.
+SUFFIXES = {'.gz': 'gz', '.tgz': 'gz', '.bz2': 'bz2', '.xz': 'xz'}
+
+# Number of uncompressed bytes between checkpoints.
+SPAN = 1 << 20
+
+# Number of bytes of compressed data read at a time.
+CHUNK = 1 << 16
+
+class Error(Exception):
+    pass
+
+def compression(name):
+    """The compression of the file `name` ('gz', 'bz2', 'xz'), as
+    guessed from its suffix, or None."""
+
+    return SUFFIXES.get(os.path.splitext(name)[1])
+
+def is_tar(name):
+    """True if the file `name` is a tar file (perhaps compressed)."""
+
+    if name.endswith('.tgz'):
+        return True
+    if compression(name):
+        name = os.path.splitext(name)[0]
+    return name.endswith('.tar')
+
+def is_compressed(name):
+    """
+    True if the file `name` is compressed or is a tar file, so
+    that its contents cannot be addressed by offsets in the file.
+    """
+
+    return bool(compression(name) or is_tar(name))
+
+def data_name(name):
+    """
+    The name that the data in the file `name` would have if it
+    were extracted: the name of the member for a tar file, or
+    `name` without its compression suffix.
+    """
+
+    if is_tar(name):
+        return tar_member(name)[1].name
+    if compression(name):
+        return os.path.splitext(name)[0]
+    return name
+
+def open_compressed(name):
+    """Open the file `name` for reading in binary mode,
+    decompressing it if its suffix says so."""
+
+    kind = compression(name)
+    if kind == 'gz':
+        import gzip
+        return gzip.open(name, 'rb')
+    if kind == 'bz2':
+        import bz2
+        return bz2.open(name, 'rb')
+    if kind == 'xz':
+        import lzma
+        return lzma.open(name, 'rb')
+    return open(name, 'rb')
+
+def tar_member(name):
+    """
+    Find the first member of the tar file `name` whose name ends
+    in '.dat'.  A (tarfile, member) pair is returned.
+    """
+
+    import tarfile
+
+    tar = tarfile.open(fileobj=open_compressed(name))
+    for member in tar:
+        if member.isfile() and member.name.endswith('.dat'):
+            return tar, member
+    raise Error("No .dat file in %s" % name)
+
+def open_input(name, mode='rb'):
+    """
+    Open the file `name` for reading, decompressing it (or
+    extracting the data from a tar file) if necessary.  `mode` is
+    'rb' for bytes, 'r' for strings.
+    """
+
+    if is_tar(name):
+        tar, member = tar_member(name)
+        f = tar.extractfile(member)
+    else:
+        f = open_compressed(name)
+    if 'b' in mode:
+        return f
+    return io.TextIOWrapper(f, encoding='iso8859-1')
+
+def open_reader(name):
+    """
+    Open the file `name` for random access.  The object returned
+    has a `read(offset, length)` method, where `offset` is the
+    offset in the uncompressed data (of the member, for a tar
+    file), and a `close` method.
+    """
+
+    if not is_tar(name):
+        return reader_class(name)(name)
+    tar, member = tar_member(name)
+    tar.fileobj.close()
+    return Member(reader_class(name)(name, member.offset_data),
+      member.size)
+
+def reader_class(name):
+    """The class used by `open_reader` for the file `name`."""
+
+    kind = compression(name)
+    if kind == 'gz':
+        return GzipReader
+    if kind:
+        return StreamReader
+    return FileReader
+
+class Member:
+    """A member of a tar file, read with `reader`."""
+
+    def __init__(self, reader, size):
+        self.reader = reader
+        self.size = size
+
+    def read(self, offset, length):
+        length = min(length, self.size - offset)
+        if length <= 0:
+            return b''
+        return self.reader.read(offset, length)
+
+    def close(self):
+        self.reader.close()
+
+class FileReader:
+    """An uncompressed file, read with pread."""
+
+    def __init__(self, name, base=0):
+        self.file = open(name, 'rb')
+        self.base = base
+
+    def read(self, offset, length):
+        return os.pread(self.file.fileno(), length, self.base + offset)
+
+    def close(self):
+        self.file.close()
+
+class StreamReader:
+    """
+    A bz2 or xz file, read by seeking in the decompressed stream
+    (which restarts from the beginning of the file when it goes
+    back).
+    """
+
+    def __init__(self, name, base=0):
+        self.file = open_compressed(name)
+        self.base = base
+
+    def read(self, offset, length):
+        self.file.seek(self.base + offset)
+        return self.file.read(length)
+
+    def close(self):
+        self.file.close()
+
+class GzipReader:
+    """
+    A gzip file (which can have several members), read from
+    checkpoints.
+    """
+
+    def __init__(self, name, base=0):
+        self.file = open(name, 'rb')
+        self.base = base
+        # (uncompressed offset, compressed offset, decompressor)
+        # for each checkpoint, in order.
+        self.points = [(0, 0, decompressor())]
+        self.offsets = [0]
+
+    def read(self, offset, length):
+        offset += self.base
+        stop = offset + length
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        at, where, d = self.points[i]
+        d = d.copy()
+        result = []
+        while at < stop:
+            data = os.pread(self.file.fileno(), CHUNK, where)
+            if not data.strip(b'\0'):
+                # The end of the file (which, as the gzip module
+                # allows, may be padded with zeros).
+                break
+            where += len(data)
+            out = d.decompress(data)
+            if d.eof:
+                # The end of a gzip member; another may follow.
+                where -= len(d.unused_data)
+                d = decompressor()
+            if at + len(out) > offset:
+                result.append(out[max(offset - at, 0):stop - at])
+            at += len(out)
+            if at >= self.offsets[-1] + SPAN:
+                self.points.append((at, where, d.copy()))
+                self.offsets.append(at)
+        return b''.join(result)
+
+    def close(self):
+        self.file.close()
+
+def decompressor():
+    """A zlib decompressor for a single gzip member."""
+
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 """
+gaps.py [--histogram] [--jobs N] ghcnm.dat
+
 For each station--element in the input file, output the gaps. A
 gap is a period where there is no data, immediately surrounded
 before and after by a period with data.
@@ -9,7 +11,7 @@ The output is a series of lines, one for each gap:
 
   ID ELEM GAP
 
-The following UNIX pipeline will produce a table:
+With the --histogram option, the output is instead a table:
 
   cumulative count gap
 
@@ -17,73 +19,112 @@ where `gap` gives the length of the gap in months;
 `count` gives the number of gaps of that length;
 `cumulative` give the cumulative number of gaps of at least that length
 
+This is the same table as the following UNIX pipeline produces
+from the normal output:
+
   awk '{print$3}' gaps-ghcnm | sort -r -n | uniq -c |
   awk '{s+=$1;print s, $1, $2}'
+
+The input is read in a single pass; for each station--element
+only the most recent month with data is remembered.  With --jobs
+the input is split into N shards which are processed in parallel.
 """
 
+import collections
 import itertools
 import sys
 
-class Station:
-    def __init__(self, **k):
-        self.data = []
-        self.__dict__.update(k)
-
-    def add_row(self, row):
-        year = int(row[11:15])
-        while self.first_year + len(self.data) // 12 < year:
-            self.data.extend([None] * 12)
-        for m in range(12):
-            v = int(row[19+m*8:24+m*8])
-            if v == -9999:
-                self.data.append(None)
-            else:
-                self.data.append(int(v))
-
-def gaps(inp):
-    for station in records(inp):
-        data = station.data
-
-        # Strip None from beginning and end.
-        while data[0] is None:
-            data = data[1:]
-        while data[-1] is None:
-            data = data[:-1]
-
-        for gap, block in itertools.groupby(data, lambda x: x is None):
-            if gap:
-                print(station.id, station.element, len(list(block)))
-
-def records(inp):
+# ghcntool directory
+import compressed
+import shard
+
+def gaps(found, out=sys.stdout):
+    """
+    Write a line to `out` for each gap in `found`, a sequence of
+    (id, element, gap) triples as yielded by `gap_lengths`.
+    """
+
+    for id, element, gap in found:
+        out.write("%s %s %d\n" % (id, element, gap))
+
+def histogram(found, out=sys.stdout):
     """
-    Given `inp` in GHCN-M v3 format (or ISTI's variant), yield a
-    sequence of Station instances; where a station has several
-    elements recorded in the file (ISTI style), an instance for
-    each element will be yielded.
+    Write to `out` the table of cumulative count, count, and gap
+    length for the gaps in `found` (as per `gaps`); longest gaps
+    first.
+    """
+
+    count = collections.Counter(gap for _, _, gap in found)
+    cumulative = 0
+    for gap, n in sorted(count.items(), reverse=True):
+        cumulative += n
+        out.write("%d %d %d\n" % (cumulative, n, gap))
+
+def gap_lengths(inp):
+    """
+    Given `inp` in GHCN-M v3 format (or ISTI's variant), yield an
+    (id, element, gap) triple for each gap, `gap` being its length
+    in months.  Where a station has several elements recorded in
+    the file (ISTI style), the gaps of each element are yielded
+    together, elements in sorted order.
     """
 
     def get_id(l):
         return l[:11]
 
-    def get_elem(l):
-        return l[15:19]
+    for id, rows in itertools.groupby(inp, get_id):
+        # For each element, the most recent month with data
+        # (counting January of year 0 as 0) and the gaps found.
+        last = {}
+        found = {}
+        for row in rows:
+            element = row[15:19]
+            if element not in found:
+                found[element] = []
+                last[element] = None
+            prev = last[element]
+            month = int(row[11:15]) * 12
+            for m in range(12):
+                if row[19+m*8:24+m*8] != '-9999':
+                    if prev is not None and month - prev > 1:
+                        found[element].append(month - prev - 1)
+                    prev = month
+                month += 1
+            last[element] = prev
+        for element in sorted(found):
+            for gap in found[element]:
+                yield id, element, gap
+
+def shard_gap_lengths(name, start, stop):
+    """
+    A list of the gaps (as per `gap_lengths`) in a shard of the
+    file `name`.
+    """
 
-    for id, station_block in itertools.groupby(inp, get_id):
-        sorted_by_element = sorted(station_block, key=get_elem)
-        for elem, rows in itertools.groupby(sorted_by_element, get_elem):
-            rows = list(rows)
-            station = Station(id=id, element=elem, first_year=int(rows[0][11:15]))
-            for row in rows:
-                station.add_row(row)
-            yield station
+    return list(gap_lengths(shard.lines(name, start, stop)))
 
 def main(argv=None):
+    import getopt
+
     if argv is None:
         argv = sys.argv
 
-    arg = argv[1:]
-    with open(arg[0]) as inp:
-        gaps(inp)
+    opt, arg = getopt.getopt(argv[1:], '', ['histogram', 'jobs='])
+    output = gaps
+    jobs = 1
+    for k,v in opt:
+        if k == '--histogram':
+            output = histogram
+        if k == '--jobs':
+            jobs = int(v)
+
+    if jobs > 1:
+        output(itertools.chain.from_iterable(
+          shard.run(arg[0], jobs, shard_gap_lengths)))
+        return
+
+    with compressed.open_input(arg[0], 'r') as inp:
+        output(gap_lengths(inp))
 
 if __name__ == '__main__':
     main()
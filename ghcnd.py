@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+
+"""
+ghcnd.py [--jobs N] [--stations ghcnd-stations.txt]
+  [--max-missing D] [--max-consecutive C] [--keep-flagged]
+  [--tavg either|daily|derived] -o out.dat input.dly ...
+
+Convert GHCN-Daily (.dly) files to a GHCN-M v3 file of monthly
+means of TMAX, TMIN and TAVG, which the other tools here
+(ghcnm_index.py, gaps.py, stationplot.py, and so on) can read.
+
+The inputs are .dly files (one for each station, as in the
+ghcnd_all directory, or several stations concatenated; they can be
+compressed), or directories, which stand for all the .dly files in
+them.  Each .dly row holds one month of one element for a station:
+the identifier, year, month, element, and then 31 daily values
+(tenths of a degree C for the temperatures; -9999 if missing),
+each followed by its MFLAG, QFLAG and SFLAG.  Rows of other
+elements (PRCP, SNOW, ...) are skipped without being parsed.
+
+A monthly mean is made from the valid days of the month.  A day is
+missing if its value is -9999 or, unless --keep-flagged is given,
+it has a QFLAG (it failed a quality assurance check).  The month is
+invalid if more than D days are missing (9 by default, as GHCN-M
+v3 allows), or, if --max-consecutive is given, if more than C
+consecutive days are missing.  In the output, the DMFLAG of each
+value is 'a' to 'i' for 1 to 9 missing days, as in GHCN-M v3 (and
+blank otherwise).
+
+TAVG is made, according to --tavg, from the daily TAVG values
+('daily'), or as the mean of the monthly TMAX and TMIN ('derived',
+which is how GHCN-M v3 makes it), or from the daily TAVG where the
+month has a valid daily mean and derived otherwise ('either', the
+default).
+
+The output is written to out.dat.  With --stations, the GHCN-Daily
+station list, out.inv is written as well: a GHCN-M v3 .inv row for
+each station in out.dat (identifier, latitude, longitude, elevation
+and name; the other fields are blank).
+
+--jobs converts the inputs in a pool of N processes; each input is
+split into shards at station boundaries (see shard.py).  The output
+is in the same order as the input.
+"""
+
+import calendar
+import itertools
+import os
+import struct
+import sys
+
+# ghcntool directory
+import ghcnm_cache
+import ghcnm_write
+import shard
+
+MISSING = ghcnm_cache.MISSING
+
+# The elements that are converted, in the order that they are
+# written for each station.
+ELEMENTS = ('TAVG', 'TMAX', 'TMIN')
+
+# A .dly row: identifier, year, month, element, and 31 days of
+# value and flags (MFLAG, QFLAG, SFLAG).
+DAILY = struct.Struct('11s4s2s4s' + '5s3s' * 31)
+
+# DMFLAG for 1 to 9 missing days.
+DMFLAGS = ' abcdefghi'
+
+class Rules:
+    """
+    The rules for making monthly means (see the module docstring).
+    """
+
+    def __init__(self, max_missing=9, max_consecutive=None,
+      keep_flagged=False, tavg='either'):
+        if tavg not in ('either', 'daily', 'derived'):
+            raise ValueError("Unknown TAVG rule %r" % tavg)
+        self.max_missing = max_missing
+        self.max_consecutive = max_consecutive
+        self.keep_flagged = keep_flagged
+        self.tavg = tavg
+
+def month_mean(row, rules):
+    """
+    Parse the .dly `row` (bytes) and return a (mean, missing) pair:
+    the mean of its valid days in tenths of a degree, and the
+    number of days missing; or None if the month is invalid
+    according to `rules`.
+    """
+
+    fields = DAILY.unpack_from(row)
+    year, month = int(fields[1]), int(fields[2])
+    days = calendar.monthrange(year, month)[1]
+    values = fields[4:4+2*days:2]
+    flags = fields[5:5+2*days:2]
+    valid = []
+    present = []
+    for value, flag in zip(values, flags):
+        v = int(value)
+        ok = v != MISSING and (rules.keep_flagged or flag[1:2] == b' ')
+        if ok:
+            valid.append(v)
+        present.append(ok)
+    missing = days - len(valid)
+    if not valid or missing > rules.max_missing:
+        return None
+    if rules.max_consecutive is not None:
+        run = longest = 0
+        for ok in present:
+            run = 0 if ok else run + 1
+            longest = max(longest, run)
+        if longest > rules.max_consecutive:
+            return None
+    return sum(valid) / len(valid), missing
+
+def station_means(rows, rules):
+    """
+    The monthly means of a single station's `rows` (bytes), as a
+    dict that maps from element to a dict that maps from
+    (year, month) to (mean, missing) pairs (mean in hundredths of a
+    degree).  TAVG is made as `rules` says.
+    """
+
+    means = dict((element, {}) for element in ELEMENTS)
+    for row in rows:
+        element = row[17:21].decode('ascii')
+        if element not in means:
+            continue
+        result = month_mean(row, rules)
+        if result is not None:
+            key = (int(row[11:15]), int(row[15:17]))
+            means[element][key] = (result[0] * 10, result[1])
+
+    daily = means['TAVG']
+    if rules.tavg == 'daily':
+        return means
+    tavg = {} if rules.tavg == 'derived' else daily
+    for key, (tmax, missing_max) in means['TMAX'].items():
+        if key in tavg or key not in means['TMIN']:
+            continue
+        tmin, missing_min = means['TMIN'][key]
+        tavg[key] = ((tmax + tmin) / 2, max(missing_max, missing_min))
+    means['TAVG'] = tavg
+    return means
+
+def series(means):
+    """
+    Convert `means`, a dict as made by `station_means` for one
+    element, to a (first_year, values, flags) triple, as
+    ghcnm_write.rows takes; or None if it is empty.
+    """
+
+    if not means:
+        return None
+    first = min(year for year, _ in means)
+    last = max(year for year, _ in means)
+    values = [MISSING] * (12 * (last - first + 1))
+    flags = bytearray(b' ' * (3 * len(values)))
+    for (year, month), (mean, missing) in means.items():
+        i = 12 * (year - first) + month - 1
+        values[i] = int(round(mean))
+        if missing < len(DMFLAGS):
+            flags[3*i] = ord(DMFLAGS[missing])
+    return first, values, bytes(flags)
+
+def convert_stations(rows, rules):
+    """
+    Convert the .dly `rows` (bytes) a station at a time, and yield
+    an (id, data) pair for each station that has any GHCN-M v3
+    rows: its identifier, and the rows (bytes).
+    """
+
+    for id, station_rows in itertools.groupby(rows, shard.station_id):
+        means = station_means(station_rows, rules)
+        out = []
+        for element in ELEMENTS:
+            s = series(means[element])
+            if s is not None:
+                out.append(ghcnm_write.rows(id, element, *s))
+        if out:
+            yield id.decode('ascii'), b''.join(out)
+
+def convert(rows, rules):
+    """
+    Convert the .dly `rows` (bytes), as per `convert_stations`,
+    and return a (data, ids) pair: the GHCN-M v3 rows (bytes), and
+    the list of identifiers of the stations that have any.
+    """
+
+    out = []
+    ids = []
+    for id, data in convert_stations(rows, rules):
+        out.append(data)
+        ids.append(id)
+    return b''.join(out), ids
+
+def convert_shard(name, start, stop, rules):
+    """`convert` a shard of the file `name`."""
+
+    return convert(shard.lines(name, start, stop, binary=True), rules)
+
+def inputs(args):
+    """
+    The names of the .dly files in `args`, where a directory
+    stands for the .dly files in it (in sorted order).
+    """
+
+    names = []
+    for arg in args:
+        if os.path.isdir(arg):
+            names.extend(os.path.join(arg, name)
+              for name in sorted(os.listdir(arg)) if '.dly' in name)
+        else:
+            names.append(arg)
+    return names
+
+def convert_files(names, out, rules, jobs=1):
+    """
+    Convert the .dly files `names` and write the GHCN-M v3 rows to
+    `out` (opened in binary mode), as the results come in.  The
+    list of identifiers of the stations written is returned.
+
+    In a single process the rows are written a station at a time;
+    with a pool, a shard at a time (in file order).
+    """
+
+    tasks = [(name, start, stop, rules)
+      for name in names for start, stop in shard.plan(name, jobs)]
+    ids = []
+    with ghcnm_write.Writer(out) as writer:
+        if jobs <= 1 or len(tasks) <= 1:
+            for name, start, stop, rules in tasks:
+                for id, data in convert_stations(
+                  shard.lines(name, start, stop, binary=True), rules):
+                    writer.write(data)
+                    ids.append(id)
+            return ids
+        for data, shard_ids in shard.istarmap(convert_shard, tasks, jobs):
+            writer.write(data)
+            ids.extend(shard_ids)
+    return ids
+
+def read_stations(inp):
+    """
+    Read the GHCN-Daily station list `inp` (ghcnd-stations.txt,
+    opened in binary mode) and return a dict that maps from
+    identifier to (lat, lon, elev, name).
+    """
+
+    stations = {}
+    for row in inp:
+        if not row.strip():
+            continue
+        stations[row[:11].decode('ascii')] = (float(row[12:20]),
+          float(row[21:30]), float(row[31:37]),
+          row[41:71].decode('iso8859-1').strip())
+    return stations
+
+def write_inv(ids, stations, out):
+    """
+    Write a GHCN-M v3 .inv row to `out` (opened in binary mode) for
+    each station in `ids` that is in `stations` (as returned by
+    `read_stations`).
+    """
+
+    for id in ids:
+        if id not in stations:
+            continue
+        lat, lon, elev, name = stations[id]
+        row = '%s %8.4f %9.4f %6.1f %-30.30s' % (id, lat, lon, elev, name)
+        out.write(row.ljust(107).encode('iso8859-1') + b'\n')
+
+def main(argv=None):
+    import getopt
+
+    if argv is None:
+        argv = sys.argv
+
+    opt, arg = getopt.getopt(argv[1:], 'o:', ['jobs=', 'stations=',
+      'max-missing=', 'max-consecutive=', 'keep-flagged', 'tavg='])
+    jobs = 1
+    out_name = None
+    stations_name = None
+    key = {}
+    for k,v in opt:
+        if k == '--jobs':
+            jobs = int(v)
+        if k == '-o':
+            out_name = v
+        if k == '--stations':
+            stations_name = v
+        if k == '--max-missing':
+            key['max_missing'] = int(v)
+        if k == '--max-consecutive':
+            key['max_consecutive'] = int(v)
+        if k == '--keep-flagged':
+            key['keep_flagged'] = True
+        if k == '--tavg':
+            key['tavg'] = v
+
+    if out_name is None or not out_name.endswith('.dat'):
+        sys.stderr.write(__doc__)
+        return 2
+
+    rules = Rules(**key)
+    with open(out_name, 'wb') as out:
+        ids = convert_files(inputs(arg), out, rules, jobs)
+    if stations_name is not None:
+        with open(stations_name, 'rb') as inp:
+            stations = read_stations(inp)
+        with open(out_name[:-4] + '.inv', 'wb') as out:
+            write_inv(ids, stations, out)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+
+"""
+ghcnm_cache.py [ghcnm.dat ...]
+
+Convert a file in GHCN-M v3 format (typically
+input/ghcnm.tavg.qca.dat) into a binary cache that can be
+memory-mapped.  Subsequent analyses can then load the whole
+dataset in milliseconds instead of re-parsing the text.
+
+The cache is stored alongside the input, with '.cache' appended
+to the name.  It records the modification time and size of the
+input, and is rebuilt automatically when either changes.  The
+input can be compressed (see the `compressed` module).
+
+The cache holds one series for each station--element in the
+input (ISTI files have several elements per station).  For each
+series there is an 11 character station identifier, a 4
+character element, the first year, and the position of its data
+in a single matrix of int16 values (12 values for each year from
+the first year to the last year, -9999 marking invalid data and
+the months of years that are absent from the input).  The 3
+flag characters (DMFLAG, QCFLAG, DSFLAG) that follow each value
+in the input are kept in a parallel matrix.
+
+Values can be masked by their flags (see `parse_mask` and `mask`),
+so that, for example, the values that failed quality control can
+be treated as invalid.
+
+ghcnm_timemajor.py makes a time-major copy of the cache (a row for
+each month, a column for each station), for questions about all
+the stations at once.
+"""
+
+import array
+import itertools
+import mmap
+import os
+import struct
+import sys
+import weakref
+
+# ghcntool directory
+import compressed
+
+# Marks invalid data, same as the GHCN-M v3 file.
+MISSING = -9999
+
+# The magic number includes the byte order, since the int16
+# and int64 sections are written in native byte order.
+MAGIC = b'GHCNMC1' + {'little': b'<', 'big': b'>'}[sys.byteorder]
+
+# magic, input mtime (ns), input size, number of series, number
+# of values.
+HEADER = struct.Struct('<8sqqqq')
+
+# Fixed-width fields of a GHCN-M v3 data row: id, year, element,
+# then 12 values each followed by 3 flags.
+ROW = struct.Struct('11s4s4s' + '5s3s' * 12)
+
+class Error(Exception):
+    pass
+
+# The position of each flag among the 3 flag characters that
+# follow a value.
+DMFLAG, QCFLAG, DSFLAG = 0, 1, 2
+
+# The letter for each flag in a mask specification.
+FLAG_LETTERS = {'D': DMFLAG, 'Q': QCFLAG, 'S': DSFLAG}
+
+def stamp(name):
+    """A (mtime, size) pair that changes when the file `name`
+    changes.  Used to invalidate caches and indexes derived from
+    it."""
+
+    st = os.stat(name)
+    return st.st_mtime_ns, st.st_size
+
+def parse_row(row):
+    """
+    Parse a single GHCN-M v3 row (as bytes).  A (id, year, element,
+    values, flags) tuple is returned; `values` is a list of 12 ints
+    (-9999 for invalid), `flags` is 36 bytes (3 for each month).
+    """
+
+    fields = ROW.unpack_from(row)
+    return (fields[0], int(fields[1]), fields[2],
+      [int(v) for v in fields[3::2]], b''.join(fields[4::2]))
+
+def parse_mask(spec):
+    """
+    Parse a mask specification: a comma separated list of items,
+    each a flag letter (D for DMFLAG, Q for QCFLAG, S for DSFLAG)
+    optionally followed by '=' and the flag characters to reject.
+    With no '=', every flag character but blank is rejected.  For
+    example, 'Q' rejects every value that failed a quality control
+    check, and 'Q=OS,D=E' rejects outliers, values that failed the
+    spatial consistency check, and estimated values.
+
+    The result is a list of (position, table) pairs, where `table`
+    is a 256 byte table (for bytes.translate) that maps each
+    rejected character to 1 and every other to 0.
+    """
+
+    masks = []
+    for item in spec.split(','):
+        letter, _, chars = item.partition('=')
+        if letter not in FLAG_LETTERS:
+            raise Error("Unknown flag %r in mask %r" % (letter, spec))
+        if chars:
+            reject = set(chars.encode('iso8859-1'))
+        else:
+            reject = set(range(256)) - set(b' ')
+        table = bytes(int(c in reject) for c in range(256))
+        masks.append((FLAG_LETTERS[letter], table))
+    return masks
+
+def mask(values, flags, masks):
+    """
+    Return a copy of `values` (int16, as an array or memoryview) as
+    an array, with MISSING in place of each value whose flags are
+    rejected by `masks` (as returned by `parse_mask`).  `flags`
+    holds 3 bytes for each value.
+
+    Each flag is taken out of `flags` with a single slice, and
+    translated with its table, so only the rejected values are
+    visited in Python.
+    """
+
+    result = array.array('h')
+    result.frombytes(memoryview(values).cast('B'))
+    for position, table in masks:
+        marked = bytes(flags[position::3]).translate(table)
+        i = marked.find(1)
+        while i >= 0:
+            result[i] = MISSING
+            i = marked.find(1, i + 1)
+    return result
+
+def rejected(flags, masks):
+    """True if the 3 flag characters `flags` (bytes) of a single
+    value are rejected by `masks`."""
+
+    return any(table[flags[position]] for position, table in masks)
+
+def parse(inp):
+    """
+    Read the GHCN-M v3 file `inp` (opened in binary mode) and yield
+    a (id, element, first_year, values, flags) tuple for each
+    station--element.  `values` is an array of int16 with 12
+    entries per year, `flags` is a bytearray with 3 bytes per
+    value.  Within each station the elements are yielded in
+    sorted order.
+    """
+
+    for id, rows in itertools.groupby(inp, lambda row: row[:11]):
+        # Rows for each element, in file order.
+        by_element = {}
+        for row in rows:
+            by_element.setdefault(row[15:19], []).append(row)
+        for element, rows in sorted(by_element.items()):
+            yield (id, element) + series_of_rows(rows)
+
+def series_of_rows(rows):
+    """
+    Convert `rows`, the GHCN-M v3 rows for a single
+    station--element in increasing order of year, to a
+    (first_year, values, flags) triple, as yielded by `parse`.
+    """
+
+    first_year = int(rows[0][11:15])
+    values = array.array('h')
+    flags = bytearray()
+    for row in rows:
+        _, year, _, v, f = parse_row(row)
+        # Subsequent rows must be for later years.
+        gap = year - first_year - len(values) // 12
+        if gap < 0:
+            raise Error("Rows out of order at %r" % row[:19])
+        # If we skip a year, pad the data.
+        values.extend([MISSING] * (12 * gap))
+        flags.extend(b' ' * (36 * gap))
+        values.extend(v)
+        flags.extend(f)
+    return first_year, values, flags
+
+def build(inp, out, source_stamp):
+    """
+    Build a cache of the GHCN-M v3 file `inp` (opened in binary
+    mode) and write it to `out` (also binary).  `source_stamp` is
+    the (mtime, size) pair of the input, as returned by `stamp`.
+    """
+
+    write(parse(inp), out, source_stamp)
+
+def write(series, out, source_stamp):
+    """
+    Write a cache of `series`, a sequence of (id, element,
+    first_year, values, flags) tuples (as yielded by `parse`), to
+    `out`.  `values` can be any int16 buffer (so series can be
+    copied from another cache's memoryviews).  `source_stamp` is as
+    per `build`.
+    """
+
+    ids = bytearray()
+    elements = bytearray()
+    first_year = array.array('i')
+    start = array.array('q', [0])
+    values = array.array('h')
+    flags = bytearray()
+    for id, element, first, v, f in series:
+        ids.extend(id)
+        elements.extend(element)
+        first_year.append(first)
+        values.frombytes(memoryview(v).cast('B'))
+        flags.extend(f)
+        start.append(len(values))
+
+    out.write(HEADER.pack(MAGIC, source_stamp[0], source_stamp[1],
+      len(first_year), len(values)))
+    for section in [ids, elements, first_year, start, values, flags]:
+        data = bytes(section)
+        out.write(data)
+        out.write(b'\0' * padding(len(data)))
+
+def padding(n):
+    """Number of bytes needed to pad `n` to a multiple of 8."""
+    return -n % 8
+
+class Cache:
+    """
+    A GHCN-M v3 file accessed through its binary cache.
+
+    The attributes `first_year`, `start`, `values` and `flags`
+    expose the whole cache (as memoryviews on the mapped file) for
+    bulk processing; series `i` has its values in
+    values[start[i]:start[i+1]].  Those memoryviews, and the ones
+    returned by `series` and `series_flags`, are released by
+    `close`.
+    """
+
+    def __init__(self, name, build=True):
+        """
+        `name` is the filename of the GHCN-M v3 file.  The cache is
+        built if it does not exist or is out of date, unless `build`
+        is false, in which case Error is raised.
+        """
+
+        self.name = name
+        self.cache_name = name + '.cache'
+        self.map = None
+        if not self.open():
+            if not build:
+                raise Error("No up to date cache for %s" % name)
+            self.build()
+            if not self.open():
+                raise Error("Cache still out of date after building.")
+
+    def build(self):
+        """
+        (Re-) build the cache file.
+        """
+
+        sys.stderr.write("Building cache...\n")
+        self.close()
+        # Write to a temporary file and rename, so that other
+        # processes never see a partially written cache.
+        tmp = '%s.%d.tmp' % (self.cache_name, os.getpid())
+        with compressed.open_input(self.name) as inp, (
+          open(tmp, 'wb')) as out:
+            build(inp, out, stamp(self.name))
+        os.replace(tmp, self.cache_name)
+        sys.stderr.write("Done building cache...\n")
+
+    def open(self):
+        """
+        Map the cache file.  Returns False if it does not exist or
+        does not match the input file.
+        """
+
+        try:
+            f = open(self.cache_name, 'rb')
+        except IOError:
+            return False
+        with f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return False
+            magic, mtime, size, n, nvalues = HEADER.unpack(header)
+            if magic != MAGIC or (mtime, size) != stamp(self.name):
+                return False
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Every memoryview on the map, so that they can all be
+        # released before the map is closed.
+        self.views = [memoryview(self.map)]
+        at = HEADER.size
+        for size in [11*n, 4*n, 4*n, 8*(n+1), 2*nvalues, 3*nvalues]:
+            self.views.append(self.views[0][at:at+size])
+            at += size + padding(size)
+        (self.ids, self.elements, first_year, start,
+          values, self.flags) = self.views[1:]
+        self.first_year = first_year.cast('i')
+        self.start = start.cast('q')
+        self.values = values.cast('h')
+        self.views.extend([self.first_year, self.start, self.values])
+        # The views handed out by `series` and `series_flags`, which
+        # `close` releases too if they are still alive (keyed by a
+        # serial number, as int16 memoryviews can't be hashed).
+        self.slices = weakref.WeakValueDictionary()
+        self.serial = itertools.count()
+        self.lookup = dict(((self.id(i), self.element(i)), i)
+          for i in range(n))
+        return True
+
+    def close(self):
+        """
+        Release the mapped file.  Returns True if it was closed.
+
+        Every view of the cache (its own and the ones handed out by
+        `series` and `series_flags`) is released.  If a caller
+        still holds a buffer made from one of them (with a cast,
+        say), the map cannot be closed yet: it stays open in
+        `map` (the cache is still unusable, as its views are
+        released) and False is returned; calling `close` again once
+        that buffer has gone closes it.
+        """
+
+        if self.map is None:
+            return True
+        exported = False
+        for view in list(self.slices.values()) + self.views[::-1]:
+            try:
+                view.release()
+            except BufferError:
+                exported = True
+        if not exported:
+            try:
+                self.map.close()
+            except BufferError:
+                exported = True
+        if exported:
+            return False
+        self.map = None
+        return True
+
+    def __len__(self):
+        return len(self.first_year)
+
+    def id(self, i):
+        """The 11 character station identifier of series `i`."""
+        return self.ids[11*i:11*i+11].tobytes().decode('ascii')
+
+    def element(self, i):
+        """The element (for example 'TAVG') of series `i`."""
+        return self.elements[4*i:4*i+4].tobytes().decode('ascii')
+
+    def find(self, id, element='TAVG'):
+        """
+        Return the index of the series for station `id` and
+        `element`, or None if there is no such series.
+        """
+
+        return self.lookup.get((id, element))
+
+    def series(self, i, masks=None):
+        """
+        For series `i` return a (values, first_year) pair; `values`
+        is a memoryview of int16 with 12 entries per year.  If
+        `masks` (as returned by `parse_mask`) is given, `values` is
+        instead an array, with the values rejected by `masks` made
+        MISSING.
+        """
+
+        values = self.values[self.start[i]:self.start[i+1]]
+        self.slices[next(self.serial)] = values
+        if masks:
+            values = mask(values, self.series_flags(i), masks)
+        return values, self.first_year[i]
+
+    def series_flags(self, i):
+        """
+        For series `i` return its flags as a memoryview of bytes,
+        3 for each value (DMFLAG, QCFLAG, DSFLAG).
+        """
+
+        flags = self.flags[3*self.start[i]:3*self.start[i+1]]
+        self.slices[next(self.serial)] = flags
+        return flags
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    names = argv[1:] or ["input/ghcnm.tavg.qca.dat"]
+    for name in names:
+        Cache(name).close()
+
+if __name__ == '__main__':
+    main()
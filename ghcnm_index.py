@@ -8,49 +8,387 @@
 Create an index of a file in GHCN-M format (typically either
 input/ghcnm.tavg.qca.dat (GHCN-M v3) or input/v2.mean (GHCN-M
 v2)).  This allows other programs to have faster random access.
+
+Two formats of index are supported.  The text format (one line
+per record: id, first year, offset) is written by `build`.  The
+binary format, written by `build_binary` and used by `File`, is a
+header followed by fixed-width entries sorted by identifier and
+element; each entry gives the offset and length in bytes of a
+contiguous block of lines for one station--element, and the width
+of its lines if they are all the same length (a GHCN-M v3
+file normally has one block for each, but an ISTI style file can
+have the elements of a station interleaved).  It is memory-mapped
+and searched with a binary search, so opening it costs nothing,
+and a record, or one element of it, can be fetched with a pread
+for each block.  After the entries comes a table with the offset,
+length and CRC-32 of the block of lines of each station (the first
+11 characters of the identifier), in file order, so that two
+releases of a file can be compared without reading the old one
+(see update.py).
+
+Either index is built by scanning the file in large binary chunks,
+in parallel with --jobs, so that building is limited by I/O
+rather than by the interpreter.  The file can be compressed, or a
+tar file (see the `compressed` module); offsets in the index are
+then offsets in the uncompressed data.
+
+  ghcnm_index.py [--jobs N] [ghcnm.dat ...]
 """
 
-import itertools
+import mmap
+import os
+import struct
 import sys
+import zlib
+
+# ghcntool directory
+import compressed
+import ghcnm_cache
+
+# magic, input mtime (ns), input size, number of entries, number
+# of distinct ids, number of stations.
+BINARY_HEADER = struct.Struct('<8sqqqqq')
+BINARY_MAGIC = b'GHCNMI4\0'
+# id (padded with spaces to 12 characters), element (4 spaces for
+# GHCN-M v2), first year, offset, length, line width (0 if the
+# lines differ in length).
+BINARY_ENTRY = struct.Struct('<12s4s4sqqq')
+# station id (padded to 12 characters), offset, length, CRC-32.
+BINARY_STATION = struct.Struct('<12sqqq')
 
 class Error(Exception):
     pass
 
-def build(inp, out):
+def build(inp, out, jobs=1):
     """Build an index of the GHCN-M file `inp` and write it to the file
-    `out`."""
+    `out`.  The file is scanned by `jobs` processes (see `scan`)."""
+
+    n = id_length(inp.name)
+    for id, _, year, whence, _, _ in scan(inp.name, n, jobs):
+        out.write("%s %s %d\n" % (id.decode('iso8859-1'),
+          year.decode('iso8859-1'), whence))
+
+def id_length(name):
+    """The length of the record identifier, 12 for GHCN-M v2, 11
+    for GHCN-M v3, guessed from the filename `name`."""
+
+    name = compressed.data_name(name)
+    if name.endswith('.dat'):
+        return 11
+    if 'v2' in name:
+        return 12
+    raise Error("Can't tell if input is GHCN-M v2 or v3")
+
+def build_binary(inp, out, source_stamp, jobs=1):
+    """Build a binary index of the GHCN-M file `inp` (opened in
+    binary mode) and write it to `out` (also binary).
+    `source_stamp` is the (mtime, size) pair of the input, as
+    returned by `ghcnm_cache.stamp`.  The file is scanned by `jobs`
+    processes (see `scan`).
+    """
+
+    n = id_length(inp.name)
+    blocks = scan(inp.name, n, jobs, elements=(n == 11))
+    reader = compressed.open_reader(inp.name)
+    try:
+        sums = checksums(reader, stations(blocks))
+    finally:
+        reader.close()
+    write_binary(blocks, sums, out, source_stamp)
+
+def write_binary(blocks, sums, out, source_stamp):
+    """
+    Write a binary index of `blocks`, a list of
+    (id, element, year, whence, length, width) tuples as returned
+    by `scan`, and `sums`, the checksums of its stations as
+    returned by `checksums`, to `out`.  `source_stamp` is as per
+    `build_binary`.
+    """
+
+    # Sorted by id, element, then position in the file.
+    entries = sorted((id.ljust(12), element.ljust(4), whence, year,
+      length, width) for id, element, year, whence, length, width in blocks)
+    ids = len(set(entry[0] for entry in entries))
+    out.write(BINARY_HEADER.pack(BINARY_MAGIC,
+      source_stamp[0], source_stamp[1], len(entries), ids, len(sums)))
+    for id, element, whence, year, length, width in entries:
+        out.write(BINARY_ENTRY.pack(id, element, year, whence, length,
+          width))
+    for id, whence, length, crc in sums:
+        out.write(BINARY_STATION.pack(id.ljust(12), whence, length, crc))
+
+def stations(blocks):
+    """
+    From `blocks`, as returned by `scan`, return a list of
+    (id, start, stop) triples, one for each station (the first 11
+    characters of the identifier), in file order.
+    """
+
+    result = []
+    for id, _, _, whence, length, _ in blocks:
+        id = id[:11]
+        if result and result[-1][0] == id:
+            start = result[-1][1]
+            result[-1] = (id, start, max(result[-1][2], whence + length))
+        else:
+            result.append((id, whence, whence + length))
+    return result
+
+def checksums(reader, stations):
+    """
+    A list of (id, whence, length, crc) tuples giving the CRC-32 of
+    the block of lines of each of `stations` (as returned by
+    `stations`) in the file read by `reader` (see
+    compressed.open_reader).
+    """
 
-    index = None
-    if 'v2' in inp.name:
-        index = v2_index
-    if inp.name.endswith('.dat'):
-        index = v3_index
+    return [(id, start, stop - start,
+      zlib.crc32(reader.read(start, stop - start)))
+      for id, start, stop in stations]
 
-    if index is None:
-        raise Error("Can't tell if input is GHCN-M v2 or v3")
+def build_file(name, jobs=1):
+    """
+    (Re-) build the binary index of the GHCN-M file `name`, which
+    is written to `name` with '.bindex' appended.
+    """
+
+    sys.stderr.write("Building index...\n")
+    index_name = name + '.bindex'
+    # Write to a temporary file and rename, so that other
+    # processes never see a partially written index.
+    tmp = '%s.%d.tmp' % (index_name, os.getpid())
+    with open(name, 'rb') as inp, open(tmp, 'wb') as out:
+        build_binary(inp, out, ghcnm_cache.stamp(name), jobs)
+    os.replace(tmp, index_name)
+    sys.stderr.write("Done building index...\n")
 
-    out.writelines(index(inp))
+# Largest chunk of the file that is scanned in one piece.
+CHUNK = 1 << 24
+
+def scan(name, n, jobs=1, elements=False):
+    """
+    For the GHCN-M file `name` return a list with an
+    (id, element, year, whence, length, width) tuple for each block
+    of lines that share the same record identifier (the first `n`
+    bytes of each line), in file order; `year` is the year of the
+    block's first line, `whence` and `length` are its position and
+    size in bytes, and `width` is the length of its lines if they
+    are all the same length (and end with a newline), otherwise 0.
+    `id`, `element` and `year` are bytes.
+
+    If `elements` is true (only for GHCN-M v3 and ISTI files) a
+    block is also split wherever the element (line[15:19])
+    changes; otherwise `element` is always b''.
+
+    The file is split into line-aligned chunks, which are scanned
+    by `scan_chunk` in a pool of `jobs` processes; a block that
+    straddles a chunk boundary is joined up afterwards.  A
+    compressed file (see the `compressed` module) is decompressed
+    and scanned a chunk at a time in this process instead.
+    """
 
-def v2_index(inp):
-    return index_grouping(inp, lambda line: line[:12])
+    if compressed.is_compressed(name):
+        return join_chunks(scan_stream(name, n, elements))
+
+    size = os.path.getsize(name)
+    count = max(jobs, -(-size // CHUNK))
+    with open(name, 'rb') as f:
+        bounds = [0]
+        for k in range(1, count):
+            at = line_start(f, size * k // count)
+            if bounds[-1] < at < size:
+                bounds.append(at)
+    bounds.append(size)
+    tasks = [(name, start, stop, n, elements)
+      for start, stop in zip(bounds, bounds[1:]) if start < stop]
+    if jobs <= 1 or len(tasks) <= 1:
+        chunks = [scan_chunk(*task) for task in tasks]
+    else:
+        import multiprocessing
+
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            chunks = pool.starmap(scan_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    return join_chunks(chunks)
 
-def v3_index(inp):
-    return index_grouping(inp, lambda line: line[:11])
+def join_chunks(chunks):
+    """
+    Join the lists of blocks in `chunks` (as returned by
+    `scan_chunk` for consecutive chunks of a file) into one list.
+    """
 
-def index_grouping(inp, id):
-    """Read the GHCN-M v2 file from `inp` and yield a series of index
-    lines.
+    result = []
+    for chunk in chunks:
+        if result and chunk and result[-1][:2] == chunk[0][:2]:
+            # The block continues from the previous chunk.
+            id, element, year, whence, length, width = result[-1]
+            if width != chunk[0][5]:
+                width = 0
+            result[-1] = (id, element, year, whence, length + chunk[0][4],
+              width)
+            chunk = chunk[1:]
+        result.extend(chunk)
+    return result
+
+def line_start(f, at):
+    """The offset of the first line that starts at or after `at` in
+    the file `f` (opened in binary mode)."""
+
+    if at == 0:
+        return 0
+    f.seek(at - 1)
+    f.readline()
+    return f.tell()
+
+def scan_chunk(name, start, stop, n, elements=False):
+    """
+    Scan the bytes from `start` to `stop` (both at the start of a
+    line) of the file `name`, and return a list of
+    (id, element, year, whence, length, width) tuples as per `scan`.
     """
 
-    def id_of_pair(t):
-        """The record identifier from a (location, line) pair."""
-        return id(t[1])
+    with open(name, 'rb') as f:
+        data = os.pread(f.fileno(), stop - start, start)
+    return scan_data(data, start, n, elements)
 
-    for ghcn_id, group in itertools.groupby(tell_stream(inp),
-      id_of_pair):
-        whence,first = list(group)[0]
-        year = first[len(ghcn_id):][:4]
-        yield "%s %s %d\n" % (ghcn_id, year, whence)
+def scan_stream(name, n, elements=False):
+    """
+    Decompress the file `name` and scan it a chunk at a time,
+    yielding a list of blocks for each chunk, as per `scan_chunk`.
+    """
+
+    at = 0
+    rest = b''
+    with compressed.open_input(name) as f:
+        while True:
+            data = f.read(CHUNK)
+            if not data:
+                break
+            data = rest + data
+            # Keep any incomplete last line for the next chunk.
+            end = data.rfind(b'\n') + 1
+            rest = data[end:]
+            if end:
+                yield scan_data(data[:end], at, n, elements)
+                at += end
+    if rest:
+        yield scan_data(rest, at, n, elements)
+
+def scan_data(data, start, n, elements=False):
+    """
+    Scan `data`, bytes consisting of whole lines, that starts at
+    offset `start` of a file, as per `scan_chunk`.
+    """
+
+    result = []
+    at = 0
+    while at < len(data):
+        id = data[at:at+n]
+        end = block_end(data, at, id)
+        if elements:
+            runs = element_runs(data, at, end)
+        else:
+            runs = [(b'', at, end)]
+        for element, i, j in runs:
+            result.append((id, element, data[i+n:i+n+4], start + i, j - i,
+              line_width(data, i, j)))
+        at = end
+    return result
+
+def line_width(data, at, end):
+    """
+    The length of each of the lines data[at:end], if they are all
+    the same length and each ends with a newline; otherwise 0.
+    """
+
+    width = data.find(b'\n', at, end) + 1 - at
+    if width <= 0:
+        return 0
+    lines = (end - at) // width
+    if lines * width != end - at or (
+      data[at+width-1:end:width] != b'\n' * lines):
+        return 0
+    return width
+
+def element_runs(data, at, end):
+    """
+    Split the block of lines data[at:end] (all for one station)
+    into runs of lines with the same element (line[15:19]).  A list
+    of (element, start, stop) triples is returned.
+    """
+
+    element = data[at+15:at+19]
+    width = line_width(data, at, end)
+    if not width:
+        # Lines of differing lengths; look at each one.
+        starts = []
+        i = at
+        while i < end:
+            starts.append(i)
+            i = data.find(b'\n', i) + 1 or end
+    else:
+        # The usual case: fixed width lines, and a single element
+        # throughout, which is checked one character at a time.
+        lines = (end - at) // width
+        if all(data[at+15+k:end:width] == element[k:k+1] * lines
+          for k in range(4)):
+            return [(element, at, end)]
+        starts = range(at, end, width)
+    runs = []
+    for i in starts:
+        element = data[i+15:i+19]
+        if runs and runs[-1][0] == element:
+            continue
+        if runs:
+            runs[-1][2] = i
+        runs.append([element, i, None])
+    runs[-1][2] = end
+    return [tuple(run) for run in runs]
+
+def block_end(data, at, id):
+    """
+    In `data` (bytes consisting of whole lines), find the end of
+    the block of lines that starts at offset `at` and whose lines
+    all start with `id`.
+
+    Rather than visit every line, look at lines at exponentially
+    increasing distances until one does not start with `id`, then
+    search back for the last line that does.  Lines are then
+    counted to check that the block really is contiguous; it
+    always is for a GHCN-M file, which is sorted by identifier, but
+    if not the block is found line by line.
+    """
+
+    size = len(data)
+    good = at
+    step = data.find(b'\n', at) + 1 - at
+    if step <= 0:
+        # The last line, without a newline.
+        return size
+    while True:
+        # First line starting at or after good+step.
+        probe = data.find(b'\n', good + step - 1) + 1
+        if not probe or probe >= size:
+            bad = size
+            break
+        if not data.startswith(id, probe):
+            bad = probe
+            break
+        good = probe
+        step *= 2
+    last = data.rfind(b'\n' + id, good, bad) + 1 or good
+    end = data.find(b'\n', last) + 1 or size
+
+    lines = data.count(b'\n', at, end)
+    if data.count(b'\n' + id, at, end - 1) == lines - 1:
+        return end
+    end = at
+    while end < size and data.startswith(id, end):
+        end = data.find(b'\n', end) + 1 or size
+    return end
 
 def tell_stream(f):
     """For a input file `f` yield a stream of (location, line) pairs
@@ -60,7 +398,7 @@ def tell_stream(f):
     while True:
         whence = f.tell()
         line = f.readline()
-        if line == '':
+        if not line:
             break
         yield whence, line
 
@@ -73,31 +411,29 @@ class File:
         .name attribute, or a filename.
         """
 
+        self.name = getattr(file, 'name', file)
+        # Reads the file, decompressing it if necessary.
+        self.reader = compressed.open_reader(self.name)
+        self.index_name = self.name + '.bindex'
+        self.index = None
         try:
-            self.name = file.name
-            self.file = file
-        except AttributeError:
-            self.name = file
-            self.file = open(self.name)
-        self.index_name = self.name + '.index'
-        try:
-            self.index = index(open(self.index_name))
-        except IOError:
+            self.index = BinaryIndex(self.index_name,
+              ghcnm_cache.stamp(self.name))
+        except (IOError, Error):
             self.build()
 
-    def build(self):
+    def build(self, jobs=1):
         """
-        (Re-) build the index file.  Updates self.index.
+        (Re-) build the index file, scanning the input with `jobs`
+        processes.  Updates self.index.
         """
 
-        sys.stderr.write("Building index...\n")
-        inp = open(self.name)
-        out = open(self.index_name, 'w')
-        build(inp, out)
-        out.close()
-        inp.close()
-        sys.stderr.write("Done building index...\n")
-        self.index = index(open(self.index_name))
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        build_file(self.name, jobs)
+        self.index = BinaryIndex(self.index_name,
+          ghcnm_cache.stamp(self.name))
 
     def get_id12(self, id12):
         """For a given 12-digit record identifier, return an iterator
@@ -106,40 +442,66 @@ class File:
 
         assert 12 == len(id12)
 
-        return get_single_id(self, id12)
+        return self.get_single_id(id12)
 
     def get_single_id(self, id):
         """
         For a given record identifier (11-digit in GHCN-M v3,
         12-digit in GHCN-M v2), return an iterator that yields
-        each datum.
+        each datum.  Each of the record's blocks is read (and
+        checked) separately, so that rows of other records between
+        them (in a file that is not sorted) are not included.
+        """
+
+        return iter(self.checked_read(lambda: self.index.blocks(id)))
+
+    def get_element(self, id, element='TAVG'):
+        """
+        For an 11-digit station identifier in a GHCN-M v3 (or
+        ISTI) file, return an iterator that yields each datum of
+        `element`, in file order.  Only the blocks for that element
+        are read.
+        """
+
+        return iter(self.checked_read(
+          lambda: self.index.blocks(id, element)))
+
+    def checked_read(self, entries):
+        """
+        Read the blocks given by the list of Index objects returned
+        by `entries()`, check each against the index, and return a
+        list of lines.  The index is rebuilt (and `entries` called
+        again) if it is wrong.
         """
 
-        # Get the first line according to the index, and check it.
         rebuilt_index = False
         while True:
-            i = self.index[id]
-            self.file.seek(i.whence)
-            first_line = self.file.readline()
-            if first_line.startswith(i.match):
-                break
+            lines = []
+            for i in entries():
+                block = self.read(i.whence, i.length)
+                if not block.startswith(i.match):
+                    break
+                block = block.splitlines(True)
+                if i.element and any(line[15:19] != i.element
+                  for line in block):
+                    break
+                lines.extend(block)
+            else:
+                return lines
             if rebuilt_index:
                 raise Error(
-                  "Index still wrong after rebuilding.  id=%s" % id)
+                  "Index still wrong after rebuilding.  id=%s" % i.id)
             sys.stderr.write("Index is wrong, rebuilding it...\n")
             rebuilt_index = True
             self.build()
 
-        def iter():
-            """Iterator for the lines."""
+    def read(self, whence, length):
+        """
+        Read `length` bytes from offset `whence` of the file (without
+        moving the file pointer) and return them as a string.
+        """
 
-            # This is a pretty naughty capture of `first_line`
-            # from the enclosing function.
-            line = first_line
-            while line.startswith(id):
-                yield line
-                line = self.file.readline()
-        return iter()
+        return self.reader.read(whence, length).decode('iso8859-1')
 
     def get_many_id(self, id11):
         """
@@ -172,6 +534,114 @@ class File:
         for pair in self.get_many_id(id):
             yield pair
 
+    def get_window(self, id, timewindow, element=None):
+        """
+        As `get`, but only the rows for the years y1 <= year < y2,
+        where `timewindow` is the pair (y1, y2), are read; and, if
+        `element` is given, only the rows of that element (in a
+        GHCN-M v2 file, which has no elements, every row).  A
+        sequence of (id, rows, span) triples is returned, where
+        `span` is the (first, last) pair of years of the record's
+        first and last rows (of all of them, not only the ones read),
+        or None if it has none.
+
+        The rows for a year are found by a binary search in each
+        block of the index (see `window_block`), so the cost is in
+        proportion to the number of rows in the window, not in the
+        whole record.
+        """
+
+        item = self.index.get(id)
+        if not item:
+            return
+        if isinstance(item, Index):
+            ids = [id]
+        else:
+            ids = item
+        for id in ids:
+            spans = []
+            def entries():
+                del spans[:]
+                parts = []
+                for entry in self.index.blocks(id):
+                    if element and entry.element and entry.element != element:
+                        continue
+                    part, first, last = self.window_block(entry, *timewindow)
+                    if part:
+                        parts.append(part)
+                    spans.append((first, last))
+                return parts
+            rows = self.checked_read(entries)
+            span = None
+            if spans:
+                span = (min(s[0] for s in spans), max(s[1] for s in spans))
+            yield id, rows, span
+
+    def window_block(self, entry, y1, y2):
+        """
+        Find the rows of the block `entry` (an Index object) for
+        the years y1 <= year < y2.  A (part, first, last) triple is
+        returned: `part` is an Index object for those rows (None if
+        there are none), `first` and `last` are the years of the
+        block's first and last rows.
+
+        The lines of a block are normally all the same length (the
+        index records the width of the lines of each block, if so),
+        and then the year of any line can be read from the file
+        directly; only a few bytes are read for each step of the
+        search.  A compressed file (where going back is expensive)
+        is read in full, and searched in memory; so is a block with
+        lines of differing lengths.
+        """
+
+        n = len(entry.id)
+        data = None
+        if compressed.is_compressed(self.name):
+            data = self.reader.read(entry.whence, entry.length)
+        if entry.width:
+            starts = range(0, entry.length, entry.width)
+        else:
+            if data is None:
+                data = self.reader.read(entry.whence, entry.length)
+            starts = [0]
+            at = data.find(b'\n') + 1
+            while 0 < at < len(data):
+                starts.append(at)
+                at = data.find(b'\n', at) + 1
+
+        def year(k):
+            at = starts[k] + n
+            if data is None:
+                return self.read(entry.whence + at, 4)
+            return data[at:at+4].decode('iso8859-1')
+
+        lo = bisect_years(year, len(starts), y1)
+        hi = bisect_years(year, len(starts), y2)
+        first = int(entry.year)
+        last = int(year(len(starts) - 1))
+        if lo >= hi:
+            return None, first, last
+        stop = starts[hi] if hi < len(starts) else entry.length
+        part = Index.from_fields(entry.id, year(lo),
+          entry.whence + starts[lo], stop - starts[lo], entry.element)
+        return part, first, last
+
+def bisect_years(year, n, y):
+    """
+    The first k in range(n) for which int(year(k)) >= y, or n if
+    there is none.  `year(k)` is the year (a string) of line k of a
+    block, and must not decrease with k.
+    """
+
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if int(year(mid)) < y:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
 def index(f):
     """Read the index file `f` and return a dictionary that maps from
     id to an Index object, and also for GHCN-M v2 files that
@@ -194,6 +664,13 @@ def index(f):
 class Index:
     """A single entry from the index file."""
 
+    # Length of the record's block, in bytes, its element, and the
+    # width of its lines (0 if they differ).  Only known for entries
+    # from a binary index.
+    length = None
+    element = ''
+    width = 0
+
     def __init__(self, line):
         self.id, self.year, self.whence = line.split()
         # Concatentate these two to form the 15 or 16 character
@@ -201,11 +678,175 @@ class Index:
         self.match = self.id + self.year
         self.whence = int(self.whence)
 
+    @classmethod
+    def from_fields(cls, id, year, whence, length, element='', width=0):
+        """An entry from the fields of a binary index entry."""
+
+        entry = cls.__new__(cls)
+        entry.width = width
+        entry.id = id
+        entry.element = element
+        entry.year = year
+        entry.match = id + year
+        entry.whence = whence
+        entry.length = length
+        return entry
+
+class BinaryIndex:
+    """
+    A binary index file (see `build_binary`), memory-mapped.  It
+    can be used in the same way as the dict returned by `index`:
+    it maps from id to an Index object (covering all the station's
+    elements), and for GHCN-M v2 files `.get` also maps from id11 to
+    a list of id12s.  `blocks` gives the entries for a single
+    element.
+    """
+
+    def __init__(self, name, source_stamp):
+        """
+        Open the binary index `name`.  Error is raised if it
+        was not built from an input with `source_stamp`.
+        """
+
+        with open(name, 'rb') as f:
+            header = f.read(BINARY_HEADER.size)
+            if len(header) < BINARY_HEADER.size:
+                raise Error("Index %s is truncated" % name)
+            magic, mtime, size, self.n, self.ids, self.stations = (
+              BINARY_HEADER.unpack(header))
+            if magic != BINARY_MAGIC or (mtime, size) != source_stamp:
+                raise Error("Index %s is out of date" % name)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def key(self, i, width=12):
+        """The first `width` bytes of entry `i`: the (padded)
+        identifier, followed by the element when `width` is 16."""
+
+        at = BINARY_HEADER.size + i * BINARY_ENTRY.size
+        return self.map[at:at+width]
+
+    def bisect(self, key):
+        """The position of the first entry whose key is not less
+        than `key` (bytes)."""
+
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid, len(key)) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def entry(self, i):
+        """Entry `i`, as an Index object."""
+
+        id, element, year, whence, length, width = BINARY_ENTRY.unpack_from(
+          self.map, BINARY_HEADER.size + i * BINARY_ENTRY.size)
+        return Index.from_fields(id.rstrip().decode('ascii'),
+          year.decode('ascii'), whence, length,
+          element.rstrip().decode('ascii'), width)
+
+    def blocks(self, id, element=None):
+        """
+        A list of the entries (Index objects) for `id`, and only
+        for `element` if it is given, in file order.
+        """
+
+        key = id.encode('ascii').ljust(12)
+        if element is not None:
+            key += element.encode('ascii').ljust(4)
+        i = self.bisect(key)
+        result = []
+        while i < self.n and self.key(i, len(key)) == key:
+            result.append(self.entry(i))
+            i += 1
+        result.sort(key=lambda entry: entry.whence)
+        return result
+
+    def elements(self, id):
+        """The elements recorded for `id`, sorted."""
+
+        return sorted(set(entry.element for entry in self.blocks(id)))
+
+    def __getitem__(self, id):
+        """
+        An Index object for `id` that covers all its blocks, which
+        are normally adjacent in the file.  If they are not (the
+        file is not sorted), it covers only the first block; use
+        `blocks` to get them all.
+        """
+
+        blocks = self.blocks(id)
+        if not blocks:
+            raise KeyError(id)
+        first = blocks[0]
+        end = first.whence
+        for entry in blocks:
+            if entry.whence != end:
+                break
+            end += entry.length
+        else:
+            return Index.from_fields(first.id, first.year, first.whence,
+              end - first.whence)
+        return first
+
+    def get(self, id, default=None):
+        try:
+            return self[id]
+        except KeyError:
+            pass
+        # All the id12s that start with id.
+        prefix = id.encode('ascii')
+        ids = []
+        i = self.bisect(prefix)
+        while i < self.n and self.key(i).startswith(prefix):
+            ids.append(self.key(i).rstrip().decode('ascii'))
+            i += 1
+        return ids or default
+
+    def __contains__(self, id):
+        return self.get(id) is not None
+
+    def __len__(self):
+        return self.ids
+
+    def __iter__(self):
+        prev = None
+        for i in range(self.n):
+            key = self.key(i)
+            if key != prev:
+                yield key.rstrip().decode('ascii')
+            prev = key
+
+    def checksums(self):
+        """
+        The checksum of each station, as a list of
+        (id, whence, length, crc) tuples (as per `checksums`, but
+        `id` is a string) in file order.
+        """
+
+        at = BINARY_HEADER.size + self.n * BINARY_ENTRY.size
+        table = self.map[at:at + self.stations * BINARY_STATION.size]
+        return [(id.rstrip().decode('ascii'), whence, length, crc)
+          for id, whence, length, crc in BINARY_STATION.iter_unpack(table)]
+
+    def close(self):
+        self.map.close()
+
 def main(argv=None):
+    import getopt
+
     if argv is None:
         argv = sys.argv
-    name = "input/ghcnm.tavg.qca.dat"
-    return build(open(name), open(name + '.index', 'w'))
+    opt, arg = getopt.getopt(argv[1:], '', ['jobs='])
+    jobs = 1
+    for k,v in opt:
+        if k == '--jobs':
+            jobs = int(v)
+    names = arg or ["input/ghcnm.tavg.qca.dat"]
+    for name in names:
+        build_file(name, jobs)
 
 if __name__ == '__main__':
     main()
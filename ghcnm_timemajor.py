@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+"""
+ghcnm_timemajor.py [--element E] [--ids ID,ID,...]
+  [--month YYYY-MM | --year YYYY | -t YYYY,YYYY] [ghcnm.dat ...]
+
+A time-major copy of a GHCN-M v3 file: for one element (TAVG by
+default), a matrix of int16 values with a row for each month and a
+column for each station, so that the values of every station for a
+month, a year, or a range of years are together, and can be read
+without touching the rest of the file.  The binary cache (see
+ghcnm_cache.py) holds each station's series together, which suits
+questions about a station; this suits questions about a month (for
+example, a map of the whole network for July 1998).
+
+The store is built from the cache (which is built first, if need
+be) and stored alongside the input, with '.' and the element and
+'.tmajor' appended to the name.  It records the modification time
+and size of the input, and is rebuilt automatically when either
+changes.  Rows run from January of the first year of any station
+to December of the last year; -9999 marks invalid data, as in the
+cache.  There is a column for each series of the element in the
+cache, in the same order.  Flags are not kept.
+
+With no query option the stores are just built.  --month, --year
+or -t (as per stationplot.py: from the beginning of the first year
+up to the beginning of the second) print the valid values of the
+stations (all of them, or those given with --ids) in that time,
+one to a line:
+
+  ID YEAR MONTH VALUE
+"""
+
+import array
+import mmap
+import operator
+import os
+import struct
+import sys
+
+# ghcntool directory
+import ghcnm_cache
+
+MISSING = ghcnm_cache.MISSING
+
+# The magic number includes the byte order, since the values are
+# written in native byte order.
+MAGIC = b'GHCNMT1' + {'little': b'<', 'big': b'>'}[sys.byteorder]
+
+# magic, input mtime (ns), input size, element (padded to 8
+# bytes), first year, number of months, number of stations.
+HEADER = struct.Struct('<8sqq8sqqq')
+
+class Error(Exception):
+    pass
+
+def store_name(name, element='TAVG'):
+    """The name of the time-major store of `element` for the
+    GHCN-M v3 file `name`."""
+
+    return '%s.%s.tmajor' % (name, element)
+
+def build(cache, element, out, source_stamp):
+    """
+    Build a time-major store of the series of `element` in `cache`
+    (a ghcnm_cache.Cache) and write it to `out` (opened in binary
+    mode).  `source_stamp` is as per ghcnm_cache.build.
+
+    Each series is copied into its column with a single strided
+    slice assignment.
+    """
+
+    series = [i for i in range(len(cache)) if cache.element(i) == element]
+    first = min((cache.first_year[i] for i in series), default=0)
+    end = max((cache.first_year[i] + (cache.start[i+1] - cache.start[i])
+      // 12 for i in series), default=first)
+    months = 12 * (end - first)
+    stations = len(series)
+
+    matrix = array.array('h', [MISSING]) * (months * stations)
+    for j, i in enumerate(series):
+        values, first_year = cache.series(i)
+        column = array.array('h')
+        column.frombytes(values.cast('B'))
+        at = 12 * (first_year - first) * stations + j
+        matrix[at:at + len(column) * stations:stations] = column
+
+    out.write(HEADER.pack(MAGIC, source_stamp[0], source_stamp[1],
+      element.encode('ascii'), first, months, stations))
+    ids = b''.join(cache.id(i).encode('ascii') for i in series)
+    for data in [ids, matrix.tobytes()]:
+        out.write(data)
+        out.write(b'\0' * ghcnm_cache.padding(len(data)))
+
+class TimeMajor:
+    """
+    The time-major store of one element of a GHCN-M v3 file.
+
+    The attributes `first_year`, `months` (the number of rows) and
+    `ids` (the station identifier of each column) describe the
+    matrix; `values` exposes it as a memoryview of int16 on the
+    mapped file, the value of column j for month m (counting from
+    January of `first_year`) being values[m*len(ids) + j].
+    """
+
+    def __init__(self, name, element='TAVG', build=True):
+        """
+        `name` is the filename of the GHCN-M v3 file.  The store
+        is built if it does not exist or is out of date, unless
+        `build` is false, in which case Error is raised.
+        """
+
+        self.name = name
+        self.element = element
+        self.store_name = store_name(name, element)
+        self.map = None
+        if not self.open():
+            if not build:
+                raise Error("No up to date store for %s" % name)
+            self.build()
+            if not self.open():
+                raise Error("Store still out of date after building.")
+
+    def build(self):
+        """
+        (Re-) build the store file.
+        """
+
+        sys.stderr.write("Building time-major store...\n")
+        self.close()
+        cache = ghcnm_cache.Cache(self.name)
+        # Write to a temporary file and rename, so that other
+        # processes never see a partially written store.
+        tmp = '%s.%d.tmp' % (self.store_name, os.getpid())
+        try:
+            with open(tmp, 'wb') as out:
+                build(cache, self.element, out,
+                  ghcnm_cache.stamp(self.name))
+        finally:
+            cache.close()
+        os.replace(tmp, self.store_name)
+        sys.stderr.write("Done building time-major store...\n")
+
+    def open(self):
+        """
+        Map the store file.  Returns False if it does not exist or
+        does not match the input file.
+        """
+
+        try:
+            f = open(self.store_name, 'rb')
+        except IOError:
+            return False
+        with f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return False
+            magic, mtime, size, element, first, months, stations = (
+              HEADER.unpack(header))
+            if (magic != MAGIC or (mtime, size) != ghcnm_cache.stamp(
+              self.name) or element.rstrip(b'\0') !=
+              self.element.encode('ascii')):
+                return False
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        at = HEADER.size
+        size = 11 * stations
+        ids = self.map[at:at+size].decode('ascii')
+        self.ids = [ids[k:k+11] for k in range(0, size, 11)]
+        at += size + ghcnm_cache.padding(size)
+        self.views = [memoryview(self.map)]
+        self.views.append(self.views[0][at:at + 2*months*stations])
+        self.values = self.views[-1].cast('h')
+        self.views.append(self.values)
+        self.first_year = first
+        self.months = months
+        self.column = dict((id, j) for j, id in enumerate(self.ids))
+        return True
+
+    def close(self):
+        """Release the mapped file."""
+
+        if self.map is None:
+            return
+        for view in reversed(self.views):
+            view.release()
+        self.map.close()
+        self.map = None
+
+    def columns(self, ids=None):
+        """
+        The columns for the station identifiers `ids` (all the
+        stations if None), as an (ids, columns) pair; identifiers
+        that are not in the store are left out.  `columns` is None
+        for all the stations.
+        """
+
+        if ids is None:
+            return list(self.ids), None
+        ids = [id for id in ids if id in self.column]
+        return ids, [self.column[id] for id in ids]
+
+    def get(self, m1, m2, ids=None):
+        """
+        The values for the months from `m1` up to (but not
+        including) `m2`, counting months from January of the year 0
+        (so that July 1998 is 1998*12 + 6), for the stations `ids`
+        (all of them if None).  An (ids, values) pair is returned:
+        `values` is an array of int16 with a row of len(ids) values
+        for each month.  Months outside the store are MISSING.
+
+        Only the rows for those months are read; with `ids`, the
+        columns are picked out of each row with an itemgetter.
+        """
+
+        ids, columns = self.columns(ids)
+        width = len(self.ids)
+        start = 12 * self.first_year
+        # The months from a to b are in the store.
+        a = min(max(m1, start), m2)
+        b = max(min(m2, start + self.months), a)
+        result = array.array('h', [MISSING]) * (len(ids) * (a - m1))
+        rows = self.values[width*(a-start):width*(b-start)]
+        if columns is None:
+            result.frombytes(rows.cast('B'))
+        elif columns:
+            pick = operator.itemgetter(*columns)
+            for at in range(0, len(rows), width):
+                picked = pick(rows[at:at+width])
+                if len(columns) == 1:
+                    result.append(picked)
+                else:
+                    result.extend(picked)
+        result.extend([MISSING] * (len(ids) * (m2 - b)))
+        return ids, result
+
+    def month(self, year, month, ids=None):
+        """As `get`, for the single `month` (1 to 12) of `year`."""
+
+        m = 12 * year + month - 1
+        return self.get(m, m + 1, ids)
+
+    def year(self, year, ids=None):
+        """As `get`, for the 12 months of `year`."""
+
+        return self.get(12 * year, 12 * (year + 1), ids)
+
+    def range(self, y1, y2, ids=None):
+        """As `get`, for the years from `y1` up to (but not
+        including) `y2`."""
+
+        return self.get(12 * y1, 12 * y2, ids)
+
+def write_values(out, m1, ids, values):
+    """
+    Write the valid `values`, as returned by `TimeMajor.get` for
+    months from `m1`, to `out`, one to a line.
+    """
+
+    width = len(ids)
+    for k, value in enumerate(values):
+        if value == MISSING:
+            continue
+        m, j = divmod(k, width)
+        year, month = divmod(m1 + m, 12)
+        out.write("%s %d %02d %d\n" % (ids[j], year, month + 1, value))
+
+def main(argv=None):
+    import getopt
+
+    if argv is None:
+        argv = sys.argv
+
+    opt, arg = getopt.getopt(argv[1:], 't:',
+      ['element=', 'ids=', 'month=', 'year='])
+    element = 'TAVG'
+    ids = None
+    months = None
+    for k,v in opt:
+        if k == '--element':
+            element = v
+        if k == '--ids':
+            ids = v.split(',')
+        if k == '--month':
+            year, month = v.split('-')
+            m = 12 * int(year) + int(month) - 1
+            months = (m, m + 1)
+        if k == '--year':
+            months = (12 * int(v), 12 * (int(v) + 1))
+        if k == '-t':
+            y1, y2 = v.split(',')
+            months = (12 * int(y1), 12 * int(y2))
+
+    names = arg or ["input/ghcnm.tavg.qca.dat"]
+    for name in names:
+        store = TimeMajor(name, element)
+        try:
+            if months is not None:
+                found, values = store.get(months[0], months[1], ids)
+                write_values(sys.stdout, months[0], found, values)
+        finally:
+            store.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+"""
+Write files in GHCN-M v3 format from arrays of values.
+
+A series (a station--element) is given as an array of int16
+values, 12 for each year from its first year (MISSING, -9999,
+marking invalid data), and optionally the 3 flag characters
+(DMFLAG, QCFLAG, DSFLAG) of each value, as bytes; this is how
+ghcnm_cache.parse and ghcnm_cache.Cache present them.  The rows of
+a whole series are formatted at once:
+
+  each value's 5 character field is looked up in a table (made
+  once, with an entry for every int16 value);
+  the fields and the flags are interleaved into the 96 bytes of
+  data of each row with a few strided slice assignments over the
+  whole series;
+  only the 19 character prefix (identifier, year, element) of each
+  row is made separately.
+
+Years with no valid data are skipped.  The output is the same,
+byte for byte, as formatting each value with '{:5d}' followed by
+its flags.  `Writer` collects the rows in a buffer and writes them
+to a binary file in large chunks.
+"""
+
+import array
+
+# ghcntool directory
+import ghcnm_cache
+
+MISSING = ghcnm_cache.MISSING
+
+# Size of the buffer that `Writer` writes at once.
+CHUNK = 1 << 20
+
+# Width of a value field, and of a value with its flags.
+FIELD = 5
+WIDTH = 8
+
+# The formatted field for each int16 value, indexed by the value as
+# an unsigned 16-bit number.  Made when first needed.
+_fields = None
+
+def fields():
+    """The table of formatted fields (see `_fields`)."""
+
+    global _fields
+    if _fields is None:
+        _fields = [b'%5d' % (u - 0x10000 if u >= 0x8000 else u)
+          for u in range(0x10000)]
+    return _fields
+
+def as_array(values):
+    """`values` (a sequence of ints) as an int16 array."""
+
+    if isinstance(values, array.array) and values.typecode == 'h':
+        return values
+    result = array.array('h')
+    if isinstance(values, memoryview):
+        result.frombytes(values.cast('B'))
+    else:
+        result.extend(values)
+    return result
+
+def format_values(values, flags=None):
+    """
+    Format `values` (int16) and their `flags` (3 bytes for each
+    value; blank if None) as the data part of GHCN-M v3 rows: 8
+    bytes for each value (9 for a value below -9999, which is too
+    wide for its field).  The result is a bytearray.
+    """
+
+    values = as_array(values)
+    n = len(values)
+    if flags is None:
+        flags = b' ' * (3 * n)
+    assert len(flags) == 3 * n
+    if n and min(values) < -9999:
+        # Too wide for the field; format the slow way, so that the
+        # output is still the same as '{:5d}' makes.
+        table = fields()
+        return bytearray(b''.join(table[v & 0xffff] + bytes(flags[3*i:3*i+3])
+          for i, v in enumerate(values)))
+    unsigned = memoryview(values).cast('B').cast('H')
+    text = b''.join(map(fields().__getitem__, unsigned))
+    out = bytearray(WIDTH * n)
+    for k in range(FIELD):
+        out[k::WIDTH] = text[k::FIELD]
+    for k in range(3):
+        out[FIELD+k::WIDTH] = flags[k::3]
+    return out
+
+def rows(id, element, first_year, values, flags=None):
+    """
+    Return the GHCN-M v3 rows (as bytes) of a series: the station
+    `id` (11 characters) and `element` (4 characters), both str or
+    bytes, whose `values` (and `flags`) start in January of
+    `first_year`.  The number of values must be a multiple of 12.
+    Years with no valid data are skipped.
+    """
+
+    if isinstance(id, str):
+        id = id.encode('ascii')
+    if isinstance(element, str):
+        element = element.encode('ascii')
+    assert 11 == len(id)
+    assert 4 == len(element)
+    values = as_array(values)
+    assert len(values) % 12 == 0
+    data = None
+    if not values or min(values) >= -9999:
+        # Every year is 96 bytes of data.
+        data = format_values(values, flags)
+    raw = memoryview(values).cast('B')
+    # The 24 bytes of a year with no valid data.
+    missing = array.array('h', [MISSING] * 12).tobytes()
+    result = []
+    for y in range(len(values) // 12):
+        if raw[24*y:24*y+24] == missing:
+            continue
+        if data is None:
+            # Some values are too wide for their fields, so the
+            # years are formatted one at a time.
+            year = format_values(values[12*y:12*y+12],
+              flags and flags[36*y:36*y+36])
+        else:
+            year = data[96*y:96*y+96]
+        result.append(b'%s%4d%s%s\n' % (id, first_year + y, element, year))
+    return b''.join(result)
+
+class Writer:
+    """
+    Writes GHCN-M v3 rows to `out` (a file opened in binary mode),
+    in chunks of about CHUNK bytes.  `close` (or leaving a `with`
+    block) writes what is left; it does not close `out`.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.buffer = bytearray()
+
+    def write_series(self, id, element, first_year, values, flags=None):
+        """Write a series, as per `rows`."""
+
+        self.buffer += rows(id, element, first_year, values, flags)
+        if len(self.buffer) >= CHUNK:
+            self.flush()
+
+    def write(self, data):
+        """Write `data`, rows already formatted (bytes)."""
+
+        self.buffer += data
+        if len(self.buffer) >= CHUNK:
+            self.flush()
+
+    def flush(self):
+        self.out.write(self.buffer)
+        self.buffer = bytearray()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+"""
+isti.py [station_monthly_stage2 ...]
+
+Random access to ISTI stage 2 files (the `_monthly_stage2` files of
+the International Surface Temperature Initiative's databank, one
+file for each station, one row for each month).
+
+A small index of each file is stored alongside it, with '.yindex'
+appended to the name: the offset of the first row of each year.
+It records the modification time and size of the file, and is
+rebuilt automatically when either changes.  With it, a station's
+record, or just the years of it that fall in a time window, is
+read with a single pread.
+
+The rows are parsed a block at a time: the block is split into
+whitespace separated fields once, and the dates (field 4) and
+values (field 7, TAVG in hundredths of a degree) of every row are
+taken out of the list of fields with a stride.  The results are
+the same as stationplot.from_lines produces.
+
+Running this module builds the index of each file named.
+"""
+
+import array
+import os
+import struct
+import sys
+
+# ghcntool directory
+import ghcnm_cache
+
+# Marks invalid data, same as stationplot.BAD.
+BAD = 9999
+
+MAGIC = b'ISTIY1\0\0'
+# magic, input mtime (ns), input size, first year, last month
+# (counting January of year 0 as 0).  Followed by the offsets (as
+# int64) of the first row of each year, from the first year to the
+# last year, and then the size of the file.
+HEADER = struct.Struct('<8sqqqq')
+
+# The fields of a row that hold the date (YYYYMM) and the value.
+DATE_FIELD = 4
+VALUE_FIELD = 7
+
+class Error(Exception):
+    pass
+
+def row_month(row):
+    """The month of `row` (bytes), counting January of year 0 as
+    0."""
+
+    date = row.split()[DATE_FIELD]
+    return int(date[:4]) * 12 + int(date[4:6]) - 1
+
+def build(inp, out, source_stamp):
+    """
+    Build a year index of the ISTI stage 2 file `inp` (opened in
+    binary mode) and write it to `out` (also binary).
+    `source_stamp` is the (mtime, size) pair of the input, as
+    returned by `ghcnm_cache.stamp`.
+    """
+
+    offsets = array.array('q')
+    first_year = last_month = 0
+    at = 0
+    for row in inp:
+        if not row.strip():
+            at += len(row)
+            continue
+        month = row_month(row)
+        if not offsets:
+            first_year = month // 12
+        # Every year up to this row's year starts here, or later.
+        while first_year + len(offsets) <= month // 12:
+            offsets.append(at)
+        last_month = month
+        at += len(row)
+    offsets.append(at)
+    out.write(HEADER.pack(MAGIC, source_stamp[0], source_stamp[1],
+      first_year, last_month))
+    out.write(offsets.tobytes())
+
+class Stage2:
+    """
+    An ISTI stage 2 file accessed through its year index.  It
+    follows stationplot's fast access protocol: `get` returns the
+    rows, and `get_series` returns the record already parsed.
+    """
+
+    def __init__(self, name):
+        """
+        `name` is the filename of the ISTI stage 2 file.  The index
+        is built if it does not exist or is out of date.
+        """
+
+        self.name = name
+        self.index_name = name + '.yindex'
+        self.file = open(name, 'rb')
+        if not self.open():
+            self.build()
+            if not self.open():
+                raise Error("Index still out of date after building.")
+
+    def build(self):
+        """
+        (Re-) build the index file.
+        """
+
+        # Write to a temporary file and rename, so that other
+        # processes never see a partially written index.
+        tmp = '%s.%d.tmp' % (self.index_name, os.getpid())
+        with open(self.name, 'rb') as inp, open(tmp, 'wb') as out:
+            build(inp, out, ghcnm_cache.stamp(self.name))
+        os.replace(tmp, self.index_name)
+
+    def open(self):
+        """
+        Read the index file.  Returns False if it does not exist
+        or does not match the input file.
+        """
+
+        try:
+            f = open(self.index_name, 'rb')
+        except IOError:
+            return False
+        with f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return False
+            magic, mtime, size, first_year, last_month = (
+              HEADER.unpack(header))
+            if magic != MAGIC or (mtime, size) != ghcnm_cache.stamp(
+              self.name):
+                return False
+            self.offsets = array.array('q')
+            self.offsets.frombytes(f.read())
+        self.first_year = first_year
+        self.last_month = last_month
+        return True
+
+    def read(self, y1, y2):
+        """
+        Read the rows for the years from `y1` up to (but not
+        including) `y2`, and return them as bytes.
+        """
+
+        k1 = min(max(y1 - self.first_year, 0), len(self.offsets) - 1)
+        k2 = min(max(y2 - self.first_year, 0), len(self.offsets) - 1)
+        start, stop = self.offsets[k1], self.offsets[k2]
+        return os.pread(self.file.fileno(), stop - start, start)
+
+    def get(self, id):
+        """
+        Yield a single (id, rows) pair, `rows` being every row of
+        the file.  The file holds a single station, so `id` is not
+        checked.
+        """
+
+        rows = self.read(self.first_year, self.last_month // 12 + 1)
+        yield (id, rows.decode('iso8859-1').splitlines(True))
+
+    def get_series(self, id, scale=None, timewindow=None):
+        """
+        Return the record as a (series, begin) pair, as
+        stationplot.from_lines does (values are always in
+        hundredths, so `scale` is not used).
+
+        If `timewindow`, a (y1, y2) pair of years, is given, then
+        only the rows for those years are read, and the result is
+        the same as stationplot.window would make of the whole
+        record; if that would leave nothing, the series is empty
+        (and `begin` is y1), so that stationplot.window drops it.
+        """
+
+        if len(self.offsets) < 2:
+            return None
+        begin = self.first_year
+        stop = self.last_month + 1
+        if timewindow is not None:
+            t1, t2 = timewindow
+            # As per stationplot.window, which only counts whole
+            # years at the end of the record.
+            end = begin + (stop - 12 * begin) // 12
+            if t2 <= begin or end <= t1:
+                return [], t1
+            if t2 < end:
+                stop = 12 * t2
+            begin = max(begin, t1)
+        block = self.read(begin, (stop - 1) // 12 + 1)
+        return parse(block, begin, stop), begin
+
+    def close(self):
+        self.file.close()
+
+def parse(block, begin, stop):
+    """
+    Parse `block`, bytes consisting of whole rows, and return a
+    list of values for each month from January of `begin` up to
+    (but not including) month `stop` (counting January of year 0 as
+    0).  Months with no row are BAD.
+    """
+
+    fields = block.split()
+    rows = block.count(b'\n') + (not block.endswith(b'\n'))
+    stride = rows and len(fields) // rows
+    if rows and stride * rows == len(fields) and stride > VALUE_FIELD:
+        dates = fields[DATE_FIELD::stride]
+        values = fields[VALUE_FIELD::stride]
+    else:
+        # Rows with differing numbers of fields.
+        split = [row.split() for row in block.splitlines() if row.strip()]
+        dates = [row[DATE_FIELD] for row in split]
+        values = [row[VALUE_FIELD] for row in split]
+    months = [int(date[:4]) * 12 + int(date[4:6]) - 1 for date in dates]
+    values = [int(value) * 0.01 for value in values]
+
+    first = begin * 12
+    series = [BAD] * (stop - first)
+    if all(a < b for a, b in zip(months, months[1:])):
+        for month, value in zip(months, values):
+            if first <= month < stop:
+                series[month - first] = value
+        return series
+
+    # Not in increasing order; as per stationplot.from_months, each
+    # row's value is placed after the previous one.
+    series = []
+    prev = first - 1
+    for month, value in zip(months, values):
+        while prev + 1 < month:
+            series.append(BAD)
+            prev += 1
+        prev = month
+        series.append(value)
+    return series
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    for name in argv[1:]:
+        Stage2(name).close()
+
+if __name__ == '__main__':
+    main()
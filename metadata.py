@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+"""
+metadata.py [station.inv ...]
+
+Station metadata, from a .inv file in the GHCN-M v2 or v3 layout
+(or ISTI's emulation of GHCN-M v3), parsed once and cached.
+
+The cache is stored alongside the .inv file, with '.meta' appended
+to the name.  It records the modification time and size of the
+.inv file, and is rebuilt automatically when either changes.  It
+holds columns, one entry for each station in file order: the 11
+character identifier, the name, latitude, longitude, and
+elevation (as arrays of doubles; NaN where a field is blank or
+invalid), and the position of the station's row in the .inv file.
+Loading it is a handful of reads, after which a station is found
+by identifier with a dict lookup, and the coordinates of every
+station are available as whole columns.  If the cache cannot be
+written (the .inv file is in a read-only directory, say), it is
+built in memory instead.
+
+The other fields of a row (which only GHCN-M v3 has) are parsed
+on demand by `Metadata.fields`.  Running this module builds the
+cache of each file named.
+"""
+
+import array
+import io
+import mmap
+import os
+import struct
+import sys
+
+# ghcntool directory
+import compressed
+import ghcnm_cache
+
+# The magic number includes the byte order, since the arrays are
+# written in native byte order.
+MAGIC = b'GHCNMD1' + {'little': b'<', 'big': b'>'}[sys.byteorder]
+
+# magic, .inv mtime (ns), .inv size, number of stations.
+HEADER = struct.Struct('<8sqqq')
+
+# Width of the name column.
+NAME_WIDTH = 30
+
+def blank_int(s):
+    """
+    Convert a field to an int, or if blank, convert to None.  (With
+    the beta GHCN-M v3 metadata, several fields are blank for some
+    stations.)
+    """
+
+    if s == '' or s.isspace():
+        return None
+    return int(s)
+
+# The fields of a GHCN-M v3 .inv row, named after the designators
+# used in the GHCN-M v3 documentation; see
+# ftp://ftp.ncdc.noaa.gov/pub/data/ghcn/v3/README
+V3_FIELDS = [
+    ('id',        0,    11, str),
+    ('latitude',  12,   20, float),
+    ('longitude', 21,   30, float),
+    ('stelev',    31,   37, float),
+    ('name',      38,   68, str.strip),
+    ('grelev',    69,   73, blank_int),
+    ('popcls',    73,   74, str),
+    ('popsiz',    75,   79, blank_int),
+    ('topo',      79,   81, str),
+    ('stveg',     81,   83, str),
+    ('stloc',     83,   85, str),
+    ('ocndis',    85,   87, blank_int),
+    ('airstn',    87,   88, str),
+    ('towndis',   88,   90, blank_int),
+    ('grveg',     90,  106, str.strip),
+    ('popcss',    106, 107, str),
+]
+
+class Error(Exception):
+    pass
+
+def layout(row):
+    """
+    The layout of the .inv row `row`: 'v3' for GHCN-M v3 (108
+    characters, with the newline) or ISTI's emulation of it (69),
+    otherwise 'v2'.
+    """
+
+    if len(row.rstrip(b'\r\n')) in (68, 107):
+        return 'v3'
+    return 'v2'
+
+def parse_row(row):
+    """
+    Parse the .inv row `row` (bytes) and return an
+    (id, name, lat, lon, elev) tuple; `id` and `name` are strings.
+    Numbers that are blank or invalid are NaN.
+    """
+
+    if layout(row) == 'v3':
+        name = row[38:68]
+        lat, lon, elev = row[12:20], row[21:30], row[31:37]
+    else:
+        name = row[12:42]
+        lat, lon, elev = row[43:49], row[50:57], row[58:62]
+    return ((row[:11].decode('iso8859-1'),
+      name.decode('iso8859-1').strip()) +
+      tuple(number(x) for x in (lat, lon, elev)))
+
+def number(s):
+    """`s` as a float, or NaN if it is blank or not a number."""
+
+    try:
+        return float(s)
+    except ValueError:
+        return float('nan')
+
+def build(inp, out, source_stamp):
+    """
+    Build a metadata cache of the .inv file `inp` (opened in binary
+    mode) and write it to `out` (also binary).  `source_stamp` is
+    the (mtime, size) pair of the input, as returned by
+    `ghcnm_cache.stamp`.
+    """
+
+    ids = bytearray()
+    names = bytearray()
+    columns = [array.array('d') for _ in range(3)]
+    offsets = array.array('q')
+    lengths = array.array('q')
+    at = 0
+    for row in inp:
+        if row.strip():
+            _, name, lat, lon, elev = parse_row(row)
+            ids.extend(row[:11].ljust(11))
+            names.extend(name.encode('iso8859-1')[:NAME_WIDTH].ljust(
+              NAME_WIDTH))
+            for column, x in zip(columns, (lat, lon, elev)):
+                column.append(x)
+            offsets.append(at)
+            lengths.append(len(row))
+        at += len(row)
+
+    out.write(HEADER.pack(MAGIC, source_stamp[0], source_stamp[1],
+      len(offsets)))
+    for section in [ids, names] + columns + [offsets, lengths]:
+        data = bytes(section)
+        out.write(data)
+        out.write(b'\0' * ghcnm_cache.padding(len(data)))
+
+class Station:
+    """
+    The metadata of one station.  Its fields can also be got by
+    subscripting (station['lat']), so that it can be used where
+    stationplot expects an info dictionary.
+    """
+
+    __slots__ = ('id', 'name', 'lat', 'lon', 'elev')
+
+    def __init__(self, id, name, lat, lon, elev):
+        self.id = id
+        self.name = name
+        self.lat = lat
+        self.lon = lon
+        self.elev = elev
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __repr__(self):
+        return 'Station(%r, %r, %r, %r, %r)' % (self.id, self.name,
+          self.lat, self.lon, self.elev)
+
+class Metadata:
+    """
+    The metadata of a .inv file, accessed through its cache.
+
+    It maps from 11-digit identifier to a Station instance.  The
+    columns `lat`, `lon` and `elev` are arrays of doubles, in file
+    order; `index(id)` gives the position of a station in them.
+    """
+
+    def __init__(self, name):
+        """
+        `name` is the filename of the .inv file (which can be
+        compressed).  The cache is built if it does not exist or
+        is out of date.
+        """
+
+        self.name = name
+        self.cache_name = name + '.meta'
+        # The contents of the .inv file, mapped (or read, if it is
+        # compressed) when first needed by `row`.
+        self.data = None
+        if not self.open():
+            try:
+                self.build()
+            except OSError:
+                # The cache can't be written; parse the .inv file
+                # into a cache in memory instead.
+                self.build_in_memory()
+                return
+            if not self.open():
+                raise Error("Cache still out of date after building.")
+
+    def build(self):
+        """
+        (Re-) build the cache file.
+        """
+
+        # Write to a temporary file and rename, so that other
+        # processes never see a partially written cache.
+        tmp = '%s.%d.tmp' % (self.cache_name, os.getpid())
+        try:
+            with compressed.open_input(self.name) as inp, (
+              open(tmp, 'wb')) as out:
+                build(inp, out, ghcnm_cache.stamp(self.name))
+            os.replace(tmp, self.cache_name)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def build_in_memory(self):
+        """
+        Build the cache in memory, and load it, without writing a
+        file.
+        """
+
+        out = io.BytesIO()
+        with compressed.open_input(self.name) as inp:
+            build(inp, out, ghcnm_cache.stamp(self.name))
+        out.seek(0)
+        if not self.load(out):
+            raise Error("Cache built in memory is out of date.")
+
+    def open(self):
+        """
+        Load the cache file.  Returns False if it does not exist or
+        does not match the .inv file.
+        """
+
+        try:
+            f = open(self.cache_name, 'rb')
+        except IOError:
+            return False
+        with f:
+            return self.load(f)
+
+    def load(self, f):
+        """
+        Load the cache from `f` (a binary file).  Returns False if
+        it does not match the .inv file.
+        """
+
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return False
+        magic, mtime, size, n = HEADER.unpack(header)
+        if (magic != MAGIC or
+          (mtime, size) != ghcnm_cache.stamp(self.name)):
+            return False
+
+        def section(size):
+            data = f.read(size)
+            f.read(ghcnm_cache.padding(size))
+            return data
+
+        ids = section(11 * n).decode('iso8859-1')
+        self.names = section(NAME_WIDTH * n)
+        self.lat, self.lon, self.elev = [
+          array.array('d', section(8 * n)) for _ in range(3)]
+        self.offsets, self.lengths = [
+          array.array('q', section(8 * n)) for _ in range(2)]
+        self.ids = [ids[11*i:11*i+11] for i in range(n)]
+        self.lookup = dict((id, i) for i, id in enumerate(self.ids))
+        return True
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return id in self.lookup
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __getitem__(self, id):
+        return self.station(self.lookup[id])
+
+    def get(self, id, default=None):
+        i = self.lookup.get(id)
+        if i is None:
+            return default
+        return self.station(i)
+
+    def items(self):
+        for i, id in enumerate(self.ids):
+            yield id, self.station(i)
+
+    def index(self, id):
+        """The position of station `id` in the columns, or None."""
+
+        return self.lookup.get(id)
+
+    def station(self, i):
+        """Station `i` (in file order), as a Station instance."""
+
+        name = self.names[NAME_WIDTH*i:NAME_WIDTH*(i+1)]
+        return Station(self.ids[i], name.decode('iso8859-1').rstrip(),
+          self.lat[i], self.lon[i], self.elev[i])
+
+    def valid(self, i):
+        """True if station `i` has valid coordinates (CRUTEM4, for
+        one, has stations with invalid ones)."""
+
+        lat, lon = self.lat[i], self.lon[i]
+        return -90 <= lat <= 90 and -180 <= lon <= 180
+
+    def row(self, i):
+        """The .inv row of station `i`, as a string."""
+
+        if self.data is None:
+            if compressed.is_compressed(self.name):
+                with compressed.open_input(self.name) as f:
+                    self.data = f.read()
+            else:
+                with open(self.name, 'rb') as f:
+                    self.data = mmap.mmap(f.fileno(), 0,
+                      access=mmap.ACCESS_READ)
+        at = self.offsets[i]
+        return self.data[at:at+self.lengths[i]].decode('iso8859-1')
+
+    def fields(self, i):
+        """
+        A dict of all the fields (see V3_FIELDS) of the GHCN-M v3
+        row of station `i`.
+        """
+
+        row = self.row(i)
+        return dict((field, convert(row[a:b]))
+          for field, a, b, convert in V3_FIELDS)
+
+    def __getstate__(self):
+        # Only the name is pickled; the cache is loaded again.
+        return self.name
+
+    def __setstate__(self, name):
+        self.__init__(name)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = None
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    for name in argv[1:]:
+        Metadata(name).close()
+
+if __name__ == '__main__':
+    main()
@@ -1,52 +1,240 @@
 #!/usr/bin/env python3
 
 """
-nearest -LT+LON
+nearest [--inv file.inv] [-k N] [--radius km] -LT+LON
+nearest [--inv file.inv] [-k N] [--radius km] --batch
 
-Print a list of the nearest stations to the given location.
+Print a list of the nearest stations to the given location (10
+of them, unless -k is used).  With --radius, print all the
+stations within that many kilometres instead (nearest first).
+
+With --batch the target locations are read from stdin, one
+-LT+LON per line; each output line is prefixed with its target.
+
+The stations are found using a k-d tree of their coordinates on
+the unit sphere.  The tree is built once and cached in a file
+alongside the .inv file (with '.kdtree' appended); it is rebuilt
+when the .inv file changes.  It is built from the coordinate
+columns of the metadata cache (see metadata.py).
 """
 
+import array
+import heapq
 import math
 import os
 import re
+import struct
+import sys
 
-def nearest(target, inv):
-    m = re.match(r'([-+]\d+(?:\.(?:\d+))?)([-+]\d+(?:\.(?:\d+))?)',
-      target)
-    lat, lon = [float(s) for s in m.groups()]
+# ghcntool directory
+import ghcnm_cache
+import metadata
 
-    target_xyz = xyz(lat, lon)
+# Mean radius of the Earth, in km.
+EARTH_RADIUS = 6371.0
 
-    def distance_from_target(thing):
-        return distance(thing[0], target_xyz)
+# magic, .inv mtime (ns), .inv size, number of stations.
+HEADER = struct.Struct('<8sqqq')
+MAGIC = b'KDTREE2' + {'little': b'<', 'big': b'>'}[sys.byteorder]
 
-    i = 0
-    for _, row in sorted(xyz_inv(inv), key=distance_from_target):
-        print(row[:69].strip())
-        i += 1
-        if i >= 10:
-            break
+def nearest(target, tree, k=10, radius=None, prefix=''):
+    """
+    Print the rows of the `k` stations in `tree` (a Tree instance)
+    that are nearest to `target` (a -LT+LON string).  If `radius`
+    (in km) is given, print all the stations within that distance
+    instead.  Each row is prefixed with `prefix`.
+    """
+
+    target_xyz = xyz(*parse_target(target))
+    if radius is None:
+        found = tree.nearest(target_xyz, k)
+    else:
+        found = tree.within(target_xyz, chord(radius))
+    for _, i in found:
+        print(prefix + tree.row(i)[:69].strip())
+
+def parse_target(target):
+    """
+    Parse a location of the form -LT+LON (signed decimal degrees
+    latitude, then longitude) and return a (lat, lon) pair.
+    """
 
+    m = re.match(r'([-+]\d+(?:\.(?:\d+))?)([-+]\d+(?:\.(?:\d+))?)',
+      target)
+    return tuple(float(s) for s in m.groups())
 
-def distance(pv, qv):
+def chord(km):
     """
-    Return the distance between the two vectors pv and qv.
+    The straight line distance between two points on the unit
+    sphere that are `km` apart along the surface of the Earth.
     """
-    assert len(pv) == len(qv)
-    s = sum((p-q)**2 for p, q in zip(pv, qv))
-    return s**0.5
 
-def xyz_inv(inv):
+    angle = min(km / EARTH_RADIUS, math.pi)
+    return 2 * math.sin(angle / 2)
+
+class Tree:
     """
-    For each row of the .inv file `inv` yield ((x,y,z), row).
+    A k-d tree of the stations of a .inv file.  The tree is
+    implicit: the points are stored in an order such that the
+    root of any range of points is at its middle, and it splits
+    the range on coordinate (depth % 3); so all that needs to be
+    stored is the coordinates, and the position of each station
+    in the metadata (a metadata.Metadata instance).
     """
-    for row in inv:
-        lat = float(row[12:20])
-        lon = float(row[21:30])
-        if not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
-            # CRUTEM4 has stations with invalid coords.
-            continue
-        yield xyz(lat, lon), row
+
+    def __init__(self, inv_name):
+        """
+        `inv_name` is the filename of the .inv file; the tree is
+        loaded from its cache file, or built if the cache does not
+        exist or is out of date.
+        """
+
+        self.inv_name = inv_name
+        self.tree_name = inv_name + '.kdtree'
+        self.meta = metadata.Metadata(inv_name)
+        if not self.load():
+            self.build()
+
+    def build(self):
+        """
+        (Re-) build the tree from the .inv file and save it.
+        """
+
+        sys.stderr.write("Building k-d tree...\n")
+        meta = self.meta
+        points = [xyz(meta.lat[i], meta.lon[i]) + (i,)
+          for i in range(len(meta)) if meta.valid(i)]
+
+        def arrange(lo, hi, depth):
+            """Arrange points[lo:hi] as a subtree."""
+            if hi - lo < 2:
+                return
+            axis = depth % 3
+            points[lo:hi] = sorted(points[lo:hi], key=lambda p: p[axis])
+            mid = (lo + hi) // 2
+            arrange(lo, mid, depth + 1)
+            arrange(mid + 1, hi, depth + 1)
+        arrange(0, len(points), 0)
+
+        self.coords = array.array('d')
+        self.stations = array.array('q')
+        for x, y, z, i in points:
+            self.coords.extend((x, y, z))
+            self.stations.append(i)
+        self.n = len(points)
+
+        tmp = '%s.%d.tmp' % (self.tree_name, os.getpid())
+        with open(tmp, 'wb') as out:
+            st = ghcnm_cache.stamp(self.inv_name)
+            out.write(HEADER.pack(MAGIC, st[0], st[1], self.n))
+            self.coords.tofile(out)
+            self.stations.tofile(out)
+        os.replace(tmp, self.tree_name)
+        sys.stderr.write("Done building k-d tree...\n")
+
+    def load(self):
+        """
+        Load the tree from its cache file.  Returns False if it
+        does not exist or does not match the .inv file.
+        """
+
+        try:
+            f = open(self.tree_name, 'rb')
+        except IOError:
+            return False
+        with f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return False
+            magic, mtime, size, self.n = HEADER.unpack(header)
+            if (magic != MAGIC or
+              (mtime, size) != ghcnm_cache.stamp(self.inv_name)):
+                return False
+            self.coords = array.array('d')
+            self.coords.fromfile(f, 3 * self.n)
+            self.stations = array.array('q')
+            self.stations.fromfile(f, self.n)
+        return True
+
+    def row(self, i):
+        """The .inv row of station `i`."""
+
+        return self.meta.row(self.stations[i])
+
+    def search(self, target, visit):
+        """
+        Visit the nodes of the tree that may be close enough to
+        `target`.  `visit(d2, i)` is called for station `i`, at
+        squared distance `d2`; it returns the squared distance
+        beyond which nodes need no longer be visited.
+        """
+
+        coords = self.coords
+        tx, ty, tz = target
+        t = target
+
+        def search(lo, hi, depth, bound):
+            while lo < hi:
+                mid = (lo + hi) // 2
+                x, y, z = coords[3*mid:3*mid+3]
+                bound = visit((x-tx)**2 + (y-ty)**2 + (z-tz)**2, mid)
+                axis = depth % 3
+                diff = t[axis] - coords[3*mid+axis]
+                depth += 1
+                # Search the near side first; then the far side, but
+                # only if the splitting plane is close enough.
+                if diff < 0:
+                    bound = search(lo, mid, depth, bound)
+                    if diff*diff > bound:
+                        return bound
+                    lo = mid + 1
+                else:
+                    bound = search(mid + 1, hi, depth, bound)
+                    if diff*diff > bound:
+                        return bound
+                    hi = mid
+            return bound
+
+        search(0, self.n, 0, float('inf'))
+
+    def nearest(self, target, k):
+        """
+        Return the `k` stations nearest to `target` (an (x,y,z)
+        triple) as a list of (distance, i) pairs, nearest first.
+        """
+
+        # Max-heap (by negating) of the best k found so far.
+        best = []
+
+        def visit(d2, i):
+            if len(best) < k:
+                heapq.heappush(best, (-d2, -i))
+            elif -d2 > best[0][0]:
+                heapq.heapreplace(best, (-d2, -i))
+            if len(best) < k:
+                return float('inf')
+            return -best[0][0]
+
+        if k > 0:
+            self.search(target, visit)
+        return [((-d2)**0.5, -i) for d2, i in sorted(best, reverse=True)]
+
+    def within(self, target, distance):
+        """
+        Return the stations within `distance` (on the unit sphere)
+        of `target`, as per `nearest`.
+        """
+
+        found = []
+        bound = distance**2
+
+        def visit(d2, i):
+            if d2 <= bound:
+                found.append((d2**0.5, i))
+            return bound
+
+        self.search(target, visit)
+        return sorted(found)
 
 
 def xyz(lat, lon):
@@ -58,7 +246,6 @@ def xyz(lat, lon):
 
 
 def main(argv=None):
-    import codecs
     import getopt
     import glob
     import sys
@@ -67,19 +254,33 @@ def main(argv=None):
         argv = sys.argv
 
     inv = None
-    opt, arg = getopt.getopt(argv[1:], '', ['inv='])
+    k = 10
+    radius = None
+    batch = False
+    opt, arg = getopt.getopt(argv[1:], 'k:', ['inv=', 'radius=', 'batch'])
     for o,v in opt:
         if o == '--inv':
             inv = v
+        if o == '-k':
+            k = int(v)
+        if o == '--radius':
+            radius = float(v)
+        if o == '--batch':
+            batch = True
 
     if inv is None:
         pattern = os.path.expanduser("~/.local/share/data/ghcn/ghcnm*/*.inv")
         invs = glob.glob(pattern)
         inv = sorted(invs)[-1]
         sys.stderr.write("Using --inv {}\n".format(inv))
-    # See http://www.evanjones.ca/python-utf8.html for use of codecs.
-    with codecs.open(inv, 'r', 'iso8859-1') as inp:
-        nearest(arg[0], inp)
+    tree = Tree(inv)
+    if batch:
+        for line in sys.stdin:
+            target = line.strip()
+            if target:
+                nearest(target, tree, k, radius, prefix=target + ' ')
+    else:
+        nearest(arg[0], tree, k, radius)
 
 if __name__ == '__main__':
     main()
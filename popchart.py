@@ -11,28 +11,62 @@
 # Extensive Revision and an Update to 2001"; Journal of Climate; 2003.
 
 """
-popchart.py [ghcn.dat ...]
+popchart.py [--jobs N] [--months] [--element] [ghcn.dat ...]
 
 Tool to draw a googlechart of year versus number of data in that
 year.  See Jones and Moberg 2003 Figure 1 for an example.
 
 The inputs are files in GHCN-M v3 format.
+
+Normally the number of rows in each year is counted.  --months
+counts the number of valid monthly values instead.  --element
+draws a separate series for each element (TAVG, TMAX, ...) of
+each input.
+
+The inputs are read as a stream, one row at a time.  --jobs
+counts the inputs concurrently, in a pool of N processes (each
+input is also split into N shards); an input that is not a named
+file (stdin) is still read as a stream.
+
+The chart has a legend with the name of each input (and element,
+with --element).
 """
 
-import itertools
-import urllib
+import collections
+import os
+
+# ghcntool directory
+import compressed
+import shard
 
 prefix = 'http://chart.apis.google.com/chart'
 
-def popchart(inps, out):
+def popchart(inps, out, jobs=1, months=False, element=False):
     """
     Output googlechart URL on *out*. *inps* is a list of files in
-    GHCN-M v3 format (or v2 format).
+    GHCN-M v3 format (or v2 format).  When *jobs* is more than 1,
+    the inputs that are named files are counted concurrently (see
+    `count_files`); the others are counted here, as a stream.
+    *months* and *element* are as per `count`.
     """
 
+    inps = list(inps)
     # There is one "count" dict for each input, the dict maps from year
     # to count of rows for that year.
-    counts = [count(inp) for inp in inps]
+    counts = [None] * len(inps)
+    if jobs > 1:
+        files = [k for k, inp in enumerate(inps) if named_file(inp)]
+        for k, c in zip(files, count_files([inps[k].name for k in files],
+          jobs, months, element)):
+            counts[k] = c
+    counts = [c if c is not None else count(inp, months, element)
+      for c, inp in zip(counts, inps)]
+
+    names = [getattr(inp, 'name', '') for inp in inps]
+    if element:
+        # Split each count into a count for each element.
+        counts, names = by_element(counts, names)
+
     minyear = min(min(c) for c in counts)
     maxyear = max(max(c) for c in counts)
     most = max(max(c.values()) for c in counts)
@@ -45,11 +79,7 @@ def popchart(inps, out):
 
     data = '|'.join(','.join(map(str, l)) for l in seqs)
 
-    chdl=None
-    try:
-        chdl = '|'.join(inp.name for inp in inps)
-    except:
-        pass
+    chdl = '|'.join(names)
 
     d = dict(cht='bvg',
       chd='t:'+data,
@@ -71,6 +101,15 @@ def popchart(inps, out):
     url = prefix + '?' + '&'.join(map('='.join, d.items()))
     out.write(url+'\n')
 
+def named_file(inp):
+    """
+    True if *inp* was opened from a named file (which can be
+    opened again to count it in shards), not stdin, say.
+    """
+
+    name = getattr(inp, 'name', None)
+    return isinstance(name, str) and os.path.isfile(name)
+
 def reasonable_scale(x):
     """
     Calculate a limit (for the scale of the y-axis).  The result
@@ -88,37 +127,105 @@ def reasonable_scale(x):
         return 5*10**len(s[1:])
     return 10**len(s)
 
-def count(inp):
+def count(inp, months=False, element=False):
     """
     *inp* is a file in GHCN-M format (either v2 or v3).
-    Counts the number of rows in each year.
-    
+    Counts the number of rows in each year (or, if *months* is
+    true, the number of valid monthly values in each year).
+
     The result is a dict that maps from year (a number) to
-    count (also a number).
+    count (also a number).  If *element* is true, the dict maps
+    from (element, year) pairs instead (in GHCN-M v2, which has
+    no element, the element is always 'TAVG').
+
+    The rows are counted as they are read.
     """
 
-    def getyear(row):
+    res = collections.Counter()
+    for row in inp:
         if len(row) == 116:
             # GHCN-M v3
-            return row[11:15]
+            year = int(row[11:15])
+            elem = row[15:19]
+            first, width = 19, 8
         else:
             # GHCN-M v2
-            return row[12:16]
-    res = dict((int(year),len(list(rows))) for year,rows in
-      itertools.groupby(sorted(inp, key=getyear), getyear))
-    return res
+            year = int(row[12:16])
+            elem = 'TAVG'
+            first, width = 16, 5
+        if months:
+            n = sum(row[i:i+5] != '-9999'
+              for i in range(first, first + 12*width, width))
+        else:
+            n = 1
+        if element:
+            res[elem, year] += n
+        else:
+            res[year] += n
+    return dict(res)
+
+def by_element(counts, names):
+    """
+    Convert *counts*, a list of dicts (as returned by `count` with
+    *element* true), and *names*, their names, into a list of dicts
+    (one for each input and element) that map from year to count,
+    and a list of their names.
+    """
+
+    result = []
+    result_names = []
+    for c, name in zip(counts, names):
+        for elem in sorted(set(e for e, _ in c)):
+            result.append(dict((year, n) for (e, year), n in c.items()
+              if e == elem))
+            result_names.append(('%s %s' % (name, elem)).strip())
+    return result, result_names
+
+def count_files(names, jobs, months=False, element=False):
+    """
+    As `count`, but for each of the files called *names*, which are
+    counted concurrently in a pool of *jobs* processes.  A list of
+    dicts is returned.
+    """
+
+    counts = []
+    for results in shard.run_many(names, jobs, shard_count, months,
+      element):
+        total = collections.Counter()
+        for c in results:
+            total.update(c)
+        counts.append(dict(total))
+    return counts
+
+def shard_count(name, start, stop, months, element):
+    """
+    `count` a shard of the file *name*.
+    """
+
+    return count(shard.lines(name, start, stop), months, element)
 
 def main(argv=None):
+    import getopt
     import sys
     if argv is None:
         argv = sys.argv
 
-    arg = argv[1:]
+    opt, arg = getopt.getopt(argv[1:], '', ['jobs=', 'months', 'element'])
+    jobs = 1
+    key = {}
+    for k,v in opt:
+        if k == '--jobs':
+            jobs = int(v)
+        if k == '--months':
+            key['months'] = True
+        if k == '--element':
+            key['element'] = True
+
     if arg:
-        fs = map(open, arg)
+        fs = [compressed.open_input(name, 'r') for name in arg]
     else:
         fs = [sys.stdin]
-    popchart(fs, sys.stdout)
+    popchart(fs, sys.stdout, jobs, **key)
 
 if __name__ == '__main__':
     main()
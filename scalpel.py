@@ -19,11 +19,46 @@ child with the most recent data which has the privilege of
 retaining its parent ID.
 
 A new .dat file and a new .inv file are output.
+
+Usage:
+
+  scalpel.py [-N n] [--jobs J] -o out.dat in.dat
+  scalpel.py --sweep n,n,... [--jobs J] [-o out.dat] in.dat
+
+Normally N is 18 (the -N option changes it).  --sweep cuts the
+dataset for each of several values of N, reading the input once;
+the number of child stations (distinct ids, as in the .inv output)
+for each N is printed, and if -o is given a .dat and .inv file is
+output for each N (for out.dat and N=12 these are out-N12.dat and
+out-N12.inv).
+
+--jobs splits the input into J shards that are cut in parallel.
+
+The input can be compressed (in.dat.gz, say, in which case the
+.inv file is in.inv.gz).
 """
 
-import itertools
+import array
+import collections
+import os
 import sys
 
+# ghcntool directory
+import compressed
+import ghcnm_cache
+import ghcnm_write
+import shard
+
+# Marks invalid data.
+MISSING = ghcnm_cache.MISSING
+
+# The characters that replace a character of the parent's id, one
+# for each child, oldest first.
+LETTERS = 'abcdefghijklmnopqrstuvwxyz$@_%-^+!:/|~#='
+
+class Error(Exception):
+    pass
+
 class Config:
     """Just a blank struct to hold the config."""
 
@@ -31,127 +66,292 @@ config = Config()
 config.N = 18
 
 class Station:
+    """
+    A single station--element.  `data` is an array with 12 values
+    for each year, starting with January of `first_year`; invalid
+    values are MISSING.  `flags` holds the 3 flag characters of
+    each value (as bytes).  Children share their parent's `data`
+    and `flags`, and are described by the range of indexes
+    [start, stop) that belong to them.
+    """
+
     def __init__(self, **k):
-        self.data = []
         self.__dict__.update(k)
 
-    def add_row(self, row):
-        assert not hasattr(self, 'first_month')
-        year = int(row[11:15])
-        if not hasattr(self, 'first_year'):
-            self.first_year = year
-
-        # Subsequent rows must be for later years.
-        assert self.first_year + len(self.data) // 12 <= year
-
-        # If we skip a year, pad the data
-        while self.first_year + len(self.data) // 12 < year:
-            self.data.extend([None] * 12)
-        for m in range(12):
-            v = int(row[19+m*8:24+m*8])
-            if v == -9999:
-                self.data.append(None)
-            else:
-                self.data.append(int(v))
-
     def trim(self):
         """
-        Remove initial and trailing periods of repeated None.
-        (and modify the station from using .first_year to using
-        .first_month).
+        Set .start and .stop so that data[start:stop] excludes the
+        initial and trailing periods of MISSING.  Returns False if
+        there is no valid data at all.
+
+        (Also resets the gaps that are cached by .gaps()).
         """
 
-        # Months are numbered so that January of year 0 is 0.
-        first_month = self.first_year * 12
-        del self.first_year
-        while self.data[0] is None:
-            self.data = self.data[1:]
-            first_month += 1
-        while self.data[-1] is None:
-            self.data = self.data[:-1]
-        self.first_month = first_month
-
-    def write_ghcnm_v3(self, out):
+        self.gap_list = None
+
+        data = self.data
+        start = 0
+        stop = len(data)
+        while start < stop and data[start] == MISSING:
+            start += 1
+        while stop > start and data[stop-1] == MISSING:
+            stop -= 1
+        self.start = start
+        self.stop = stop
+        return start < stop
+
+    def gaps(self):
         """
-        Write out data to `out` in GHCN-M v3 format. Destroys
-        the data in self.data.
+        Return a list of the (start, stop) index range of each gap
+        (run of MISSING) in the (trimmed) station.  The list is
+        computed once, and shared by all the values of N that the
+        station is cut with.
         """
 
-        # Undo the trimming, by padding out to year boundaries.
-        while self.first_month % 12 != 0:
-            self.data = [None] + self.data
-            self.first_month -= 1
-        while len(self.data) % 12 != 0:
-            self.data.append(None)
-
-        while self.data:
-            year = self.first_month // 12
-            year_data = self.data[:12]
-            self.data = self.data[12:]
-            self.first_month += 12
-            if year_data == [None]*12:
-                # Whole year has invalid data, skip it.
-                continue
-            assert 11 == len(self.id)
-            assert 4 == len(self.element)
-            out.write("{}{:4d}{}{}\n".format(
-              self.id, year, self.element,
-              convert_to_ghcnm(year_data)))
-
-def convert_to_ghcnm(l):
-    """Convert 12 values in l to GHCN-M v3 format."""
-    def convert1(x):
-        if x is None:
-            return '-9999   '
-        else:
-            return '{:5d}   '.format(x)
+        if self.gap_list is not None:
+            return self.gap_list
+
+        data = self.data
+        self.gap_list = []
+        i = self.start
+        while True:
+            try:
+                i = data.index(MISSING, i, self.stop)
+            except ValueError:
+                break
+            j = i + 1
+            while data[j] == MISSING:
+                j += 1
+            self.gap_list.append((i, j))
+            i = j
+        return self.gap_list
+
+    def cuts(self, N):
+        """
+        Yield the (start, stop) index range of each child, oldest
+        first, when the (trimmed) station is cut at every gap of
+        length `N` or more.
+        """
+
+        start = self.start
+        for i, j in self.gaps():
+            if j - i >= N:
+                yield start, i
+                start = j
+        yield start, self.stop
 
-    assert 12 == len(l)
-    return ''.join(convert1(v) for v in l)
+    def write_ghcnm_v3(self, out, id=None, start=None, stop=None):
+        """
+        Write out data[start:stop] (by default, the whole trimmed
+        station) to `out` (a ghcnm_write.Writer) in GHCN-M v3
+        format, with the identifier `id` (by default, the
+        station's).  Each value is written with its flags, as they
+        were in the input.  The data are padded out to year
+        boundaries (with blank flags), and years that have no valid
+        data are skipped.
+        """
+
+        id = id or self.id
+        start = self.start if start is None else start
+        stop = self.stop if stop is None else stop
+        # Pad out to year boundaries.
+        first = start // 12
+        before = start - 12*first
+        after = -stop % 12
+        values = array.array('h', [MISSING] * before)
+        values.extend(self.data[start:stop])
+        values.extend([MISSING] * after)
+        flags = (b'   ' * before + self.flags[3*start:3*stop] +
+          b'   ' * after)
+        out.write_series(id, self.element, self.first_year + first,
+          values, flags)
 
 
 def scalpel(dat, inp_inv, out_dat, out_inv):
+    """
+    Cut the stations of `dat` (a GHCN-M v3 file, opened in binary
+    mode) and write them to `out_dat` (also binary).  The rows of
+    `inp_inv` are copied to `out_inv`, each followed by a row for
+    each of its children; this is done as the rows are read, so
+    the output is in the same order as the input.
+    """
+
     mutants = {}
-    for station in records(dat):
-        station.trim()
-
-        # Copy station data onto data, until we see a gap that's
-        # big enough to cut.
-        data = []
-        # The first month of the data in data[]
-        month = station.first_month
-        for gap, block in itertools.groupby(station.data, lambda x: x is None):
-            block = list(block)
-            if gap and len(block) >= config.N:
-                id = mutate(station.id, mutants)
-                child = Station(id=id,
-                  first_month=month,
-                  element=station.element, data=data)
-                child.write_ghcnm_v3(out_dat)
-                # Update month and reset data
-                month += len(data) + len(block)
-                data = []
-            else:
-                data.extend(block)
-        # This child, the most recent one, keeps its parent's id.
-        child = Station(id=station.id,
-          first_month=month,
-          element=station.element, data=data)
-        child.write_ghcnm_v3(out_dat)
+    with ghcnm_write.Writer(out_dat) as writer:
+        for station in records(dat):
+            if not station.trim():
+                continue
+            write_children(station, config.N, writer, mutants)
 
     # Write out the new inv file (which copies the inp_inv
     # file for each child of the parent).
-    inv = dict((row[:11], row) for row in inp_inv)
-    for id, row in sorted(inv.items()):
-        out_inv.write(row)
-        for child_id in mutants.get(id, []):
-            out_inv.write(bytes(child_id, 'ascii'))
-            out_inv.write(row[11:])
+    for row in inp_inv:
+        write_inv_row(row, mutants, out_inv)
+
+def sweep(dat, Ns, inp_inv=None, out=None):
+    """
+    Cut the stations of `dat` (as per `scalpel`) for each value of
+    N in `Ns`, reading `dat` once and finding the gaps of each
+    station once.  A dict that maps each N to the number of child
+    stations is returned.
+
+    If `out` is supplied, it is a dict that maps each N to an
+    (out_dat, out_inv) pair of output files, which are written as
+    per `scalpel` (`inp_inv` is required in that case).
+    """
+
+    out_dats = out and dict((N, out[N][0]) for N in Ns)
+    parents, gap_count, mutants = cut(dat, Ns, out_dats)
+    if out:
+        write_inv(inp_inv, Ns, mutants, out)
+    return child_counts(parents, gap_count, Ns)
+
+def sweep_file(name, Ns, inp_inv=None, out=None, jobs=1):
+    """
+    As `sweep`, but `name` is the name of the input file, which is
+    split into `jobs` shards that are cut in parallel.  The output
+    is the same as `sweep`'s.
+    """
+
+    import shutil
+
+    results = shard.run(name, jobs, shard_cut, Ns, out is not None)
+    parents = set()
+    gap_count = collections.Counter()
+    mutants = dict((N, {}) for N in Ns)
+    for shard_parents, shard_gap_count, shard_mutants, tmp in results:
+        parents.update(shard_parents)
+        gap_count.update(shard_gap_count)
+        for N in Ns:
+            mutants[N].update(shard_mutants[N])
+            if out:
+                with open(tmp[N], 'rb') as f:
+                    shutil.copyfileobj(f, out[N][0])
+                os.remove(tmp[N])
+    if out:
+        write_inv(inp_inv, Ns, mutants, out)
+    return child_counts(parents, gap_count, Ns)
+
+def shard_cut(name, start, stop, Ns, write):
+    """
+    `cut` a shard of the file `name`.  If `write` is true, the
+    children for each N are written to a temporary file.  A
+    (parents, gap_count, mutants, tmp) tuple is returned, where
+    `tmp` maps each N to the name of its temporary file.
+    """
+
+    import tempfile
+
+    tmp = {}
+    out_dats = None
+    if write:
+        out_dats = {}
+        for N in Ns:
+            out_dats[N] = tempfile.NamedTemporaryFile('wb',
+              prefix='scalpel', suffix='.dat', delete=False)
+            tmp[N] = out_dats[N].name
+    try:
+        result = cut(shard.lines(name, start, stop, binary=True),
+          Ns, out_dats)
+    finally:
+        for f in (out_dats or {}).values():
+            f.close()
+    return result + (tmp,)
+
+def cut(dat, Ns, out_dats=None):
+    """
+    Cut the stations of `dat` for each value of N in `Ns`.  If
+    `out_dats` is supplied, it maps each N to the file that the
+    children are written to.  A (parents, gap_count, mutants)
+    triple is returned: the set of station ids (a station with
+    several elements is one station), a Counter of the number of
+    gaps of each length, and a dict that maps each N to its
+    mutants (as per `mutate`).  Error is raised, as per `mutate`,
+    if a station would have too many children, even when the
+    children are not written.
+    """
+
+    mutants = dict((N, {}) for N in Ns)
+    # The number of mutated ids each station needs for the
+    # smallest N (which cuts the most).
+    needed = collections.Counter()
+    smallest = min(Ns)
+    # The number of gaps of each length.
+    gap_count = collections.Counter()
+    parents = set()
+    writers = dict((N, ghcnm_write.Writer(out_dats[N]))
+      for N in (Ns if out_dats else []))
+    for station in records(dat):
+        if not station.trim():
+            continue
+        parents.add(station.id)
+        lengths = [j - i for i, j in station.gaps()]
+        gap_count.update(lengths)
+        needed[station.id] += sum(1 for length in lengths
+          if length >= smallest)
+        check_mutants(station.id, needed[station.id])
+        for N, writer in writers.items():
+            write_children(station, N, writer, mutants[N])
+    for writer in writers.values():
+        writer.close()
+    return parents, gap_count, mutants
+
+def child_counts(parents, gap_count, Ns):
+    """
+    A dict that maps each N in `Ns` to the number of child
+    stations, given the set of `parents` and the Counter of gap
+    lengths `gap_count`.  Each gap of length N or more gives a
+    child with a new (mutated) id, even when the gap is in one of
+    several elements of a station, so this is the number of
+    distinct ids, and of rows, in the .inv file for N (for the
+    stations listed in the input .inv file).
+    """
+
+    return dict((N, len(parents) + sum(count for length, count in
+      gap_count.items() if length >= N)) for N in Ns)
+
+def write_inv(inp_inv, Ns, mutants, out):
+    """
+    Write the .inv file for each N in `Ns` (as per `sweep`).
+    """
+
+    for row in inp_inv:
+        for N in Ns:
+            write_inv_row(row, mutants[N], out[N][1])
+
+def write_children(station, N, out_dat, mutants):
+    """
+    Cut the (trimmed) `station` at every gap of length `N` or
+    more, and write each child to `out_dat` (a
+    ghcnm_write.Writer).  The mutated ids are
+    recorded in `mutants`.
+    """
+
+    cuts = list(station.cuts(N))
+    for start, stop in cuts[:-1]:
+        id = mutate(station.id, mutants)
+        station.write_ghcnm_v3(out_dat, id, start, stop)
+    # This child, the most recent one, keeps its parent's id.
+    start, stop = cuts[-1]
+    station.write_ghcnm_v3(out_dat, station.id, start, stop)
+
+def write_inv_row(row, mutants, out_inv):
+    """
+    Write the .inv `row` (bytes) to `out_inv`, followed by a copy
+    for each of its children in `mutants`.
+    """
+
+    out_inv.write(row)
+    for child_id in mutants.get(row[:11], []):
+        out_inv.write(bytes(child_id, 'ascii'))
+        out_inv.write(row[11:])
 
 def mutate(id, mutants):
     """
     Pick a mutated id, store the mutants as a list associated
-    with id in the dict of mutants.
+    with id in the dict of mutants.  Error is raised if `id` has
+    run out of mutated ids (it already has one for each of
+    LETTERS, which can happen when N is small).
     """
 
     # ASCIIbetically least character.
@@ -166,34 +366,33 @@ def mutate(id, mutants):
         mutants[bid] = [new_id]
         return new_id
 
-    letters = 'abcdefghijklmnopqrstuvwxyz$@_%-^+!:/|~#='
-    modified_t = letters[len(mutants[bid])]
+    check_mutants(id, len(mutants[bid]) + 1)
+    modified_t = LETTERS[len(mutants[bid])]
     new_id = id[:i] + modified_t + id[i+1:]
     mutants[bid].append(new_id)
     return new_id
 
-def records(inp):
+def check_mutants(id, n):
     """
-    Given `inp` in GHCN-M v3 format (or ISTI's variant), yield a
-    sequence of Station instances; where a station has several
-    elements recorded in the file (ISTI style), an instance for
-    each element will be yielded.
+    Raise Error if the station `id` cannot have `n` mutated ids.
     """
 
-    def get_id(l):
-        return l[:11]
+    if n > len(LETTERS):
+        raise Error("Station %s has too many children to give each a"
+          " mutated id (at most %d); cut with a larger N"
+          % (id, len(LETTERS)))
 
-    def get_elem(l):
-        return l[15:19]
+def records(inp):
+    """
+    Given `inp` in GHCN-M v3 format (or ISTI's variant), opened in
+    binary mode, yield a sequence of Station instances; where a
+    station has several elements recorded in the file (ISTI
+    style), an instance for each element will be yielded.
+    """
 
-    for id, station_block in itertools.groupby(inp, get_id):
-        sorted_by_element = sorted(station_block, key=get_elem)
-        for elem, rows in itertools.groupby(sorted_by_element, get_elem):
-            rows = list(rows)
-            station = Station(id=id, element=elem)
-            for row in rows:
-                station.add_row(row)
-            yield station
+    for id, element, first_year, data, flags in ghcnm_cache.parse(inp):
+        yield Station(id=id.decode('ascii'), element=element.decode('ascii'),
+          first_year=first_year, data=data, flags=bytes(flags))
 
 def main(argv=None):
     import getopt
@@ -201,30 +400,76 @@ def main(argv=None):
     if argv is None:
         argv = sys.argv
 
-    opt, arg = getopt.getopt(argv[1:], 'o:')
+    opt, arg = getopt.getopt(argv[1:], 'o:N:', ['sweep=', 'jobs='])
 
     out_dat_name = None
+    Ns = None
+    jobs = 1
     for k,v in opt:
+        if k == '--jobs':
+            jobs = int(v)
         if k == '-o':
             out_dat_name = v
+        if k == '-N':
+            config.N = int(v)
+        if k == '--sweep':
+            Ns = [int(n) for n in v.split(',')]
 
-    if out_dat_name is None:
+    if out_dat_name is None and Ns is None:
         raise Exception('-o thing.dat is required')
-    if out_dat_name.endswith('.dat'):
-        out_inv_name = out_dat_name[:-4] + '.inv'
-    else:
+    if out_dat_name is not None and not out_dat_name.endswith('.dat'):
         raise Exception('.dat file must end .dat')
 
-    if arg[0].endswith('.dat'):
-        inv_name = arg[0][:-4] + '.inv'
+    # A compressed in.dat.gz goes with in.inv.gz.
+    base, suffix = arg[0], ''
+    if compressed.compression(base):
+        base, suffix = os.path.splitext(base)
+    if base.endswith('.dat'):
+        inv_name = base[:-4] + '.inv' + suffix
     else:
         raise Exception('.dat file must end .dat')
 
-    with open(arg[0]) as dat, open(inv_name, 'rb') as inv,\
-          open(out_dat_name, 'w') as out_dat,\
+    if Ns is not None:
+        return main_sweep(arg[0], inv_name, Ns, out_dat_name, jobs)
+
+    out_inv_name = out_dat_name[:-4] + '.inv'
+    with compressed.open_input(arg[0]) as dat,\
+          compressed.open_input(inv_name) as inv,\
+          open(out_dat_name, 'wb') as out_dat,\
           open(out_inv_name, 'wb') as out_inv:
-        scalpel(dat, inv, out_dat, out_inv)
-        
+        if jobs > 1:
+            sweep_file(arg[0], [config.N], inv,
+              {config.N: (out_dat, out_inv)}, jobs)
+        else:
+            scalpel(dat, inv, out_dat, out_inv)
+
+def main_sweep(dat_name, inv_name, Ns, out_dat_name, jobs=1):
+    """
+    Run `sweep` on the named files and print the number of child
+    stations for each N.  When `out_dat_name` is not None, a
+    .dat and .inv file is written for each N.  `jobs` is as per
+    `sweep_file`.
+    """
+
+    import contextlib
+
+    with contextlib.ExitStack() as stack:
+        dat = stack.enter_context(compressed.open_input(dat_name))
+        inv = None
+        out = None
+        if out_dat_name is not None:
+            inv = stack.enter_context(compressed.open_input(inv_name))
+            out = {}
+            for N in Ns:
+                base = '%s-N%d' % (out_dat_name[:-4], N)
+                out[N] = (stack.enter_context(open(base + '.dat', 'wb')),
+                  stack.enter_context(open(base + '.inv', 'wb')))
+        if jobs > 1:
+            counts = sweep_file(dat_name, Ns, inv, out, jobs)
+        else:
+            counts = sweep(dat, Ns, inv, out)
+    for N in Ns:
+        print(N, counts[N])
 
 if __name__ == '__main__':
     main()
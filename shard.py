@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+"""
+Split a file in GHCN-M format into shards, so that it can be
+processed in parallel.
+
+Each shard is a range of bytes of the file that starts and ends on
+a station boundary (all the rows for a station are in the same
+shard), so any tool that processes stations independently can
+process shards independently.  The boundaries are taken from the
+binary index made by ghcnm_index.py when it is present and up to
+date, otherwise they are found by a quick scan near each guess.
+
+`run` is the usual entry point: it processes each shard in a pool
+of worker processes and returns the results in file order.  A
+compressed file cannot be split, so it is a single shard.
+"""
+
+import bisect
+import os
+
+# ghcntool directory
+import compressed
+import ghcnm_cache
+import ghcnm_index
+
+def station_id(line):
+    """The 11-digit station identifier of a row."""
+    return line[:11]
+
+def plan(name, jobs):
+    """
+    Plan `jobs` shards (or fewer, for a small file) of the GHCN-M
+    file `name`.  A list of (start, stop) byte ranges is returned.
+    """
+
+    if compressed.is_compressed(name):
+        # There is no way to start part way through; the whole
+        # file is one shard.
+        return [(0, None)]
+    size = os.path.getsize(name)
+    if jobs <= 1 or size == 0:
+        return [(0, size)]
+    guesses = [size * k // jobs for k in range(1, jobs)]
+    starts = index_starts(name)
+    with open(name, 'rb') as f:
+        bounds = [0]
+        for at in guesses:
+            if starts:
+                i = bisect.bisect_left(starts, at)
+                b = starts[i] if i < len(starts) else size
+            else:
+                b = next_boundary(f, at)
+            if bounds[-1] < b < size:
+                bounds.append(b)
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+def index_starts(name):
+    """
+    Return the sorted offsets of the first row of each station in
+    `name`, according to its binary index; or None if there is no
+    up to date index.
+    """
+
+    try:
+        index = ghcnm_index.BinaryIndex(name + '.bindex',
+          ghcnm_cache.stamp(name))
+    except (IOError, ghcnm_index.Error):
+        return None
+    entries = sorted((entry.whence, entry.id) for entry in
+      (index.entry(i) for i in range(index.n)))
+    index.close()
+    starts = []
+    prev = None
+    for whence, id in entries:
+        # Several records (GHCN-M v2), or several elements, can
+        # belong to one station.
+        if station_id(id) != prev:
+            starts.append(whence)
+            prev = station_id(id)
+    return starts
+
+def next_boundary(f, at):
+    """
+    For the file `f` (opened in binary mode), return the offset of
+    the first row at or after `at` that belongs to a different
+    station from the row before it; or the size of the file if
+    there is none.
+    """
+
+    f.seek(max(0, at - 1))
+    # Skip to the start of the next row.
+    if at > 0:
+        f.readline()
+    line = f.readline()
+    id = station_id(line)
+    while line:
+        whence = f.tell()
+        line = f.readline()
+        if station_id(line) != id:
+            return whence
+    return f.tell()
+
+def lines(name, start, stop, binary=False):
+    """
+    Yield the rows of the file `name` from offset `start` up to
+    offset `stop` (None for the end of the file).  The rows are
+    bytes if `binary` is true, otherwise strings.
+    """
+
+    if stop is None:
+        stop = float('inf')
+    with compressed.open_input(name) as f:
+        f.seek(start)
+        at = start
+        while at < stop:
+            line = f.readline()
+            if not line:
+                break
+            at += len(line)
+            if binary:
+                yield line
+            else:
+                yield line.decode('iso8859-1')
+
+def run(name, jobs, worker, *args):
+    """
+    Plan shards of the file `name` and call
+    worker(name, start, stop, *args) for each, in a pool of `jobs`
+    processes.  `worker` must be a module-level function.  A list of
+    its results is returned, in file order.
+    """
+
+    return run_many([name], jobs, worker, *args)[0]
+
+def run_many(names, jobs, worker, *args):
+    """
+    As `run`, but for each of the files in `names`; the shards of
+    all the files share one pool, so the files are processed
+    concurrently.  A list with one element for each file is
+    returned, each element being the list of results for that file.
+    """
+
+    tasks = []
+    # The index into `names` of each task.
+    owner = []
+    for i, name in enumerate(names):
+        for start, stop in plan(name, jobs):
+            tasks.append((name, start, stop) + args)
+            owner.append(i)
+    results = starmap(worker, tasks, jobs)
+    grouped = [[] for name in names]
+    for i, result in zip(owner, results):
+        grouped[i].append(result)
+    return grouped
+
+def starmap(worker, tasks, jobs):
+    """
+    Call worker(*task) for each of `tasks`, in a pool of `jobs`
+    processes, and return a list of the results in order.
+    """
+
+    import multiprocessing
+
+    if jobs <= 1 or len(tasks) <= 1:
+        return [worker(*task) for task in tasks]
+    pool = multiprocessing.Pool(min(jobs, len(tasks)))
+    try:
+        return pool.starmap(worker, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+def istarmap(worker, tasks, jobs):
+    """
+    As `starmap`, but yield the results in order as they become
+    available, so that they need not all be held at once.
+    """
+
+    import multiprocessing
+
+    if jobs <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield worker(*task)
+        return
+    pool = multiprocessing.Pool(min(jobs, len(tasks)))
+    try:
+        for result in pool.imap(call, [(worker,) + tuple(task)
+          for task in tasks]):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def call(task):
+    """Call task[0] with the rest of `task` as its arguments (for
+    `istarmap`; it must be a module-level function)."""
+
+    return task[0](*task[1:])
+
+def plan_aligned(names, jobs):
+    """
+    Plan shards of several GHCN-M files, each sorted by station,
+    that are aligned: shard k of every file holds the same range of
+    station identifiers, so that the files can be compared (or
+    merged) shard by shard.  The shards of the first file are
+    planned by `plan`, and the others are cut at the same
+    stations.  A list with a tuple of (start, stop) ranges (one for
+    each file) for each shard is returned.
+    """
+
+    if any(compressed.is_compressed(name) for name in names):
+        return [tuple((0, None) for name in names)]
+    first = plan(names[0], jobs)
+    with open(names[0], 'rb') as f:
+        ids = []
+        for start, _ in first[1:]:
+            f.seek(start)
+            ids.append(station_id(f.readline()))
+    columns = [first]
+    for name in names[1:]:
+        size = os.path.getsize(name)
+        with open(name, 'rb') as f:
+            bounds = [0] + [find_id(f, size, id) for id in ids] + [size]
+        columns.append(list(zip(bounds, bounds[1:])))
+    return list(zip(*columns))
+
+def find_id(f, size, id):
+    """
+    For the file `f` (opened in binary mode, `size` bytes long and
+    sorted by station), return the offset of the first row whose
+    station identifier is not less than `id` (bytes), found by a
+    binary search over offsets.
+    """
+
+    lo, hi = 0, size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        f.seek(ghcnm_index.line_start(f, mid))
+        line = f.readline()
+        if not line or station_id(line) >= id:
+            hi = mid
+        else:
+            lo = mid + 1
+    return ghcnm_index.line_start(f, lo)
@@ -5,7 +5,7 @@
 # David Jones, Ravenbrook Limited, 2010-02-26
 
 """
-python ghcn_split.py YYYY
+python ghcn_split.py [--jobs N] YYYY[,YYYY...] [ghcnm.dat]
 
 Splits a GHCN-M file, on stdin, into two files: ghcnm-preYYYY,
 ghcnm-postYYYY.  The split is made on the basis of which stations are
@@ -13,49 +13,245 @@ reporting in the year YYYY or a more recent year.  ghcnm-postYYYY will
 contain records for all the stations that have a record in the year YYYY
 or a more recent year; ghcnm-preYYYY will contain the records for all
 the other stations.
+
+Several years can be given, separated by commas, to split the file
+into one more file than there are years, in a single pass.  For
+the years A and B (A before B), ghcnm-preA has the stations whose
+last year is before A, ghcnm-A-B those whose last year is A or
+later but before B, and ghcnm-postB those whose last year is B or
+later.
+
+The input can be named instead of being on stdin.  In that case
+the stations and their last years are found using the binary index
+of the file (see ghcnm_index.py; it is built, using N processes,
+if it is missing or out of date), and each station's rows are
+copied to its output file as a range of bytes, without being read
+into Python (with os.copy_file_range, or os.sendfile, where they
+work).  A compressed input is split as stdin is.
 """
 
-def get_year(line):
-    if len(line) == 116:
-        # GHCN-M v3
-        return int(line[11:15])
-    else:
-        # GHCN-M v2
-        return int(line[12:16])
+import bisect
+import errno
+import itertools
+import os
 
-def split(inp, out, splitat):
-    """Input flle: *inp*;
-    Output files: *out* (a pair);
-    The year used to split the stations: *splitat*.
+# ghcntool directory
+import compressed
+import ghcnm_cache
+import ghcnm_index
+
+# Largest number of bytes copied by one system call.
+COPY_CHUNK = 1 << 30
+
+# The ways of copying a range of bytes, fastest first.  A way that
+# is not supported for the files in hand is dropped (see
+# `copy_range`).
+copiers = ['copy_file_range', 'sendfile', 'pread']
+
+def id_length(row, name=None):
+    """
+    The length of the record identifier (11 for GHCN-M v3, 12 for
+    v2) of a GHCN-M file: guessed from the file's *name* if it is
+    given (as per ghcnm_index.id_length), otherwise (or if the name
+    does not tell) from *row*, one of its rows.  In GHCN-M v3 the
+    element (letters) follows the 11 character identifier and the
+    year; in v2, those columns are digits.  Unlike the length of
+    the row, this does not depend on the line ending, or on a
+    missing newline at the end of the file.
+    """
+
+    if name is not None:
+        try:
+            return ghcnm_index.id_length(name)
+        except ghcnm_index.Error:
+            pass
+    if row[15:19].isalpha():
+        return 11
+    return 12
+
+def get_year(line, n=None):
     """
+    The year of the row *line*, whose record identifier is *n*
+    characters long (if None, it is found from the row, as per
+    `id_length`).
+    """
+
+    if n is None:
+        n = id_length(line)
+    return int(line[n:n+4])
+
+def id11(line):
+    """
+    The 11-digit station identifier for a record.
+    """
+    return line[:11]
+
+def cutoffs(splitat):
+    """The sorted list of years to split at, given *splitat*, a
+    single year or a sequence of them."""
+
+    if isinstance(splitat, int):
+        return [splitat]
+    return sorted(splitat)
+
+def bucket(year, splitat):
+    """The index of the output file for a station whose last year
+    is *year*, given the sorted list of years *splitat*."""
+
+    return bisect.bisect_right(splitat, year)
 
-    import itertools
+def bucket_names(splitat):
+    """The names of the output files for the years *splitat*."""
 
-    def id11(line):
-        """
-        The 11-digit station identifier for a record.
-        """
-        return line[:11]
+    splitat = cutoffs(splitat)
+    return (['ghcnm-pre%d' % splitat[0]] +
+      ['ghcnm-%d-%d' % pair for pair in zip(splitat, splitat[1:])] +
+      ['ghcnm-post%d' % splitat[-1]])
 
+def split(inp, out, splitat, name=None):
+    """Input flle: *inp*;
+    Output files: *out* (one more than there are years to split at);
+    The year (or a sequence of years) used to split the stations:
+    *splitat*.
+    The name of the input, if it has one: *name* (see `id_length`).
+    """
+
+    splitat = cutoffs(splitat)
+    # The length of the identifier, found from the first row.
+    n = None
     for stationid,lines in itertools.groupby(inp, id11):
         lines = list(lines)
-        # Gather the set of years for which there are records (across
-        # all duplicates for a single station, if using GHCN-M v2).
-        years = set(get_year(line) for line in lines)
-        if max(years) >= splitat:
-            out[1].writelines(lines)
+        if n is None:
+            n = id_length(lines[0], name)
+        # The last year for which there are records (across all
+        # duplicates for a single station, if using GHCN-M v2).
+        last = max(get_year(line, n) for line in lines)
+        out[bucket(last, splitat)].writelines(lines)
+
+def split_file(name, out, splitat, jobs):
+    """As `split`, but the input is the file called *name*, and
+    *out* is a list of files opened in binary mode.  The stations
+    are found with the binary index (which is built with *jobs*
+    processes if need be), and copied as ranges of bytes.  A
+    compressed input is decompressed and split as per `split`.
+    """
+
+    if compressed.is_compressed(name):
+        with compressed.open_input(name) as inp:
+            return split(inp, out, splitat, name)
+    splitat = cutoffs(splitat)
+    with open(name, 'rb') as inp:
+        ranges = []
+        for start, stop, last in stations(name, inp, jobs):
+            which = bucket(last, splitat)
+            if ranges and ranges[-1][2] == which and ranges[-1][1] == start:
+                # Extend the previous range.
+                ranges[-1] = (ranges[-1][0], stop, which)
+            else:
+                ranges.append((start, stop, which))
+        for f in out:
+            f.flush()
+        for start, stop, which in ranges:
+            copy_range(inp.fileno(), out[which].fileno(), start, stop)
+
+def stations(name, inp, jobs=1):
+    """
+    Return a list of (start, stop, last) triples, one for each
+    station in the GHCN-M file *name* (opened as *inp*, in binary
+    mode), in file order: the range of bytes holding its rows, and
+    the last year for which it has a record.  The blocks are taken
+    from the binary index, and the last year of each block from its
+    last row.
+    """
+
+    stamp = ghcnm_cache.stamp(name)
+    try:
+        index = ghcnm_index.BinaryIndex(name + '.bindex', stamp)
+    except (IOError, ghcnm_index.Error):
+        ghcnm_index.build_file(name, jobs)
+        index = ghcnm_index.BinaryIndex(name + '.bindex', stamp)
+    entries = sorted((entry.whence, entry.length, id11(entry.id))
+      for entry in (index.entry(i) for i in range(index.n)))
+    index.close()
+    # As with `split`, a station is a run of adjacent blocks with
+    # the same 11-digit identifier (several elements, or several
+    # GHCN-M v2 records).
+    result = []
+    prev = None
+    n = None
+    for whence, length, id in entries:
+        stop = whence + length
+        row = last_row(inp, whence, stop)
+        if n is None:
+            n = id_length(row, name)
+        last = get_year(row, n)
+        if id == prev:
+            start, _, year = result[-1]
+            result[-1] = (start, stop, max(year, last))
         else:
-            out[0].writelines(lines)
+            result.append((whence, stop, last))
+            prev = id
+    return result
+
+def last_row(inp, start, stop):
+    """The last row (with its newline) of the block of rows from
+    *start* to *stop* of the file *inp*."""
+
+    # Long enough for any GHCN-M row.
+    size = min(stop - start, 256)
+    data = os.pread(inp.fileno(), size, stop - size)
+    return data[data.rfind(b'\n', 0, len(data) - 1) + 1:]
+
+def copy_range(src, dst, start, stop):
+    """
+    Copy the bytes from *start* to *stop* of the file descriptor
+    *src* to the current position of the file descriptor *dst*.
+    """
+
+    while start < stop:
+        count = min(stop - start, COPY_CHUNK)
+        way = copiers[0]
+        try:
+            if way == 'copy_file_range':
+                n = os.copy_file_range(src, dst, count, start)
+            elif way == 'sendfile':
+                n = os.sendfile(dst, src, start, count)
+            else:
+                n = os.write(dst, os.pread(src, min(count, 1 << 24), start))
+        except (AttributeError, OSError) as e:
+            if way == 'pread' or (isinstance(e, OSError) and e.errno not in
+              (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF,
+              errno.EOPNOTSUPP, errno.ENOTSUP)):
+                raise
+            # Not supported here (or, for AttributeError, by this
+            # Python or OS).  Nothing has been copied, so try the
+            # next way.
+            copiers.remove(way)
+            continue
+        if n == 0:
+            raise IOError("Unexpected end of file at %d" % start)
+        start += n
 
 def main(argv=None):
+    import getopt
     import sys
     if argv is None:
         argv = sys.argv
 
-    year = int(argv[1])
-    out = [open('ghcnm-pre%d' % year, 'w'),
-           open('ghcnm-post%d' % year, 'w')]
+    opt, arg = getopt.getopt(argv[1:], '', ['jobs='])
+    jobs = 1
+    for k,v in opt:
+        if k == '--jobs':
+            jobs = int(v)
+
+    year = [int(y) for y in arg[0].split(',')]
+    names = bucket_names(year)
+
+    if len(arg) > 1:
+        out = [open(name, 'wb') for name in names]
+        return split_file(arg[1], out, year, jobs)
 
+    out = [open(name, 'w') for name in names]
     return split(sys.stdin, out, year)
 
 if __name__ == '__main__':
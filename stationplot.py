@@ -1,11 +1,11 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # stationplot.py
 #
 # David Jones, Clear Climate Code, 2010-03-04
 # David Jones, Climate Code Foundation, 2014-07
 #
-# Require Python 2.6.
+# Requires Python 3.
 #
 # For testing purposes it might be interesting to note the following:
 # 61710384000 longest timespan
@@ -17,8 +17,10 @@
 
 """
 Usage: python stationplot.py [options] station-id
+       python stationplot.py [options] --batch directory [-j N] station-id ...
 
 The options are:
+  [--batch directory] [-j jobs]
   [-c config]
   [--colour blue,black,...]
   [-d input/ghcnm.tavg.qca.dat]
@@ -26,6 +28,7 @@ The options are:
   [--mode anom] [-a] [-y]
   [-o file.svg]
   [--offset 0,+0.2]
+  [--reject Q]
   [-t YYYY,YYYY]
   [--title title]
   [-s 0.01]
@@ -77,8 +80,19 @@ Normally the input data is scaled according to the GHCN-M TAVG
 convention (units of 0.01C for v3, 0.1C for v2).  The -s option
 can be used to specify a different sized unit.
 
+The --reject option treats values in a GHCN-M v3 input as invalid
+when their flags match the mask given (for example, 'Q' rejects
+every value with a QCFLAG; see ghcnm_cache.parse_mask).
+
 The -c option can be used to set various configuration options.  Best to
 examine the source code for details.
+
+The --batch option plots each station-id to its own SVG file,
+station-id.svg, in the given directory (which is created if
+necessary).  The station-id "all" plots every station in the input.
+The input and the metadata are only opened once, and the plots are
+shared among a pool of worker processes, one per CPU unless the -j
+option specifies the number.  The other options apply to every plot.
 """
 
 import codecs
@@ -86,6 +100,12 @@ import math
 import os
 import sys
 
+# ghcntool directory
+import anomaly
+import compressed
+import ghcnm_cache
+import metadata
+
 # :todo: Should really import this from somewhere.  Although this BAD
 # value is entirely internal to this module.
 BAD = 9999
@@ -162,10 +182,6 @@ gray
 #a6cee3
 """.split()
 
-# https://docs.python.org/2/library/itertools.html#recipes
-def grouper(seq, n):
-    return zip(*[iter(seq)]*n)
-
 def curves(series, K):
     """
     `series` is a (data,begin,axis) tuple (axis is ignored).
@@ -238,7 +254,7 @@ def treat_mode(datadict, mode):
         return dict(datadict)
 
     result = {}
-    for key, tupl in datadict.iteritems():
+    for key, tupl in datadict.items():
         data = tupl[0]
         if mode == 'anom':
             data, _ = as_monthly_anomalies(data)
@@ -275,7 +291,8 @@ def treat_offset(datadict, stations, offset):
     return result
 
 def plot(stations, out, meta, colour=[], timewindow=None, mode='temp',
-  offset=None, scale=None, caption=None, title=None, axes=None):
+  offset=None, scale=None, caption=None, title=None, axes=None,
+  sources=None, masks=None):
     """
     Create a plot of the stations specified in the list `stations`
     (each element is a `Station` instance that has a `source`
@@ -291,6 +308,10 @@ def plot(stations, out, meta, colour=[], timewindow=None, mode='temp',
     that have a time t where y1 <= t < y2 are displayed.  Normally y1
     and y2 are years in which case records from the beginning of y1 up
     to the beginning of y2 are displayed.
+
+    `meta`, `sources` and `masks` are as per `get_meta` and
+    `select_records`.  The time window is passed down to
+    `select_records`, so that rows outside it are not read.
     """
 
     import itertools
@@ -299,7 +320,8 @@ def plot(stations, out, meta, colour=[], timewindow=None, mode='temp',
     def valid(datum):
         return datum != BAD
 
-    datadict = select_records(stations, axes=axes, scale=scale)
+    datadict = select_records(stations, axes=axes, scale=scale,
+      sources=sources, masks=masks, timewindow=timewindow)
 
     if not datadict:
         raise Error('No data found for %r' % stations)
@@ -329,7 +351,7 @@ def plot(stations, out, meta, colour=[], timewindow=None, mode='temp',
     for _,(data,begin,axis) in datadict.items():
         minyear = min(minyear, begin)
         limyear = max(limyear, begin + (len(data)//K))
-        valid_data = filter(valid, data)
+        valid_data = [datum for datum in data if valid(datum)]
         ahigh = max(valid_data)
         alow = min(valid_data)
         axismax[axis] = max(axismax[axis], ahigh)
@@ -767,40 +789,23 @@ def get_meta(stations, meta):
     extracted from the file `meta`.  A dictionary is returned that
     maps from 11-digit id to an info dictionary.  The info
     dictionary has keys: name, lat, lon (and maybe more in future).
+
+    `meta` can also be a dictionary, or an object already
+    returned by `read_meta`, so that the file is only opened once
+    when plotting many stations.
     """
 
     # :todo: it only ends up using one metadata file; really
     # ought to allow different stations to have different metadata
     # files.
 
-    sources = [s.source for s in stations]
-    for source in sources:
-        m = open_metafile(meta, source)
-        if m:
-            break
-    meta = m
-    if not meta:
+    if isinstance(meta, (dict, metadata.Metadata)):
+        full = meta
+    else:
+        full = read_meta(meta, [s.source for s in stations])
+    if full is None:
         return
 
-    full = {}
-    for line in meta:
-        id = line[:11]
-        # Guess the format, v2 or v3, from the line length.
-        if len(line) in (69, 108):
-            # 108 is true GHCN-M v3.
-            # 69 is ISTI's emulation of GHCN-M v3 format.
-            full[id] = dict(
-                name=line[38:70].strip(),
-                lat=float(line[12:20]),
-                lon=float(line[21:30]),
-            )
-        else:
-            # GHCN-M v2
-            full[id] = dict(
-                name = line[12:42].strip(),
-                lat = float(line[43:49]),
-                lon = float(line[50:57]),
-            )
     d = {}
     ids = set(s.id[:11] for s in stations)
     for id11 in ids:
@@ -808,6 +813,21 @@ def get_meta(stations, meta):
             d[id11] = full[id11]
     return d
 
+def read_meta(meta, sources):
+    """
+    Open the metadata file `meta` (a filename, or None to pick a
+    default based on the names in `sources`), and return a
+    metadata.Metadata instance, which maps from 11-digit id to an
+    info record (as per `get_meta`).  The file is parsed once and
+    cached (see the `metadata` module).  None is returned if there
+    is no metadata file.
+    """
+
+    for source in sources:
+        name = metafile_name(meta, source)
+        if name:
+            return metadata.Metadata(name)
+
 def aspath(l):
     """
     Encode a list of data points as an SVG path element.  The element
@@ -893,7 +913,7 @@ def from_months(months):
     return (series, begin)
 
 
-def from_lines(lines, scale=None):
+def from_lines(lines, scale=None, masks=None):
     """
     *lines* is a list of lines (strings) that comprise a station's
     entire record.  The lines are expected to be an extract from a
@@ -913,6 +933,9 @@ def from_lines(lines, scale=None):
 
     In the case of ISTI files (in either GHCN-M v3 format or
     native ISTI format), only TAVG values are extracted.
+
+    If *masks* (as returned by ghcnm_cache.parse_mask) is given,
+    GHCN-M v3 values whose flags it rejects are also BAD.
     """
 
     # :todo: it is a bit ugly that this function handles both
@@ -962,7 +985,7 @@ def from_lines(lines, scale=None):
             # "8009991400101971" (this bug in the data file is
             # believe to be functionally extinct as of 2014).
             if line == prevline:
-                print "NOTE: repeated record found: Station %s year %s; data are identical" % (line[:12],line[12:16])
+                sys.stderr.write("NOTE: repeated record found: Station %s year %s; data are identical\n" % (line[:12],line[12:16]))
                 continue
             # This is unexpected.
             if 'v2' == format:
@@ -985,7 +1008,9 @@ def from_lines(lines, scale=None):
                 # GHCN-M v2
                 datum = int(line[16+5*m:21+5*m])
                 default_scale = 0.1
-            if datum == -9999:
+            if datum == -9999 or (masks and len(line) == 116 and
+              ghcnm_cache.rejected(
+                line[24+8*m:27+8*m].encode('iso8859-1'), masks)):
                 datum = BAD
             else:
                 # Convert to floating point and degrees C.
@@ -1001,6 +1026,34 @@ def from_lines(lines, scale=None):
     if months:
         return from_months(months)
 
+def from_window(rows, span, timewindow, scale=None, masks=None):
+    """
+    *rows* are the rows of a station's record for the years in
+    *timewindow* only, and *span* is the (first, last) pair of
+    years of the whole record, as returned by
+    ghcnm_index.File.get_window.  A (*series*, *begin*) pair is
+    returned that is the same as `window` makes of the whole record
+    (parsed by `from_lines`, with *scale* and *masks*): the years
+    in the window that are within the record, and no others, with
+    BAD where there are no rows.  If there are none, *series* is
+    empty and *begin* is the start of the window.
+    """
+
+    # Number of data items per year.
+    K = 12
+
+    t1,t2 = timewindow
+    first,last = span
+    begin = max(first, t1)
+    end = min(last + 1, t2)
+    if end <= begin:
+        return [], t1
+    if not rows:
+        return [BAD]*K*(end-begin), begin
+    data,year = from_lines(rows, scale, masks)
+    after = end - year - len(data)//K
+    return [BAD]*K*(year-begin) + list(data) + [BAD]*K*after, begin
+
 def as_monthly_anomalies(data):
     """
     Convert `data`, which should be a sequence of monthly values,
@@ -1010,105 +1063,101 @@ def as_monthly_anomalies(data):
     subtracting that from each corresponding monthly datum.
 
     A pair of (monthly_anomalies, climatology) is returned.
-    """
-
-    import itertools
 
-    # One mean for each of 12 months.
-    climatology = []
-    for m in range(12):
-        monthly_data = [data[i] for i in range(m, len(data), 12)]
-        monthly_data = [datum for datum in monthly_data if datum != BAD]
-        if monthly_data:
-            mean = float(sum(monthly_data)) / len(monthly_data)
-        else:
-            mean = BAD
-        climatology.append(mean)
-
-    def sub1(datum, mean):
-        """
-        Subtract mean from datum, taking into account BAD data.
-        """
-        if datum == BAD:
-            return BAD
-        return datum - mean
+    The work is done by the `anomaly` module.
+    """
 
-    anomalies = [sub1(datum, mean)
-      for datum, mean in zip(data, itertools.cycle(climatology))]
-    return anomalies, climatology
+    return anomaly.monthly_anomalies(data, BAD)
 
 def as_annual_anomalies(data):
     """
     A pair of (annual_anomalies, annual_average) is returned.
     """
-    monthlies, average_monthly_temp = as_monthly_anomalies(data)
-    yearly_blocks = grouper(monthlies, 12)
-
-    def mean12(data):
-        good_data = [x for x in data if x != BAD]
-        if len(good_data) < 6:
-            return BAD
-        return sum(good_data) / float(len(good_data))
 
-    annual_anomalies = [mean12(block) for block in yearly_blocks]
-    return annual_anomalies, mean12(average_monthly_temp)
+    return anomaly.annual_anomalies(data, BAD)
 
 def as_annual_temps(data):
-    anoms, average_temp = as_annual_anomalies(data)
-    def to_temp(d):
-        if d == BAD:
-            return d
-        return d + average_temp
-    return [to_temp(d) for d in anoms]
+    return anomaly.annual_temps(data, BAD)
 
 # :todo: fix for GHCN-M v2. It used to produce multiple results,
 # one for each duplicate of a station.
-def select_records(stations, axes, scale=None):
+def select_records(stations, axes, scale=None, sources=None,
+  masks=None, timewindow=None):
     """
     `stations` should be a list of `Station` instances.
     
     The records for these stations are extracted
     and returned as a dictionary that maps `Station` instance to
     (data,begin,axis) tuple.
-    """
 
-    sources = [s.source for s in stations]
+    `sources`, if supplied, is a dict that maps from source name to
+    an object already returned by `fast_access`.
+
+    `masks`, if supplied, is as per `from_lines` (it does not apply
+    to ISTI stage 2 files, which have no such flags).
+
+    `timewindow`, if supplied, is as per `window`: only the rows for
+    the years in it are read, where the source allows it, and each
+    record is as `window` would make it (see `from_window`).  A
+    record with no data in the window has an empty series, which
+    `window` drops.
+    """
 
     # dict of indexed record files.
-    index = dict((source, fast_access(source)) for source in sources)
+    index = dict(sources or {})
+    for station in stations:
+        if station.source not in index:
+            index[station.source] = fast_access(station.source)
 
     table = {}
     if not axes:
         axes = 'y' * len(stations)
 
     for station,axis in zip(stations, axes):
-        for id12,rows in index[station.source].get(station.id):
-            data,begin = from_lines(rows, scale)
+        access = index[station.source]
+        if hasattr(access, 'get_series'):
+            series = access.get_series(station.id, scale, timewindow)
+            if series:
+                table[station] = series + (axis,)
+            continue
+        if timewindow is not None and hasattr(access, 'get_window'):
+            for id12,rows,span in access.get_window(station.id,
+              timewindow, 'TAVG'):
+                if span is None:
+                    continue
+                data,begin = from_window(rows, span, timewindow, scale,
+                  masks)
+                table[station] = (data,begin,axis)
+            continue
+        for id12,rows in access.get(station.id):
+            data,begin = from_lines(rows, scale, masks)
             table[station] = (data,begin,axis)
 
     return table
 
-class ISTI_data:
-    def __init__(self, source):
-        self.source = source
-
-    def get(self, id):
-        yield (id, open(self.source).readlines())
-
 def fast_access(source):
     """
     Arrange "fast access" to the file of station records `source`.
     The protocol is that this function returns an object with a
     .get() method, which when called with a station id returns
     a sequence of (id, rows) pairs.
+
+    The object may also have a .get_series() method, which when
+    called with a station id, `scale` and a time window (as per
+    `window`; or None) returns the record already converted and
+    windowed, as a (data, begin) pair (as per `from_lines`), or
+    None.  When it has, it is used instead of .get().  Otherwise,
+    when a time window is given, a .get_window() method (as per
+    ghcnm_index.File.get_window) is used if it has one.
     """
 
     # ghcntool directory
     import ghcnm_index
+    import isti
 
     if source.endswith("_monthly_stage2"):
-        # An ISTI record, which is not optimised.
-        return ISTI_data(source)
+        # An ISTI record.
+        return isti.Stage2(source)
     else:
         return ghcnm_index.File(source)
 
@@ -1186,29 +1235,32 @@ def parse_topt(v):
     comma.  A pair of years is returned.
     """
 
-    return map(int, v.split(','))
+    return [int(y) for y in v.split(',')]
 
-def open_metafile(metafile, inp):
+def metafile_name(metafile, inp):
     """
-    `metafile` and `inp` are both filenames.
+    `metafile` and `inp` are both filenames.  Return the name of
+    the metadata file to use for the input `inp`: `metafile` if it
+    is supplied, otherwise the first of a series of defaults that
+    exists, or None.
     """
 
     if metafile:
-        # Name of metafile supplied. Open it.
-        return open(metafile)
+        return metafile
 
     # A series of defaults to try...
     names = ['input/v3.inv', 'input/v2.inv']
-    # ... including a default based on the name of the input.
-    if inp.endswith('.dat'):
-        metaname = inp[:-4] + '.inv'
+    # ... including a default based on the name of the input (a
+    # compressed input.dat.gz goes with input.inv.gz).
+    base, suffix = inp, ''
+    if compressed.compression(inp):
+        base, suffix = os.path.splitext(inp)
+    if base.endswith('.dat'):
+        metaname = base[:-4] + '.inv' + suffix
         names = [metaname] + names
     for name in names:
-        try:
-            metafile = open(name)
-            return metafile
-        except IOError:
-            pass
+        if os.path.exists(name):
+            return name
 
 class Usage(Exception):
     pass
@@ -1261,6 +1313,91 @@ def opt_one(arg, single=''):
                 del arg[0]
             return opt,v
         
+# The state of a batch worker process, set by `batch_init`.
+batch_state = {}
+
+def batch(ids, source, outdir, meta=None, jobs=None, **key):
+    """
+    Plot each station in `ids` (a list of identifiers, or None for
+    every station in `source`) to its own SVG file, named after
+    the identifier, in the directory `outdir`.  The data source
+    and the metadata are opened once, and the plots are shared
+    among a pool of `jobs` worker processes (None means one per
+    CPU; 1 means plot in this process).  Other keyword arguments
+    are as per `plot`.
+
+    The number of stations plotted is returned.  Stations that
+    cannot be plotted are reported on stderr.
+    """
+
+    import multiprocessing
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    # Opening the source here means that any index is built once,
+    # before the workers start.
+    access = fast_access(source)
+    if ids is None:
+        if not hasattr(access, 'index'):
+            raise Error("Can't list the stations in %s" % source)
+        ids = list(access.index)
+    args = (source, read_meta(meta, [source]) or {}, outdir, key)
+
+    if jobs == 1:
+        batch_init(*args)
+        return count_plotted(map(batch_one, ids))
+    # Leaving the with block terminates the workers, even if the
+    # loop is interrupted.
+    with multiprocessing.Pool(jobs, batch_init, args) as pool:
+        return count_plotted(
+          pool.imap_unordered(batch_one, ids, chunksize=16))
+
+def count_plotted(results):
+    """
+    Count the plots made, given the (id, error) pairs returned by
+    `batch_one`; report the stations that could not be plotted on
+    stderr.
+    """
+
+    plotted = 0
+    for id, error in results:
+        if error:
+            sys.stderr.write("%s: %r\n" % (id, error))
+        else:
+            plotted += 1
+    return plotted
+
+def batch_init(source, meta, outdir, key):
+    """
+    Initialise a batch worker: open the data source and record
+    the arguments shared by every plot.
+    """
+
+    batch_state.update(source=source, meta=meta, outdir=outdir, key=key,
+      sources={source: fast_access(source)})
+
+def batch_one(id):
+    """
+    Plot the station `id` in a batch worker.  An (id, error) pair
+    is returned, error being None if the plot was written.
+    """
+
+    state = batch_state
+    station = Station(id=id, source=state['source'])
+    name = os.path.join(state['outdir'], id + '.svg')
+    try:
+        out = open(name, 'w', encoding='utf-8')
+    except Exception as e:
+        return id, e
+    try:
+        with out:
+            plot([station], out, meta=state['meta'],
+              sources=state['sources'], **state['key'])
+    except Exception as e:
+        os.remove(name)
+        return id, e
+    return id, None
+
 def main(argv=None):
     import sys
     if argv is None:
@@ -1269,6 +1406,8 @@ def main(argv=None):
     infile = 'input/ghcnm.tavg.qca.dat'
     metafile = None
     outfile = None
+    batchdir = None
+    jobs = None
 
     arg = argv[1:]
     key = {}
@@ -1278,6 +1417,8 @@ def main(argv=None):
         opt, v = opt_one(arg, single='ay')
         if opt == '--axes':
             key['axes'] = v
+        if opt == '--batch':
+            batchdir = v
         if opt == '--caption':
             key['caption'] = v
         if opt == '--colour':
@@ -1292,8 +1433,12 @@ def main(argv=None):
             key['mode'] = 'anom'
         if opt == '-o':
             outfile = v
+        if opt == '--reject':
+            key['masks'] = ghcnm_cache.parse_mask(v)
         if opt == '-d':
             infile = v
+        if opt == '-j':
+            jobs = int(v)
         if opt == '-m':
             metafile = v
         if opt == '-t':
@@ -1306,6 +1451,15 @@ def main(argv=None):
             key['scale'] = float(v)
     if not arg:
         return usage('At least one identifier must be supplied.')
+
+    if batchdir is not None:
+        derive_config(config)
+        ids = arg
+        if ids == ['all']:
+            ids = None
+        batch(ids, infile, batchdir, meta=metafile, jobs=jobs, **key)
+        return 0
+
     outfile = prepare_outfile(outfile, arg)
 
     """
@@ -1351,11 +1505,9 @@ def prepare_outfile(outfile, arg):
     if outfile is None:
         outfile = arg[0] + '.svg'
     if outfile == '-':
-        outfile = sys.stdout
-    else:
-        outfile = open(outfile, 'w')
-    # See http://drj11.wordpress.com/2007/05/14/python-how-is-sysstdoutencoding-chosen/#comment-3770
-    return codecs.getwriter('utf-8')(outfile)
+        # See http://drj11.wordpress.com/2007/05/14/python-how-is-sysstdoutencoding-chosen/#comment-3770
+        return codecs.getwriter('utf-8')(sys.stdout.buffer)
+    return open(outfile, 'w', encoding='utf-8')
 
 def usage(m):
     if m:
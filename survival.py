@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+"""
+survival.py [--jobs N] [--country | --element] [ghcnm.dat ...]
+
+Station survival curve: for every year Y, the number of stations
+that are still reporting in Y (that is, that have a record in the
+year Y or a more recent year).  For the year Y that is the number of
+stations that split_year.py would put in ghcnm-postY, but the whole
+curve is found in a single pass over the input, which is the named
+files (GHCN-M v2 or v3; compressed files are decompressed), or
+stdin.
+
+The output has a line for each year, from the first year in the
+input to the last:
+
+  YEAR COUNT
+
+--country counts the stations of each country (the first 3 digits
+of the identifier) separately, and --element counts, for each
+element, the stations with a record of that element in the year Y
+or later (in GHCN-M v2, which has no element, the element is
+always TAVG).  The output then has a line for each group and year:
+
+  YEAR GROUP COUNT
+
+--jobs reads the (uncompressed) inputs in N shards in parallel.
+"""
+
+import bisect
+import sys
+
+# ghcntool directory
+import shard
+import split_year
+
+def last_years(inp, name=None):
+    """
+    Read the GHCN-M file *inp* and return a (first, last) pair:
+    *first* is the earliest year of any row (None if there are no
+    rows), *last* is a dict that maps from (id11, element) to the
+    last year for which that station has a record of that element
+    (the element is always 'TAVG' for GHCN-M v2).
+
+    Whether the file is GHCN-M v2 or v3 is found once, from its
+    *name* if given, or else from its first row, in the same way
+    as split_year.py does (see split_year.id_length).
+    """
+
+    first = None
+    last = {}
+    n = None
+    for row in inp:
+        if not row.strip():
+            continue
+        if n is None:
+            n = split_year.id_length(row, name)
+        year = split_year.get_year(row, n)
+        if n == 11:
+            key = (split_year.id11(row), row[15:19])
+        else:
+            key = (split_year.id11(row), 'TAVG')
+        if last.get(key, year) <= year:
+            last[key] = year
+        if first is None or year < first:
+            first = year
+    return first, last
+
+def merge(results):
+    """Merge several (first, last) pairs, as returned by
+    `last_years`, into one."""
+
+    first = None
+    last = {}
+    for f, l in results:
+        if f is not None and (first is None or f < first):
+            first = f
+        for key, year in l.items():
+            if last.get(key, year) <= year:
+                last[key] = year
+    return first, last
+
+def last_years_files(names, jobs=1):
+    """As `last_years`, but for the files called *names*, read in
+    *jobs* shards in parallel."""
+
+    results = shard.run_many(names, jobs, shard_last_years)
+    return merge(r for rs in results for r in rs)
+
+def shard_last_years(name, start, stop):
+    """`last_years` for a shard of the file *name*."""
+
+    return last_years(shard.lines(name, start, stop), name)
+
+def survival(first, last, by=None):
+    """
+    Compute the survival curve, from the result of `last_years`.
+    *by* is None, 'country', or 'element'.  A dict is returned that
+    maps from group (None when *by* is None) to a list of counts,
+    one for each year from *first* to the last year of any station.
+    """
+
+    if not last:
+        return {}
+    # The last year of each station, in each group.
+    groups = {}
+    for (id, elem), year in last.items():
+        if by == 'element':
+            key = (elem, id)
+        elif by == 'country':
+            key = (id[:3], id)
+        else:
+            key = (None, id)
+        if groups.get(key, year) <= year:
+            groups[key] = year
+    years = {}
+    for (group, _), year in groups.items():
+        years.setdefault(group, []).append(year)
+
+    end = max(last.values())
+    curves = {}
+    for group, ys in years.items():
+        ys.sort()
+        curves[group] = [len(ys) - bisect.bisect_left(ys, y)
+          for y in range(first, end + 1)]
+    return curves
+
+def write_curves(out, first, curves):
+    """Write the curves returned by `survival` to *out*."""
+
+    for group in sorted(curves, key=lambda g: (g is not None, g)):
+        for i, n in enumerate(curves[group]):
+            if group is None:
+                out.write("%d %d\n" % (first + i, n))
+            else:
+                out.write("%d %s %d\n" % (first + i, group, n))
+
+def main(argv=None):
+    import getopt
+
+    if argv is None:
+        argv = sys.argv
+
+    opt, arg = getopt.getopt(argv[1:], '', ['jobs=', 'country', 'element'])
+    jobs = 1
+    by = None
+    for k,v in opt:
+        if k == '--jobs':
+            jobs = int(v)
+        if k == '--country':
+            by = 'country'
+        if k == '--element':
+            by = 'element'
+
+    if arg:
+        first, last = last_years_files(arg, jobs)
+    else:
+        first, last = last_years(sys.stdin)
+    write_curves(sys.stdout, first, survival(first, last, by))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""
+Tests for ghcnm_cache.py.
+
+  python -m unittest test_ghcnm_cache
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+# ghcntool directory
+import ghcnm_cache
+
+ROW = (b'10160355000' + b'1990' + b'TAVG' +
+  b''.join(b'%5d   ' % (100 * m) for m in range(12)) + b'\n')
+
+class CacheClose(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.name = os.path.join(self.dir, 't.dat')
+        with open(self.name, 'wb') as f:
+            f.write(ROW)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_close_with_series_alive(self):
+        cache = ghcnm_cache.Cache(self.name)
+        values, first_year = cache.series(0)
+        flags = cache.series_flags(0)
+        self.assertEqual(first_year, 1990)
+        self.assertEqual(values[1], 100)
+        self.assertTrue(cache.close())
+        self.assertIsNone(cache.map)
+        # The views handed out are released, and closing again is
+        # harmless.
+        self.assertRaises(ValueError, lambda: values[0])
+        self.assertRaises(ValueError, lambda: flags[0])
+        cache.close()
+
+    def test_close_with_derived_view_alive(self):
+        cache = ghcnm_cache.Cache(self.name)
+        values, _ = cache.series(0)
+        raw = values.cast('B')
+        # The map can't go while `raw` is alive, so it stays open
+        # (and the cache's own views are released).
+        self.assertFalse(cache.close())
+        self.assertIsNotNone(cache.map)
+        self.assertFalse(cache.map.closed)
+        self.assertEqual(len(raw), 24)
+        self.assertEqual(raw[2], 100)
+        self.assertRaises(ValueError, lambda: values[0])
+        self.assertRaises(ValueError, lambda: cache.values[0])
+        del raw
+        self.assertTrue(cache.close())
+        self.assertIsNone(cache.map)
+
+if __name__ == '__main__':
+    unittest.main()
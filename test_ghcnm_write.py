@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+"""
+Tests for ghcnm_write.py.
+
+  python -m unittest test_ghcnm_write
+"""
+
+import array
+import io
+import random
+import unittest
+
+# ghcntool directory
+import ghcnm_write
+
+MISSING = -9999
+
+def reference_rows(id, element, first_year, values, flags=None):
+    """
+    The rows of a series formatted the old way, a row at a time and
+    a value at a time: '{:5d}' for each value followed by its 3
+    flag characters, skipping years with no valid data.
+    """
+
+    if flags is None:
+        flags = b' ' * (3 * len(values))
+    result = []
+    for y in range(len(values) // 12):
+        year = values[12*y:12*y+12]
+        if all(v == MISSING for v in year):
+            continue
+        data = ''.join('{:5d}'.format(v) +
+          flags[3*m:3*m+3].decode('iso8859-1')
+          for m, v in enumerate(year, 12*y))
+        result.append("{}{:4d}{}{}\n".format(id, first_year + y, element,
+          data))
+    return ''.join(result).encode('iso8859-1')
+
+# Values that are awkward to format: MISSING, values below it (too
+# wide for the field), 4 and 5 character negatives, and the ends of
+# the int16 range.
+EDGES = [MISSING, -10000, -10001, -32768, -32767, -9998, -1000, -999,
+  -100, -99, -10, -9, -1, 0, 1, 9, 10, 9999, 10000, 32767]
+
+# Flag characters, including blanks.
+FLAG_CHARS = b' ' * 8 + b'ADEGKLMNOQRSTWX0123456abc'
+
+def random_series(rng, years, values=None):
+    """A (values, flags) pair for a random series of `years` years;
+    the values are picked from `values` if it is given."""
+
+    n = 12 * years
+    if values is None:
+        result = [rng.choice([MISSING, rng.randrange(-32768, 32768),
+          rng.randrange(-9999, 10000)]) for _ in range(n)]
+    else:
+        result = [rng.choice(values) for _ in range(n)]
+    # A year with no valid data, which is skipped.
+    if years > 2:
+        result[12:24] = [MISSING] * 12
+    flags = bytes(rng.choice(FLAG_CHARS) for _ in range(3 * n))
+    return array.array('h', result), flags
+
+class Format(unittest.TestCase):
+    def test_edge_values(self):
+        rng = random.Random(1)
+        for k in range(50):
+            values, flags = random_series(rng, 5, EDGES)
+            self.assertEqual(
+              ghcnm_write.rows('10160355000', 'TAVG', 1900, values, flags),
+              reference_rows('10160355000', 'TAVG', 1900, values, flags))
+
+    def test_each_edge_value(self):
+        # Each value in a series of its own, so that the fast path
+        # (no value below MISSING) is used where it can be.
+        for v in EDGES:
+            values = array.array('h', [v] * 12)
+            flags = b' X ' * 12
+            self.assertEqual(
+              ghcnm_write.rows('10160355000', 'TMAX', 2000, values, flags),
+              reference_rows('10160355000', 'TMAX', 2000, values, flags))
+
+    def test_random_values(self):
+        rng = random.Random(2)
+        for k in range(50):
+            values, flags = random_series(rng, rng.randrange(1, 30))
+            if k % 2:
+                # Without any value below MISSING.
+                values = array.array('h', [max(v, MISSING) for v in values])
+            self.assertEqual(
+              ghcnm_write.rows('42512345000', b'PRCP', 1850, values, flags),
+              reference_rows('42512345000', 'PRCP', 1850, values, flags))
+
+    def test_no_flags(self):
+        values = array.array('h', EDGES[:12])
+        self.assertEqual(ghcnm_write.rows('10160355000', 'TAVG', 1990, values),
+          reference_rows('10160355000', 'TAVG', 1990, values))
+
+    def test_values_as_list_and_memoryview(self):
+        values = array.array('h', EDGES[:12] * 2)
+        expected = reference_rows('10160355000', 'TAVG', 1990, values)
+        for form in [list(values), memoryview(values)]:
+            self.assertEqual(
+              ghcnm_write.rows('10160355000', 'TAVG', 1990, form), expected)
+
+class Write(unittest.TestCase):
+    def test_writer(self):
+        rng = random.Random(3)
+        saved = ghcnm_write.CHUNK
+        # Small, so that the rows are written in many chunks.
+        ghcnm_write.CHUNK = 1000
+        try:
+            out = io.BytesIO()
+            expected = []
+            with ghcnm_write.Writer(out) as writer:
+                for s in range(40):
+                    id = '%011d' % rng.randrange(10**11)
+                    values, flags = random_series(rng, rng.randrange(1, 10),
+                      EDGES + [rng.randrange(-32768, 32768)])
+                    writer.write_series(id, 'TAVG', 1950, values, flags)
+                    expected.append(reference_rows(id, 'TAVG', 1950,
+                      values, flags))
+        finally:
+            ghcnm_write.CHUNK = saved
+        self.assertEqual(out.getvalue(), b''.join(expected))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+"""
+Tests for scalpel.py.
+
+  python -m unittest test_scalpel
+"""
+
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+# ghcntool directory
+import scalpel
+
+MISSING = -9999
+ID = '10160355000'
+FLAGS = b'  W'
+
+# The months (counting from January 1990) of a TAVG series: a
+# missing start and end (trimmed off), a gap of 1 month (with a QC
+# flag) and a gap of 12 months.
+FIRST_YEAR = 1990
+GAP1 = (17, 18)
+GAP12 = (26, 38)
+TRIMMED = (3, 46)
+
+def value(k):
+    """The value for month `k` of the series (MISSING in the gaps,
+    and outside TRIMMED)."""
+
+    if not TRIMMED[0] <= k < TRIMMED[1]:
+        return MISSING
+    if GAP1[0] <= k < GAP1[1] or GAP12[0] <= k < GAP12[1]:
+        return MISSING
+    # Some 4 and 5 character negatives among them.
+    return {5: -123, 20: -1234}.get(k, 10 * k)
+
+def flag(k):
+    if k == GAP1[0]:
+        return b' X '
+    if value(k) == MISSING:
+        return b'   '
+    return FLAGS
+
+def row(id, year, fields, element=b'TAVG'):
+    """A GHCN-M v3 row (bytes) with the 12 (value, flags) pairs
+    `fields`."""
+
+    return (id.encode('ascii') + b'%4d%s' % (year, element) +
+      b''.join(b'%5d%s' % field for field in fields) + b'\n')
+
+def series_rows(id, start, stop):
+    """The rows for months `start` to `stop` of the series, padded
+    to whole years with blank flags, as scalpel writes a child."""
+
+    result = []
+    for year in range(start // 12, -(-stop // 12)):
+        fields = []
+        for k in range(12 * year, 12 * year + 12):
+            if start <= k < stop:
+                fields.append((value(k), flag(k)))
+            else:
+                fields.append((MISSING, b'   '))
+        result.append(row(id, FIRST_YEAR + year, fields))
+    return b''.join(result)
+
+DAT = series_rows(ID, 0, 48)
+INV = ID.encode('ascii') + b'  51.9500   -9.7500  100.0 STATION\n'
+
+# A valid month, then a missing one, over and over.
+COMB = b''.join(row(ID, year, [(100, FLAGS), (MISSING, b'   ')] * 6)
+  for year in range(1900, 1908))
+
+def cut(data, N, inv=INV):
+    """Run scalpel on `data` (and `inv`) with `N`, and return the
+    (.dat, .inv) output."""
+
+    out_dat = io.BytesIO()
+    out_inv = io.BytesIO()
+    saved = scalpel.config.N
+    scalpel.config.N = N
+    try:
+        scalpel.scalpel(io.BytesIO(data), io.BytesIO(inv), out_dat, out_inv)
+    finally:
+        scalpel.config.N = saved
+    return out_dat.getvalue(), out_inv.getvalue()
+
+class Cuts(unittest.TestCase):
+    def station(self):
+        [station] = scalpel.records(io.BytesIO(DAT))
+        self.assertTrue(station.trim())
+        return station
+
+    def test_trim_and_gaps(self):
+        station = self.station()
+        self.assertEqual((station.start, station.stop), TRIMMED)
+        self.assertEqual(station.gaps(), [GAP1, GAP12])
+
+    def test_cuts(self):
+        station = self.station()
+        self.assertEqual(list(station.cuts(13)), [TRIMMED])
+        self.assertEqual(list(station.cuts(12)),
+          [(3, 26), (38, 46)])
+        self.assertEqual(list(station.cuts(1)),
+          [(3, 17), (18, 26), (38, 46)])
+
+    def test_rows_written(self):
+        dat, inv = cut(DAT, 12)
+        # The older child gets a mutated id; each child is padded
+        # out to whole years, keeping the flags of its own months.
+        self.assertEqual(dat,
+          series_rows('1016035500a', 3, 26) + series_rows(ID, 38, 46))
+        self.assertEqual(inv, INV + b'1016035500a' + INV[11:])
+
+    def test_rows_written_uncut(self):
+        dat, inv = cut(DAT, 13)
+        # Only the trimmed years (none of them all missing) are kept.
+        self.assertEqual(dat, series_rows(ID, 0, 48))
+        self.assertEqual(inv, INV)
+
+    def test_too_many_children(self):
+        # With N=1 each valid month is a child.
+        self.assertRaises(scalpel.Error, cut, COMB, 1)
+        dat, _ = cut(COMB, 2)
+        self.assertEqual(dat, COMB)
+
+def dataset(seed=1, stations=30):
+    """
+    A (.dat, .inv) pair of made up data: stations with runs of
+    valid data separated by gaps of random lengths, some of them
+    with a second element (ISTI style, so that a station has
+    several series).
+    """
+
+    rng = random.Random(seed)
+    dat = []
+    inv = []
+    for s in range(stations):
+        id = '%03d%08d' % (100 + s, rng.randrange(10**8))
+        inv.append(id.encode('ascii') + INV[11:])
+        elements = [b'TAVG']
+        if s % 3 == 0:
+            elements.append(b'TMAX')
+        for element in elements:
+            months = []
+            while len(months) < 12 * 40:
+                months.extend([None] * rng.choice([0, 1, 3, 11, 12, 17,
+                  18, 23, 24, 30]))
+                months.extend(range(rng.randrange(1, 60)))
+            first_year = 1900 + rng.randrange(50)
+            for y in range(len(months) // 12):
+                fields = [(MISSING, b'   ') if v is None else (v, FLAGS)
+                  for v in months[12*y:12*y+12]]
+                if any(v != MISSING for v, _ in fields):
+                    dat.append(row(id, first_year + y, fields, element))
+    return b''.join(dat), b''.join(inv)
+
+class Sweep(unittest.TestCase):
+    Ns = [12, 18, 24]
+
+    def setUp(self):
+        self.dat, self.inv = dataset()
+        self.expected = {}
+        for N in self.Ns:
+            self.expected[N] = cut(self.dat, N, self.inv)
+
+    def check(self, counts, out):
+        for N in self.Ns:
+            dat, inv = self.expected[N]
+            self.assertEqual(out[N][0].getvalue(), dat)
+            self.assertEqual(out[N][1].getvalue(), inv)
+            # The count is of distinct station ids: one .inv row
+            # for each.
+            ids = set(line[:11] for line in inv.splitlines())
+            self.assertEqual(len(ids), len(inv.splitlines()))
+            self.assertEqual(counts[N], len(ids))
+
+    def outputs(self):
+        return dict((N, (io.BytesIO(), io.BytesIO())) for N in self.Ns)
+
+    def test_sweep_same_as_separate_runs(self):
+        out = self.outputs()
+        counts = scalpel.sweep(io.BytesIO(self.dat), self.Ns,
+          io.BytesIO(self.inv), out)
+        self.check(counts, out)
+        # Without output, the counts are the same.
+        self.assertEqual(scalpel.sweep(io.BytesIO(self.dat), self.Ns),
+          counts)
+
+    def test_sweep_file_same_as_separate_runs(self):
+        dir = tempfile.mkdtemp()
+        try:
+            name = os.path.join(dir, 't.dat')
+            with open(name, 'wb') as f:
+                f.write(self.dat)
+            for jobs in [1, 3]:
+                out = self.outputs()
+                counts = scalpel.sweep_file(name, self.Ns,
+                  io.BytesIO(self.inv), out, jobs)
+                self.check(counts, out)
+        finally:
+            shutil.rmtree(dir)
+
+    def test_too_many_children(self):
+        # Even with no output, as the counts would be of ids that
+        # can't be made.
+        self.assertRaises(scalpel.Error, scalpel.sweep,
+          io.BytesIO(self.dat + COMB), [1, 12])
+        self.assertEqual(scalpel.sweep(io.BytesIO(COMB), [2, 12]),
+          {2: 1, 12: 1})
+
+if __name__ == '__main__':
+    unittest.main()
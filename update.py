@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+"""
+update.py [--jobs N] old.dat new.dat
+
+Bring the index and cache of a new release of a GHCN-M file up to
+date, using those of the previous release, and report the
+stations that differ between them.
+
+Each station's block of rows in the two files is compared by
+length and checksum (CRC-32).  The checksums of the old file are
+those saved in its binary index (old.dat.bindex, see
+ghcnm_index.py), so the old file itself is not read (its index is
+built first if it is missing or out of date).  The new binary index
+is written, with the new checksums, from the scan of the new file
+that finds its blocks.  If the old file has an up to date cache (see
+ghcnm_cache.py), the new cache is written too: the series of
+stations whose blocks are unchanged are copied from the old cache,
+and only the blocks of changed and added stations are parsed.
+
+The output is a line for each station that differs:
+
+  changed ID
+  added ID
+  removed ID
+
+so that anything derived from the changed stations (plots, say)
+can be refreshed selectively.  --jobs is used to scan the files in
+parallel.
+"""
+
+import os
+import sys
+
+# ghcntool directory
+import compressed
+import ghcnm_cache
+import ghcnm_index
+
+def old_checksums(name, jobs=1):
+    """
+    The checksums saved in the binary index of the GHCN-M file
+    `name` (which is built, scanning with `jobs` processes, if it is
+    missing or out of date), as a dict that maps from id (bytes) to
+    a (length, crc) pair.
+    """
+
+    index_name = name + '.bindex'
+    stamp = ghcnm_cache.stamp(name)
+    try:
+        index = ghcnm_index.BinaryIndex(index_name, stamp)
+    except (IOError, ghcnm_index.Error):
+        ghcnm_index.build_file(name, jobs)
+        index = ghcnm_index.BinaryIndex(index_name, stamp)
+    try:
+        return sums_dict((id.encode('ascii'), whence, length, crc)
+          for id, whence, length, crc in index.checksums())
+    finally:
+        index.close()
+
+def sums_dict(sums):
+    """A dict that maps from id to a (length, crc) pair, from
+    `sums` as returned by ghcnm_index.checksums."""
+
+    return dict((id, (length, crc)) for id, _, length, crc in sums)
+
+def compare(old, new):
+    """
+    Compare the dicts of checksums `old` and `new` (as returned by
+    `sums_dict`).  A (changed, added, removed) triple of sorted
+    lists of ids is returned.
+    """
+
+    changed = sorted(id for id in new if id in old and new[id] != old[id])
+    added = sorted(id for id in new if id not in old)
+    removed = sorted(id for id in old if id not in new)
+    return changed, added, removed
+
+def update(old_name, new_name, jobs=1):
+    """
+    Update the index and cache of the GHCN-M file `new_name` using
+    those of `old_name` (see the module docstring).  A (changed,
+    added, removed) triple of lists of ids is returned.
+    """
+
+    n = ghcnm_index.id_length(new_name)
+    old_sums = old_checksums(old_name, jobs)
+    new_blocks = ghcnm_index.scan(new_name, n, jobs, elements=(n == 11))
+    new_stations = ghcnm_index.stations(new_blocks)
+
+    new_reader = compressed.open_reader(new_name)
+    try:
+        sums = ghcnm_index.checksums(new_reader, new_stations)
+        new_sums = sums_dict(sums)
+        changed, added, removed = compare(old_sums, new_sums)
+
+        write_index(new_name, new_blocks, sums)
+        if n == 11:
+            try:
+                old_cache = ghcnm_cache.Cache(old_name, build=False)
+            except ghcnm_cache.Error:
+                old_cache = None
+            if old_cache is not None:
+                unchanged = set(id for id in new_sums
+                  if old_sums.get(id) == new_sums[id])
+                write_cache(new_name, new_reader, new_stations,
+                  old_cache, unchanged)
+                old_cache.close()
+    finally:
+        new_reader.close()
+    return tuple([id.decode('iso8859-1') for id in ids]
+      for ids in (changed, added, removed))
+
+def write_index(name, blocks, sums):
+    """Write the binary index of the file `name`, given its
+    `blocks` (as per ghcnm_index.scan) and the checksums of its
+    stations, `sums` (as per ghcnm_index.checksums)."""
+
+    index_name = name + '.bindex'
+    tmp = '%s.%d.tmp' % (index_name, os.getpid())
+    with open(tmp, 'wb') as out:
+        ghcnm_index.write_binary(blocks, sums, out, ghcnm_cache.stamp(name))
+    os.replace(tmp, index_name)
+
+def write_cache(name, reader, stations, old_cache, unchanged):
+    """
+    Write the cache of the GHCN-M v3 file `name`, read by `reader`,
+    whose `stations` are as per ghcnm_index.stations.  The series
+    of the stations in the set `unchanged` are copied from
+    `old_cache`.
+    """
+
+    # The series of each station in the old cache, in order.
+    old = {}
+    for i in range(len(old_cache)):
+        old.setdefault(old_cache.id(i).encode('ascii'), []).append(i)
+
+    def series():
+        for id, start, stop in stations:
+            if id in unchanged and id in old:
+                for i in old[id]:
+                    values, first_year = old_cache.series(i)
+                    yield (id, old_cache.element(i).encode('ascii'),
+                      first_year, values, old_cache.series_flags(i))
+                continue
+            block = reader.read(start, stop - start)
+            for s in ghcnm_cache.parse(block.splitlines(True)):
+                yield s
+
+    cache_name = name + '.cache'
+    tmp = '%s.%d.tmp' % (cache_name, os.getpid())
+    with open(tmp, 'wb') as out:
+        ghcnm_cache.write(series(), out, ghcnm_cache.stamp(name))
+    os.replace(tmp, cache_name)
+
+def main(argv=None):
+    import getopt
+
+    if argv is None:
+        argv = sys.argv
+
+    opt, arg = getopt.getopt(argv[1:], '', ['jobs='])
+    jobs = 1
+    for k,v in opt:
+        if k == '--jobs':
+            jobs = int(v)
+
+    changed, added, removed = update(arg[0], arg[1], jobs)
+    for status, ids in [('changed', changed), ('added', added),
+      ('removed', removed)]:
+        for id in ids:
+            sys.stdout.write("%s %s\n" % (status, id))
+
+if __name__ == '__main__':
+    main()
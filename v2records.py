@@ -1,8 +1,10 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # records.py
 
 """
+v2records.py [--jobs N] [input/v2.mean]
+
 Process a v2.mean file to find:
 - longest record (latest year minus oldest year)
 - shortest record
@@ -10,17 +12,21 @@ Process a v2.mean file to find:
 - least range
 - fattest (largest ratio of record length to range)
 - skinniest (smallest ratio of record length to range)
+
+--jobs splits the input into N shards that are processed in
+parallel (and turns off the progress display).
 """
 
 import itertools
-import os
 import struct
 import sys
 
-sys.path.append(os.path.join(os.getcwd(),'code'))
+# ghcntool directory
+import compressed
+import shard
 
-def collect(v2):
-    """v2 should be a v2.mean file"""
+def collect(v2, progress=True):
+    """v2 should be a v2.mean file (opened in binary mode)"""
 
     def id11(x):
         return x[:11]
@@ -36,10 +42,12 @@ def collect(v2):
     skinniest = (9999, '')
    
     for id11,lines in itertools.groupby(v2, id11):
-        sys.stdout.write('\r' + id11 + ' ')
-        sys.stdout.write(' '.join([longest[1], shortest[1], largest[1],
-        flattest[1]]))
-        sys.stdout.flush()
+        id11 = id11.decode('ascii')
+        if progress:
+            sys.stdout.write('\r' + id11 + ' ')
+            sys.stdout.write(' '.join([longest[1], shortest[1], largest[1],
+            flattest[1]]))
+            sys.stdout.flush()
         lines = list(lines)
         yearmin = min(map(year, lines))
         yearmax = max(map(year, lines))
@@ -47,9 +55,8 @@ def collect(v2):
         tmin = 9999
         tmax = -9999
         for row in lines:
-            data = struct.unpack('5s'*12, row[16:-1])
-            data = map(int, data)
-            data = filter(lambda x: x != -9999, data)
+            data = struct.unpack('5s'*12, row[16:76])
+            data = [x for x in map(int, data) if x != -9999]
             tmin = min([tmin]+data)
             tmax = max([tmax]+data)
         range = tmax - tmin
@@ -67,9 +74,52 @@ def collect(v2):
         if aspect < skinniest[0]:
             skinniest = (aspect, id11)
 
-    sys.stdout.write('\n')
+    if progress:
+        sys.stdout.write('\n')
     return longest, shortest, largest, flattest, fattest, skinniest
 
+def collect_file(name, jobs):
+    """As `collect`, but for the file called *name*, which is processed
+    in *jobs* shards in parallel."""
+
+    results = shard.run(name, jobs, shard_collect)
+    # Combine the results of the shards, in order, using the same
+    # comparisons as `collect` (so that ties are resolved the same way).
+    best = list(results[0])
+    for result in results[1:]:
+        for i, (value, id11) in enumerate(result):
+            if i % 2 == 0:
+                better = value > best[i][0]
+            else:
+                better = value < best[i][0]
+            if better:
+                best[i] = (value, id11)
+    return tuple(best)
+
+def shard_collect(name, start, stop):
+    """`collect` a shard of the file *name*."""
+
+    return collect(shard.lines(name, start, stop, binary=True),
+      progress=False)
+
+def main(argv=None):
+    import getopt
+
+    if argv is None:
+        argv = sys.argv
+
+    opt, arg = getopt.getopt(argv[1:], '', ['jobs='])
+    jobs = 1
+    for k,v in opt:
+        if k == '--jobs':
+            jobs = int(v)
+
+    name = (arg or ['input/v2.mean'])[0]
+    if jobs > 1:
+        print(collect_file(name, jobs))
+    else:
+        with compressed.open_input(name) as v2:
+            print(collect(v2))
+
 if __name__ == '__main__':
-    from step0 import open_or_uncompress
-    print collect(open_or_uncompress('input/v2.mean'))
+    main()
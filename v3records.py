@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+"""
+v3records.py [--jobs N] [--cache] [--element E] [--top K]
+  [--reject MASK] [--csv] [ghcnm.dat]
+
+Process a GHCN-M v3 file (or stdin) and find, for each station's
+record of one element (TAVG by default):
+
+- length: the latest year minus the oldest year, plus one
+- range: the highest minus the lowest value, in degrees
+- aspect: the ratio of length to range (years per degree)
+- valid: the number of valid monthly values
+
+and report the K (10 by default) stations with the largest, and
+the K with the smallest, value of each of those.  Stations with no
+valid values are not counted; stations whose range is 0 have no
+aspect.  Ties are broken in favour of the station that comes first
+in the input.  Only the K largest and K smallest of each metric
+are kept as the input is read (in heaps), so memory does not grow
+with the number of stations.  --reject treats the values whose
+flags match MASK (see ghcnm_cache.parse_mask; 'Q' rejects every
+value that failed quality control) as invalid.
+
+The report is JSON, or with --csv, CSV with a row for each
+station in each ranking:
+
+  metric,order,rank,id,value
+
+Each station's record is parsed into an array (see
+ghcnm_cache.parse), and the statistics are computed from the whole
+array at once.  --cache reads the records from the binary cache
+made by ghcnm_cache.py instead (building it if need be).  --jobs
+splits the input into N shards that are processed in parallel.
+
+This is the GHCN-M v3 successor to v2records.py.
+"""
+
+import csv
+import heapq
+import json
+import sys
+
+# ghcntool directory
+import ghcnm_cache
+import shard
+
+# The statistics, in the order of the tuples made by `stats`.
+METRICS = ['length', 'range', 'aspect', 'valid']
+
+def stats(values):
+    """
+    Compute the statistics of a record, given its `values` (12 for
+    each year, MISSING for invalid, in hundredths of a degree), as
+    a (length, range, aspect, valid) tuple; or None if there are no
+    valid values.
+    """
+
+    values = values.tolist()
+    length = len(values) // 12
+    valid = len(values) - values.count(ghcnm_cache.MISSING)
+    if not valid:
+        return None
+    distinct = set(values)
+    distinct.discard(ghcnm_cache.MISSING)
+    range = (max(distinct) - min(distinct)) * 0.01
+    aspect = length / range if range else None
+    return length, range, aspect, valid
+
+def collect(series, element='TAVG', k=10, masks=None):
+    """
+    Collect statistics from `series`, a sequence of
+    (id, element, first_year, values, flags) tuples as yielded by
+    ghcnm_cache.parse, for the records of `element`.  The values
+    are masked with `masks`, if given (see ghcnm_cache.mask).  A
+    (count, rankings) pair is returned (see `rank`).
+    """
+
+    element = element.encode('ascii')
+    count = 0
+    rankings = [Ranking(k) for _ in METRICS]
+    for s in series:
+        id, elem, _, values, flags = s
+        if elem != element:
+            continue
+        if masks:
+            values = ghcnm_cache.mask(values, flags, masks)
+        result = stats(values)
+        if result is None:
+            continue
+        count += 1
+        if isinstance(id, bytes):
+            id = id.decode('ascii')
+        for ranking, value in zip(rankings, result):
+            if value is not None:
+                ranking.push(value, id)
+    return count, dict((metric, (ranking.largest(), ranking.smallest()))
+      for metric, ranking in zip(METRICS, rankings))
+
+class Ranking:
+    """
+    The `k` largest and the `k` smallest of the values pushed,
+    kept in a pair of heaps of size `k` as they are pushed.  Ties
+    are broken in favour of the value pushed first.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        # Entries are (value, -n, id) for the largest, and
+        # (-value, -n, id) for the smallest, n counting the values
+        # pushed; the root of each heap is the entry to drop next.
+        self.top = []
+        self.bottom = []
+        self.n = 0
+
+    def push(self, value, id):
+        if self.k <= 0:
+            return
+        self.n += 1
+        for heap, entry in [(self.top, (value, -self.n, id)),
+          (self.bottom, (-value, -self.n, id))]:
+            if len(heap) < self.k:
+                heapq.heappush(heap, entry)
+            else:
+                heapq.heappushpop(heap, entry)
+
+    def largest(self):
+        """The `k` largest, as a list of (value, id) pairs in
+        order."""
+
+        return [(v, id) for v, _, id in sorted(self.top, reverse=True)]
+
+    def smallest(self):
+        """The `k` smallest, as a list of (value, id) pairs in
+        order."""
+
+        return [(-v, id) for v, _, id in sorted(self.bottom, reverse=True)]
+
+def merge(results, k):
+    """
+    Merge the (count, rankings) pairs of several shards, in input
+    order, into one.  The (value, id) pairs of each shard's
+    rankings are pushed, in order, into a `Ranking` for each
+    metric, so ties still go to the station first in the input.
+    """
+
+    count = sum(c for c, _ in results)
+    merged = {}
+    for metric in METRICS:
+        top = Ranking(k)
+        bottom = Ranking(k)
+        for _, r in results:
+            for value, id in r[metric][0]:
+                top.push(value, id)
+            for value, id in r[metric][1]:
+                bottom.push(value, id)
+        merged[metric] = (top.largest(), bottom.smallest())
+    return count, merged
+
+def collect_file(name, jobs, element='TAVG', k=10, masks=None):
+    """As `collect`, but for the file called `name`, which is
+    processed in `jobs` shards in parallel."""
+
+    return merge(shard.run(name, jobs, shard_collect, element, k, masks),
+      k)
+
+def shard_collect(name, start, stop, element, k, masks):
+    """`collect` a shard of the file `name`."""
+
+    return collect(ghcnm_cache.parse(shard.lines(name, start, stop,
+      binary=True)), element, k, masks)
+
+def collect_cache(name, element='TAVG', k=10, masks=None):
+    """As `collect`, but the records are read from the binary cache
+    of the file called `name`."""
+
+    cache = ghcnm_cache.Cache(name)
+    try:
+        series = ((cache.id(i), cache.element(i).encode('ascii'),
+          None, cache.series(i)[0], cache.series_flags(i))
+          for i in range(len(cache)))
+        return collect(series, element, k, masks)
+    finally:
+        cache.close()
+
+def report(count, rankings, element):
+    """The report, as a dict (which is what is written as JSON)."""
+
+    return dict(
+      element=element,
+      stations=count,
+      metrics=dict((metric, dict(
+        (order, [dict(id=id, value=value) for value, id in pairs])
+        for order, pairs in zip(['largest', 'smallest'],
+          rankings[metric])))
+        for metric in METRICS))
+
+def write_csv(out, rankings):
+    """Write the rankings as CSV."""
+
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(['metric', 'order', 'rank', 'id', 'value'])
+    for metric in METRICS:
+        for order, pairs in zip(['largest', 'smallest'], rankings[metric]):
+            for i, (value, id) in enumerate(pairs):
+                writer.writerow([metric, order, i + 1, id, value])
+
+def main(argv=None):
+    import getopt
+
+    if argv is None:
+        argv = sys.argv
+
+    opt, arg = getopt.getopt(argv[1:], '',
+      ['jobs=', 'cache', 'element=', 'top=', 'reject=', 'csv'])
+    jobs = 1
+    cache = False
+    element = 'TAVG'
+    top = 10
+    masks = None
+    as_csv = False
+    for k,v in opt:
+        if k == '--jobs':
+            jobs = int(v)
+        if k == '--cache':
+            cache = True
+        if k == '--element':
+            element = v
+        if k == '--top':
+            top = int(v)
+        if k == '--reject':
+            masks = ghcnm_cache.parse_mask(v)
+        if k == '--csv':
+            as_csv = True
+
+    if not arg:
+        count, rankings = collect(ghcnm_cache.parse(sys.stdin.buffer),
+          element, top, masks)
+    elif cache:
+        count, rankings = collect_cache(arg[0], element, top, masks)
+    else:
+        count, rankings = collect_file(arg[0], jobs, element, top, masks)
+
+    if as_csv:
+        write_csv(sys.stdout, rankings)
+    else:
+        json.dump(report(count, rankings, element), sys.stdout,
+          indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()